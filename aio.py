@@ -0,0 +1,157 @@
+"""asyncio serving mode for the cassette recorder.
+
+Serves the same routes as the Flask app in ``cassette.py`` on aiohttp, with
+non-blocking upstream requests, so one process can hold thousands of proxied
+requests in flight. The tape is still the module-level
+``cassette.history_manager``; calls into it run on a single recorder thread so
+disk I/O never blocks the event loop and entries are recorded in order.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import time
+import uuid
+
+try:
+    from aiohttp import ClientSession, ClientTimeout, DummyCookieJar, TCPConnector, web
+except ImportError:  # aiohttp is an optional dependency
+    web = None
+
+import cassette
+from history import HistoryEntry, decode_body
+from search import HistoryQuery
+
+PROXY_METHODS = ("GET", "POST", "PUT", "PATCH", "DELETE")
+
+if web is not None:
+    POOL_SIZE = web.AppKey("pool_size", int)
+    TIMEOUT = web.AppKey("timeout", ClientTimeout)
+    SESSION = web.AppKey("session", ClientSession)
+    RECORDER = web.AppKey("recorder", ThreadPoolExecutor)
+
+
+def create_app(upstream_url, pool_size=100, connect_timeout=None, read_timeout=None):
+    """Build the aiohttp application proxying to ``upstream_url``."""
+    if web is None:
+        raise RuntimeError("The asyncio engine needs aiohttp: pip install aiohttp")
+    cassette.app.config["UPSTREAM_URL"] = upstream_url
+    app = web.Application(client_max_size=0)
+    app[POOL_SIZE] = pool_size
+    app[TIMEOUT] = ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+    app.cleanup_ctx.append(upstream_session)
+    app.router.add_get("/__/history", history)
+    app.router.add_post("/__/replay", replay)
+    for method in PROXY_METHODS:
+        app.router.add_route(method, "/{path:.+}", proxy)
+    return app
+
+
+async def upstream_session(app):
+    app[RECORDER] = ThreadPoolExecutor(max_workers=1, thread_name_prefix="recorder")
+    app[SESSION] = ClientSession(
+        connector=TCPConnector(limit=app[POOL_SIZE]),
+        cookie_jar=DummyCookieJar(),
+        timeout=app[TIMEOUT],
+    )
+    yield
+    await app[SESSION].close()
+    app[RECORDER].shutdown(wait=True)
+
+
+async def on_recorder(request, func, *args):
+    """Run a HistoryManager call on the recorder thread."""
+    return await asyncio.get_running_loop().run_in_executor(request.app[RECORDER], func, *args)
+
+
+def client_headers(upstream_headers):
+    # aiohttp has already decoded the body, so its framing headers no longer apply.
+    return {k: v for k, v in upstream_headers.items() if k.lower() not in cassette.FRAMING_HEADERS}
+
+
+async def proxy(request):
+    started = time.perf_counter()
+    path = request.match_info["path"]
+    body = await request.read()
+    timings = {"receive": cassette.elapsed_ms(started)}
+    headers = {k: v for k, v in request.headers.items() if k not in ("Host", "Transfer-Encoding")}
+    url = cassette.upstream_url_for(path, request.query_string)
+    sent = time.perf_counter()
+    async with request.app[SESSION].request(request.method, url, headers=headers, data=body) as resp:
+        timings["ttfb"] = cassette.elapsed_ms(sent)
+        content = await resp.read()
+    timings["upstream"] = cassette.elapsed_ms(sent)
+    entry = HistoryEntry(
+        id=str(uuid.uuid4()),
+        method=request.method,
+        path=path,
+        status_code=resp.status,
+        headers=headers,
+        data=decode_body(body),
+        response_headers=dict(resp.headers),
+        response_body=decode_body(content),
+        timestamp=datetime.utcnow(),
+        query=request.query_string,
+        timings=dict(timings),
+    )
+    await on_recorder(request, cassette.record_entry, entry)
+    return web.Response(body=content, status=resp.status, headers=client_headers(resp.headers))
+
+
+async def history(request):
+    try:
+        limit = int(request.query.get("limit", 10))
+    except ValueError:
+        limit = 10
+    unique = request.query.get("unique", "false").lower() == "true"
+    counts = request.query.get("counts", "false").lower() == "true"
+    try:
+        query = HistoryQuery.from_args({name: request.query.getall(name) for name in request.query})
+        payload = await on_recorder(
+            request,
+            lambda: cassette.history_payload(
+                limit,
+                after=request.query.get("after"),
+                before=request.query.get("before"),
+                unique=unique,
+                query=query,
+                counts=counts,
+            ),
+        )
+    except ValueError as e:
+        return web.json_response({"error": str(e)}, status=400)
+    return web.json_response(payload)
+
+
+async def replay(request):
+    data = await request.json()
+    try:
+        differ = cassette.differ_for(data.get("ignore"))
+    except (TypeError, ValueError) as e:
+        return web.json_response({"error": str(e)}, status=400)
+    entry = await on_recorder(request, cassette.history_manager.get, data.get("id"))
+    if entry is None:
+        return web.json_response({"error": "Invalid request index"}, status=400)
+    async with request.app[SESSION].request(
+        entry.method, cassette.upstream_url_for(entry.path, entry.query), headers=entry.headers, data=entry.data
+    ) as resp:
+        content = await resp.read()
+    replayed_entry = HistoryEntry(
+        id=str(uuid.uuid4()),
+        method=entry.method,
+        path=str(resp.url),
+        status_code=resp.status,
+        headers=entry.headers,
+        data=entry.data,
+        response_headers=dict(resp.headers),
+        response_body=decode_body(content),
+        timestamp=datetime.utcnow(),
+    )
+    response_headers = client_headers(resp.headers)
+    response_headers.pop("Content-Type", None)
+    payload = replayed_entry.to_dict()
+    payload["diff"] = differ.diff(entry, replayed_entry)
+    return web.json_response(payload, status=resp.status, headers=response_headers)
+
+
+def run(upstream_url, host="0.0.0.0", port=54321, **options):
+    web.run_app(create_app(upstream_url, **options), host=host, port=port)
@@ -0,0 +1,293 @@
+"""Benchmarks for the proxy, the recorder and the history endpoints.
+
+Everything runs in-process against a local stand-in upstream and temporary
+tapes, so results only depend on the machine and the code. ``run`` returns
+a JSON-serializable report that can be saved as a baseline and checked
+against later runs with ``compare``.
+"""
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import gc
+import json
+import os
+import platform
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+import cassette
+from diff import ResponseDiffer
+from history import HistoryEntry, HistoryManager
+from playback import PlaybackIndex
+from replay import BatchReplay, latency_stats, load_report
+from upstream import UpstreamPool
+
+UPSTREAM_BODY = json.dumps({"id": 42, "status": "ok", "items": list(range(20))}).encode("utf-8")
+
+# Synthetic traffic to benchmark with. "basic" is what every baseline has
+# been recorded with, so it must not change; "request-ids" adds a unique
+# X-Request-Id and a Date header to every exchange, as gateways do. Reports
+# of different workloads can't be compared.
+WORKLOADS = ("basic", "request-ids")
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    disable_nagle_algorithm = True
+
+    def log_request(self, *args):
+        pass
+
+
+class StubUpstream:
+    """A local HTTP server answering every request with the same small JSON body."""
+
+    def __init__(self, body=UPSTREAM_BODY):
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def respond(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                if length:
+                    self.rfile.read(length)
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = respond
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}/"
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def synthetic_entries(count, start=0, distinct=500, workload="basic"):
+    """Entries spread over a few endpoints; only ``distinct`` exchanges differ, as on a real tape."""
+    if workload not in WORKLOADS:
+        raise ValueError(f"Unknown workload: {workload!r}")
+    timestamp = datetime(2024, 1, 1)
+    for i in range(start, start + count):
+        key = i % distinct
+        headers = {"Accept": "application/json", "User-Agent": "bench"}
+        response_headers = {"Content-Type": "application/json", "Content-Length": str(len(UPSTREAM_BODY))}
+        if workload == "request-ids":
+            headers["X-Request-Id"] = str(uuid.UUID(int=i))
+            response_headers["Date"] = (timestamp + timedelta(seconds=i // 100)).strftime("%a, %d %b %Y %H:%M:%S GMT")
+        yield HistoryEntry(
+            id=str(uuid.UUID(int=i)),
+            method="POST" if key % 5 == 0 else "GET",
+            path=f"orders/{key}" if key % 2 else f"users/{key}/profile",
+            status_code=500 if key % 50 == 0 else 200,
+            headers=headers,
+            data='{"quantity": 1}' if key % 5 == 0 else "",
+            response_headers=response_headers,
+            response_body=UPSTREAM_BODY.decode("utf-8"),
+            timestamp=timestamp + timedelta(milliseconds=10 * i),
+            query=f"page={key % 3}",
+        )
+
+
+def measure(func, repeat):
+    """Call ``func`` ``repeat`` times and return per-call latency statistics in milliseconds."""
+    latencies = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        latencies.append(round((time.perf_counter() - started) * 1000, 4))
+    stats = latency_stats(latencies)
+    return {"runs": repeat, "ops_per_s": round(repeat / (sum(latencies) / 1000), 1), "latency_ms": stats}
+
+
+def filled_tape(directory, storage, size, workload="basic"):
+    """A closed tape of ``size`` synthetic entries; returns the path."""
+    tape = os.path.join(directory, f"tape-{size}")
+    manager = HistoryManager(cassette.make_storage(storage, tape))
+    entries = synthetic_entries(size, workload=workload)
+    while True:
+        batch = [entry for _, entry in zip(range(10000), entries)]
+        if not batch:
+            break
+        manager.extend(batch)
+    manager.close()
+    return tape
+
+
+def bench_tape(storage, size, repeat=50, workload="basic"):
+    """Recorder and history benchmarks against a tape of ``size`` entries."""
+    results = {}
+    rng = random.Random(size)
+    with tempfile.TemporaryDirectory() as directory:
+        tape = filled_tape(directory, storage, size, workload)
+        results["load"] = measure(lambda: HistoryManager(cassette.make_storage(storage, tape)).close(), 3)
+
+        manager = HistoryManager(cassette.make_storage(storage, tape))
+        appended = synthetic_entries(repeat * 4, start=size, workload=workload)
+        results["append"] = measure(lambda: manager.append(next(appended)), repeat * 4)
+
+        previous, cassette.history_manager = cassette.history_manager, manager
+        try:
+            cassette.history_payload(100, unique=True)  # build the indexes outside the timings
+            cursor = cassette.encode_cursor(manager.oldest_seq() + size // 2)
+            results["history_page"] = measure(lambda: cassette.history_payload(100, after=cursor), repeat)
+            results["history_unique"] = measure(lambda: cassette.history_payload(100, unique=True), repeat)
+        finally:
+            cassette.history_manager = previous
+
+        ids = [str(uuid.UUID(int=rng.randrange(size))) for _ in range(repeat)]
+        lookups = iter(ids)
+        results["replay_lookup"] = measure(lambda: manager.get(next(lookups)), repeat)
+
+        index = PlaybackIndex()
+        index.build(manager.items())
+        probes = synthetic_entries(repeat, start=rng.randrange(size), workload=workload)
+
+        def lookup():
+            entry = next(probes)
+            index.lookup(entry.method, entry.path, entry.query, entry.data)
+
+        results["playback_lookup"] = measure(lookup, repeat)
+        manager.close()
+    return results
+
+
+def bench_memory(storage, size, workload="basic", **options):
+    """Memory a HistoryManager holds per entry after loading a tape of ``size`` entries.
+
+    ``options`` are passed to the HistoryManager, e.g. ``compress_bodies``.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        tape = filled_tape(directory, storage, size, workload)
+        gc.collect()
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            manager = HistoryManager(cassette.make_storage(storage, tape), **options)
+            gc.collect()
+            held = tracemalloc.get_traced_memory()[0] - before
+        finally:
+            tracemalloc.stop()
+        manager.close()
+    return {"runs": 1, "bytes_per_entry": round(held / size)}
+
+
+def bench_diff(count=1000):
+    """Diffing replayed responses against their recordings, half of them with a changed JSON body."""
+    recorded = list(synthetic_entries(count))
+    replayed = []
+    for i, entry in enumerate(recorded):
+        copy = HistoryEntry.from_dict(entry.to_dict())
+        if i % 2:
+            body = json.loads(UPSTREAM_BODY)
+            body["items"][i % 20] = -1
+            copy.response_body = json.dumps(body)
+        replayed.append(copy)
+    differ = ResponseDiffer(ignore_headers=["X-Request-Id"], ignore_values=["timestamps"])
+    pairs = iter(list(zip(recorded, replayed)))
+    return measure(lambda: differ.diff(*next(pairs)), count)
+
+
+def bench_proxy(storage, requests=500, concurrency=8):
+    """Throughput and latency of requests proxied through the Flask app to a local upstream."""
+    with StubUpstream() as stub, tempfile.TemporaryDirectory() as directory:
+        saved = (cassette.history_manager, cassette.upstream, dict(cassette.app.config))
+        cassette.configure(stub.url, storage=storage, tape=os.path.join(directory, "tape"), pool_size=concurrency)
+        server = make_server("127.0.0.1", 0, cassette.app, threaded=True, request_handler=QuietRequestHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        client = UpstreamPool(pool_size=concurrency)
+        base = f"http://127.0.0.1:{server.server_port}/"
+        try:
+            entries = list(synthetic_entries(requests))
+            replayer = BatchReplay(
+                lambda entry: client.request(entry.method, f"{base}{entry.path}", data=entry.data),
+                concurrency=concurrency,
+                compare=False,
+            )
+            started = time.monotonic()
+            results = replayer.run(entries)
+            report = load_report(results, time.monotonic() - started)
+        finally:
+            server.shutdown()
+            client.close()
+            cassette.history_manager.close()
+            cassette.upstream.close()
+            cassette.history_manager, cassette.upstream = saved[0], saved[1]
+            cassette.app.config.clear()
+            cassette.app.config.update(saved[2])
+    return {
+        "runs": report["requests"],
+        "ops_per_s": report["throughput_rps"],
+        "errors": report["errors"],
+        "latency_ms": report["latency_ms"],
+    }
+
+
+def run(sizes=(1000, 10000), storage="journal", requests=500, concurrency=8, repeat=50, workload="basic"):
+    """Run every benchmark and return the report, keyed ``<benchmark>@<tape size>``."""
+    results = {}
+    for size in sizes:
+        for name, result in bench_tape(storage, size, repeat, workload).items():
+            results[f"{name}@{size}"] = result
+        results[f"memory@{size}"] = bench_memory(storage, size, workload)
+    results["replay_diff"] = bench_diff()
+    if requests:
+        results["proxy"] = bench_proxy(storage, requests, concurrency)
+    return {
+        "meta": {
+            "created": datetime.utcnow().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "storage": storage,
+            "sizes": list(sizes),
+            "workload": workload,
+        },
+        "results": results,
+    }
+
+
+def headline(result):
+    """The figure a benchmark is compared on: median latency in ms, or bytes per entry."""
+    if "bytes_per_entry" in result:
+        return result["bytes_per_entry"]
+    return result["latency_ms"]["p50"] if result.get("latency_ms") else None
+
+
+def compare(report, baseline, tolerance=0.2):
+    """Benchmarks whose headline figure grew by more than ``tolerance`` since ``baseline``.
+
+    Returns ``[{"name", "baseline", "current", "change"}, ...]``; benchmarks
+    missing from either report are ignored. Raises ValueError if the reports
+    were run on different workloads (reports without one predate the option
+    and ran "basic").
+    """
+    workloads = [r.get("meta", {}).get("workload", "basic") for r in (report, baseline)]
+    if workloads[0] != workloads[1]:
+        raise ValueError(f"Can't compare a {workloads[0]!r} workload with a {workloads[1]!r} baseline")
+    regressions = []
+    for name, result in report["results"].items():
+        previous = baseline.get("results", {}).get(name)
+        before, after = headline(previous or {}), headline(result)
+        if before is None or after is None:
+            continue
+        if before > 0 and after > before * (1 + tolerance):
+            regressions.append({"name": name, "baseline": before, "current": after, "change": round(after / before - 1, 3)})
+    return regressions
@@ -0,0 +1,96 @@
+from collections import OrderedDict
+import hashlib
+import os
+import tempfile
+import threading
+
+
+def digest(body):
+    """Content address of a body, given as a string or bytes."""
+    return hashlib.sha256(body.encode("utf-8") if isinstance(body, str) else body).hexdigest()
+
+
+class BlobStore:
+    """Content-addressed storage for request and response bodies.
+
+    Each distinct body is written once to ``<directory>/<aa>/<digest>``, so a
+    tape only needs to hold the digest. Recently used bodies are kept in a
+    bounded cache, and ``put`` hands back the cached object for a body it has
+    already seen so identical bodies share one object in memory. Bodies
+    shorter than ``min_size`` characters (or bytes) are cheaper to keep inline.
+    Bodies are stored as raw bytes, so binary ones round-trip exactly.
+    Entries read their bodies back lazily from any thread, so the cache is
+    guarded by a lock; several processes may share the directory.
+    """
+
+    def __init__(self, directory="blobs", cache_size=4096, min_size=64):
+        self.directory = directory
+        self.cache_size = cache_size
+        self.min_size = min_size
+        self._cache = OrderedDict()
+        self._on_disk = set()
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def put(self, body):
+        """Store ``body`` (str or bytes) and return ``(digest, canonical_body)``."""
+        key = digest(body)
+        binary = isinstance(body, bytes)
+        with self._lock:
+            cached = self._cache.get((key, binary))
+            if cached is not None:
+                self._cache.move_to_end((key, binary))
+                return key, cached
+        if key not in self._on_disk:
+            path = self._path(key)
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # A temporary file of its own, since other processes may be storing the same body.
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f"{key}.", suffix=".tmp")
+                try:
+                    with os.fdopen(fd, "wb") as file:
+                        file.write(body if binary else body.encode("utf-8"))
+                    os.replace(tmp_path, path)  # identical content if another process got there first
+                except BaseException:
+                    try:
+                        os.remove(tmp_path)
+                    except FileNotFoundError:
+                        pass
+                    raise
+            self._on_disk.add(key)
+        self._remember((key, binary), body)
+        return key, body
+
+    def get(self, key, binary=False):
+        """Return the body stored under ``key``, as bytes if ``binary`` else as a string."""
+        with self._lock:
+            body = self._cache.get((key, binary))
+            if body is not None:
+                self._cache.move_to_end((key, binary))
+                return body
+        with open(self._path(key), "rb") as file:
+            body = file.read()
+        if not binary:
+            body = body.decode("utf-8")
+        self._on_disk.add(key)
+        self._remember((key, binary), body)
+        return body
+
+    def delete(self, key):
+        """Remove a stored body, e.g. once no tape entry refers to it any more."""
+        with self._lock:
+            for binary in (False, True):
+                self._cache.pop((key, binary), None)
+        self._on_disk.discard(key)
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _remember(self, key, body):
+        with self._lock:
+            self._cache[key] = body
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
@@ -0,0 +1,198 @@
+from collections import OrderedDict
+import threading
+import time
+
+from playback import MatchRules
+
+# Methods whose responses may be served from the cache.
+CACHEABLE_METHODS = {"GET", "HEAD"}
+
+# Methods that don't change state on the origin; a successful response to
+# any other invalidates what is cached for its path (RFC 9111, section 4.4).
+SAFE_METHODS = {"GET", "HEAD", "OPTIONS", "TRACE"}
+
+# Statuses cacheable by default (RFC 9110, section 15.1).
+CACHEABLE_STATUSES = {200, 203, 204, 300, 301, 308, 404, 405, 410, 414, 501}
+
+
+def parse_cache_control(value):
+    """``{"max-age": "60", "no-store": True}`` for ``max-age=60, no-store``."""
+    directives = {}
+    for part in (value or "").split(","):
+        name, sep, argument = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = argument.strip('"') if sep else True
+    return directives
+
+
+def header(headers, name):
+    """Look up a header case-insensitively in a plain dict."""
+    for key, value in headers.items():
+        if key.lower() == name:
+            return value
+    return None
+
+
+class ResponseCache:
+    """Recent responses to GET and HEAD requests, served instead of asking the upstream.
+
+    Responses are added from recorded entries (register ``add`` with
+    ``HistoryManager.add_listener``) and looked up by method, path,
+    normalized query string and the values of ``key_headers``. A response is
+    kept for its ``s-maxage`` or ``max-age``, or ``ttl`` seconds without one,
+    less its ``Age``; ``no-store``, ``no-cache``, ``private``, ``Set-Cookie``
+    and a ``Vary`` on headers outside ``key_headers`` keep it out of the
+    cache, as does ``Authorization`` on the request unless the response is
+    marked ``public`` or carries ``s-maxage``. A successful POST, PUT, PATCH
+    or DELETE drops every cached response for its path. Beyond ``max_entries`` entries or ``max_bytes`` of bodies the
+    least recently used responses are evicted.
+    """
+
+    def __init__(self, ttl=60.0, max_entries=1000, max_bytes=64 * 1024 * 1024, key_headers=(), clock=time.monotonic):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.key_headers = tuple(name.lower() for name in key_headers)
+        self.clock = clock
+        self._rules = MatchRules()
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (entry, stored at, expires at, size)
+        self._paths = {}  # path -> keys of its cached responses
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def key(self, method, path, query, headers):
+        values = tuple(header(headers, name) for name in self.key_headers)
+        return self._rules.key(method, path, query, None) + values
+
+    def lifetime(self, entry):
+        """Seconds the recorded response may be served for, or None if it must not be cached."""
+        if entry.method.upper() not in CACHEABLE_METHODS or entry.status_code not in CACHEABLE_STATUSES:
+            return None
+        if entry.response_size is not None:  # only part of the body was recorded
+            return None
+        request_directives = parse_cache_control(header(entry.headers, "cache-control"))
+        directives = parse_cache_control(header(entry.response_headers, "cache-control"))
+        if "no-store" in request_directives or {"no-store", "no-cache", "private"} & directives.keys():
+            return None
+        if header(entry.response_headers, "set-cookie") is not None:
+            return None
+        if header(entry.headers, "authorization") is not None and not {"public", "s-maxage"} & directives.keys():
+            return None
+        vary = header(entry.response_headers, "vary")
+        if vary and any(name.strip().lower() not in self.key_headers for name in vary.split(",")):
+            return None
+        lifetime = self.ttl
+        for directive in ("s-maxage", "max-age"):
+            if directive in directives:
+                try:
+                    lifetime = int(directives[directive])
+                except (TypeError, ValueError):
+                    return None
+                break
+        try:
+            lifetime -= int(header(entry.response_headers, "age") or 0)
+        except ValueError:
+            pass
+        return lifetime if lifetime > 0 else None
+
+    def add(self, seq, entry):
+        """Cache the response of a recorded entry, if it may be cached.
+
+        A successful response to an unsafe method invalidates the responses
+        cached for its path instead.
+        """
+        if entry.served_from_cache:
+            return
+        if entry.method.upper() not in SAFE_METHODS:
+            if entry.status_code < 400:
+                self.invalidate(entry.path)
+            return
+        lifetime = self.lifetime(entry)
+        if lifetime is None:
+            return
+        size = len(entry.response_body or "")
+        if size > self.max_bytes:
+            return
+        key = self.key(entry.method, entry.path, entry.query, entry.headers)
+        now = self.clock()
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (entry, now, now + lifetime, size)
+            self._paths.setdefault(key[1], set()).add(key)
+            self._bytes += size
+            self.stores += 1
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, path):
+        """Drop every cached response for ``path``, whatever its query or key headers."""
+        with self._lock:
+            for key in self._paths.pop(path.lstrip("/"), ()):
+                self._bytes -= self._entries.pop(key)[3]
+                self.invalidations += 1
+
+    def _remove(self, key):
+        cached = self._entries.pop(key, None)
+        if cached is None:
+            return
+        self._bytes -= cached[3]
+        keys = self._paths[key[1]]
+        keys.discard(key)
+        if not keys:
+            del self._paths[key[1]]
+
+    def lookup(self, method, path, query, headers):
+        """Return ``(entry, age in seconds)`` for a fresh cached response, or None.
+
+        A request with ``Cache-Control: no-cache`` or ``no-store`` always
+        misses, and one with ``max-age`` misses responses older than that.
+        """
+        directives = parse_cache_control(header(headers, "cache-control"))
+        try:
+            max_age = int(directives["max-age"]) if "max-age" in directives else None
+        except (TypeError, ValueError):
+            max_age = 0
+        bypass = method.upper() not in CACHEABLE_METHODS or {"no-cache", "no-store"} & directives.keys()
+        key = None if bypass else self.key(method, path, query, headers)
+        now = self.clock()
+        with self._lock:
+            cached = self._entries.get(key) if key is not None else None
+            if cached is not None and now >= cached[2]:
+                self._remove(key)
+                self.expirations += 1
+                cached = None
+            if cached is None or (max_age is not None and now - cached[1] > max_age):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return cached[0], now - cached[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._paths.clear()
+            self._bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
@@ -1,19 +1,48 @@
-from flask import Flask, request, jsonify, Response, got_request_exception
+from flask import Flask, request, jsonify, Response, g, got_request_exception
 import traceback
 import logging
-import requests
 import json
+import time
+import uuid
+from datetime import datetime
 from urllib.parse import urljoin
 
 from history import HistoryEntry, HistoryManager  # Correct the import statement
 
-from history import HistoryManager
+from history import HistoryManager, decode_body
+from recorder import BackgroundRecorder, BodyRecorder
+from storage import JsonStorage, JournalStorage, PackedStorage, SegmentedStorage, SqliteStorage
+from upstream import UpstreamPool
+from playback import MatchRules, PlaybackIndex
+from replay import BatchReplay, summarize
+from search import HistoryQuery
+from blobs import BlobStore
+from metrics import Metrics, route_template
+from tail import TailHub
+from cache import ResponseCache, header
+from diff import ResponseDiffer
 
 
 logging.basicConfig(level=logging.ERROR)
 
 app = Flask(__name__)
 history_manager = HistoryManager()
+upstream = UpstreamPool()
+playback_index = None
+background_recorder = None
+metrics = Metrics()
+tail_hub = TailHub()
+response_cache = None
+response_differ = ResponseDiffer()
+tape_sync = None
+
+
+def record_entry(entry):
+    """Record an exchange, through the background recorder when one is running."""
+    if background_recorder is not None:
+        background_recorder.submit(entry)
+    else:
+        history_manager.append(entry)
 
 # Add a global error handler for unhandled exceptions
 @app.errorhandler(Exception)
@@ -32,18 +61,111 @@ def handle_exception(e):
 
 
 
+def elapsed_ms(since):
+    return round((time.perf_counter() - since) * 1000, 3)
+
+
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+
+
+@app.before_request
+def refresh_tape():
+    """Pick up what other workers have recorded before answering from a shared tape."""
+    if app.config.get("SHARED_TAPE") and (request.path.startswith("/__/") or app.config.get("PLAYBACK")):
+        history_manager.refresh()
+
+
+@app.after_request
+def observe_timings(response):
+    """Hand a proxied request's phase timings to /__/metrics once the response has been sent."""
+    timings = g.get("timings")
+    if timings is None:
+        return response
+    started, returned = g.started, time.perf_counter()
+    method, route, status = request.method, route_template(request.path), response.status_code
+
+    def observe():
+        timings.setdefault("respond", elapsed_ms(returned))
+        timings["total"] = elapsed_ms(started)
+        metrics.observe(method, route, status, timings)
+
+    response.call_on_close(observe)
+    return response
+
+
+EXPORT_FORMATS = {"ndjson": "application/x-ndjson", "json": "application/json"}
+
+# Headers describing how a body was framed on the wire. Streamed and played
+# back responses are re-framed (and decompressed) on their way to the client.
+FRAMING_HEADERS = {"content-encoding", "content-length", "transfer-encoding", "connection"}
+
+
 @app.route("/<path:path>", methods=["GET", "POST", "PUT", "PATCH", "DELETE"])
 def proxy(path):
+    request.get_data()  # read the body up front so receiving it is timed on its own
+    g.timings = {"receive": elapsed_ms(g.started)}
+    if app.config.get("PLAYBACK"):
+        return playback(path)
+    if response_cache is not None:
+        cached = serve_from_cache(path)
+        if cached is not None:
+            return cached
+    return forward_upstream(path)
+
+
+def serve_from_cache(path):
+    """Answer with a fresh cached response, recording the exchange as served from the cache."""
+    query = request.query_string.decode("utf-8")
+    hit = response_cache.lookup(request.method, path, query, request.headers)
+    if hit is None:
+        return None
+    cached, age = hit
+    try:
+        age += int(header(cached.response_headers, "age") or 0)
+    except ValueError:
+        pass
+    response_headers = {
+        k: v for k, v in cached.response_headers.items() if k.lower() not in FRAMING_HEADERS | {"age"}
+    }
+    response_headers["Age"] = str(int(age))
+    response_headers["X-Tapedeck-Cache"] = "HIT"
+    record_entry(
+        HistoryEntry(
+            id=str(uuid.uuid4()),
+            method=request.method,
+            path=path,
+            status_code=cached.status_code,
+            headers={k: v for k, v in request.headers.items() if k != "Host"},
+            data=decode_body(request.data),
+            response_headers=dict(cached.response_headers, **{"X-Tapedeck-Cache": "HIT"}),
+            response_body=cached.response_body,
+            timestamp=datetime.utcnow(),
+            query=query,
+            timings=dict(g.timings),
+            served_from_cache=True,
+        )
+    )
+    return cached.response_body, cached.status_code, response_headers
+
+
+def forward_upstream(path, record=True):
     full_url = urljoin(app.config["UPSTREAM_URL"], path)
     headers = {k: v for k, v in request.headers.items() if k != "Host"}
-    resp = requests.request(
+    stream = app.config.get("STREAM_PROXY", False)
+    resp = upstream.request(
         method=request.method,
         url=full_url,
         headers=headers,
         json=request.get_json(silent=True),
         data=request.data,
         params=request.args,  # Forward the query parameters
+        stream=stream,
     )
+    g.timings.update(resp.upstream_timings)
+    if stream:
+        return stream_proxy_response(path, headers, resp, record)
 
     response_headers = {k: v for k, v in resp.headers.items()}
     from history import HistoryEntry  # Ensure this import is at the top of the file
@@ -51,108 +173,762 @@ def proxy(path):
     from datetime import datetime  # Ensure this import is at the top of the file
 
     history_entry = HistoryEntry(
+        id=str(uuid.uuid4()),
         method=request.method,
         path=path,
         status_code=resp.status_code,
         headers=headers,
-        data=request.data.decode("utf-8"),
+        data=decode_body(request.data),
         response_headers=response_headers,
-        response_body=resp.text,
+        response_body=decode_body(resp.content),
         timestamp=datetime.utcnow(),  # Add the current UTC timestamp
+        query=request.query_string.decode("utf-8"),
+        timings=dict(g.timings),
     )
-    history_manager.append(history_entry)  # Use the history_manager instance to append the entry
+    if record:
+        started = time.perf_counter()
+        record_entry(history_entry)  # Use the history_manager instance to append the entry
+        g.timings["record"] = elapsed_ms(started)
     # Removed the call to save_history_to_file() as it's handled by the HistoryManager's append method
     # Ensure the response has the correct content type for JSON responses
     response_headers = dict(resp.headers)
     return (resp.content, resp.status_code, response_headers)
 
 
+def stream_proxy_response(path, headers, resp, record=True):
+    """Send the upstream body to the client chunk by chunk, recording it as it passes."""
+    method = request.method
+    query = request.query_string.decode("utf-8")
+    data = decode_body(request.data)
+    timestamp = datetime.utcnow()
+    timings = g.timings
+    recorder = BodyRecorder(
+        limit=app.config.get("RECORD_BODY_LIMIT"),
+        overflow=app.config.get("RECORD_OVERFLOW", "truncate"),
+        spill_dir=app.config.get("SPILL_DIR"),
+    )
+
+    def generate():
+        started = time.perf_counter()
+        completed = False
+        try:
+            for chunk in resp.iter_content(chunk_size=app.config.get("STREAM_CHUNK_SIZE", 64 * 1024)):
+                recorder.write(chunk)
+                yield chunk
+            completed = True
+        finally:
+            resp.close()
+            recorder.close()
+            timings["respond"] = elapsed_ms(started)
+            if record:
+                partial = recorder.truncated or recorder.spill_path is not None
+                size = recorder.size
+                spill_path = recorder.spill_path
+                if not completed:
+                    # The client went away or the upstream failed mid-stream: keep what
+                    # arrived, marked as partial so the cache and playback never serve it.
+                    partial = True
+                    try:
+                        size = max(size, int(resp.headers.get("Content-Length", "")))
+                    except ValueError:
+                        pass
+                    if spill_path is not None:
+                        os.remove(spill_path)
+                        spill_path = None
+                record_entry(
+                    HistoryEntry(
+                        id=str(uuid.uuid4()),
+                        method=method,
+                        path=path,
+                        status_code=resp.status_code,
+                        headers=headers,
+                        data=data,
+                        response_headers=dict(resp.headers),
+                        response_body=recorder.body(),
+                        timestamp=timestamp,
+                        response_size=size if partial else None,
+                        response_body_path=spill_path,
+                        query=query,
+                        timings=dict(timings),
+                    )
+                )
+                timings["record"] = elapsed_ms(started) - timings["respond"]
+
+    response_headers = {
+        k: v for k, v in resp.headers.items() if k.lower() not in FRAMING_HEADERS
+    }
+    return Response(generate(), status=resp.status_code, headers=response_headers)
+
+
+def playback(path):
+    """Answer from the tape without contacting the upstream, if a recording matches."""
+    entry = None
+    if playback_index is not None:
+        seq = playback_index.lookup(
+            request.method, path, request.query_string.decode("utf-8"), decode_body(request.data)
+        )
+        if seq is not None:
+            try:
+                entry = history_manager.at(seq)
+            except IndexError:  # evicted from the tape since it was indexed
+                pass
+    if entry is None:
+        policy = app.config.get("PLAYBACK_MISS", "404")
+        if policy == "404":
+            return jsonify({"error": f"No recording matches {request.method} /{path}"}), 404, {"X-Proxy-Origin": "proxy"}
+        return forward_upstream(path, record=policy == "record")
+
+    response_headers = {
+        k: v for k, v in entry.response_headers.items() if k.lower() not in FRAMING_HEADERS
+    }
+    response_headers["X-Tapedeck-Playback"] = entry.id or ""
+    if entry.response_body_path is not None:
+        return Response(read_spilled_body(entry.response_body_path), status=entry.status_code, headers=response_headers)
+    return entry.response_body, entry.status_code, response_headers
+
+
+def read_spilled_body(body_path, chunk_size=64 * 1024):
+    with open(body_path, "rb") as file:
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
 import base64
 
 
+def encode_cursor(seq):
+    return base64.urlsafe_b64encode(str(seq).encode("utf-8")).decode("utf-8")
+
+
+def decode_cursor(cursor):
+    try:
+        return int(base64.urlsafe_b64decode(cursor).decode("utf-8"))
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+
+
 @app.route("/__/history", methods=["GET"])
 def history():
     before = request.args.get("before")
     after = request.args.get("after")
     limit = request.args.get("limit", default=10, type=int)
     unique = request.args.get("unique", default="false").lower() == "true"
+    counts = request.args.get("counts", default="false").lower() == "true"
+
+    try:
+        query = HistoryQuery.from_args(request.args.to_dict(flat=False))
+        return jsonify(
+            history_payload(limit, after=after, before=before, unique=unique, query=query, counts=counts)
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+
+def history_payload(limit, after=None, before=None, unique=False, query=None, counts=False):
+    """Build the /__/history response from the raw query parameters.
+
+    With a HistoryQuery only matching entries of the live tape are returned,
+    and the cursors skip straight to the next or previous match. ``unique``
+    keeps the first occurrence of every distinct exchange on the live tape;
+    ``counts`` adds how often each returned exchange occurs.
+    Raises ValueError for a malformed cursor.
+    """
+    after = decode_cursor(after) if after else None
+    before = decode_cursor(before) if before else None
+
+    def fetch(n, **cursor):
+        return find_entries(n, unique=unique, query=query, **cursor)
+
+    page = fetch(limit, after=after, before=before)
 
-    if before:
-        before_index = int(base64.urlsafe_b64decode(before).decode("utf-8"))
-        start = max(before_index - limit, 0)
-    elif after:
-        after_index = int(base64.urlsafe_b64decode(after).decode("utf-8"))
-        start = after_index + 1
+    next_cursor = None
+    prev_cursor = None
+    if page:
+        first_seq, last_seq = page[0][0], page[-1][0]
+        if query is None and not unique:
+            has_next = last_seq < history_manager.last_seq()
+            has_prev = first_seq > history_manager.oldest_seq()
+        else:
+            has_next = bool(fetch(1, after=last_seq))
+            has_prev = bool(fetch(1, before=first_seq))
+        if has_next:
+            next_cursor = encode_cursor(last_seq)
+        if has_prev:
+            prev_cursor = encode_cursor(first_seq)
+
+    entries = []
+    for seq, entry in page:
+        entry_dict = entry.to_dict()
+        if counts:
+            entry_dict["occurrences"] = history_manager.occurrences(entry)
+        entries.append(entry_dict)
+    return {
+        "history": entries,
+        "next": next_cursor,
+        "previous": prev_cursor,
+        "limit": limit,
+    }
+
+
+def find_entries(limit, after=None, before=None, unique=False, query=None):
+    """A page of (seq, entry) pairs from the whole tape, or only those matching a HistoryQuery."""
+    if query is None:
+        return history_manager.page(limit, after=after, before=before, unique=unique)
+    return history_manager.search(query, limit, after=after, before=before, unique=unique)
+
+
+@app.route("/__/history/export", methods=["GET"])
+def export_history():
+    """Stream the tape, or the entries matching the history filters, as NDJSON or JSON.
+
+    ``format=ndjson`` (the default) writes one entry per line; ``format=json``
+    writes ``{"history": [...]}``. Entries are read and serialized a batch at
+    a time while the response is being sent, so memory use doesn't grow with
+    the tape. The export stops at the newest entry as of the request, and the
+    ``X-Tapedeck-Cursor`` header is the ``after`` cursor that exports only
+    what is recorded from then on.
+    """
+    export_format = request.args.get("format", "ndjson")
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({"error": f"Unknown format: {export_format!r}"}), 400
+    unique = request.args.get("unique", default="false").lower() == "true"
+    counts = request.args.get("counts", default="false").lower() == "true"
+    try:
+        query = HistoryQuery.from_args(request.args.to_dict(flat=False))
+        after = decode_cursor(request.args["after"]) if request.args.get("after") else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    last_seq = history_manager.last_seq()
+    entries = export_entries(last_seq, after=after, unique=unique, query=query, counts=counts)
+    if export_format == "ndjson":
+        body = (json.dumps(entry) + "\n" for entry in entries)
     else:
-        start = 0
+        body = json_array("history", entries)
+    cursor = encode_cursor(last_seq if after is None else max(after, last_seq))
+    return Response(body, mimetype=EXPORT_FORMATS[export_format], headers={"X-Tapedeck-Cursor": cursor})
 
-    end = start + limit
-    paginated_history = history_manager.get_history()[start:end]
 
-    next_cursor = (
-        base64.urlsafe_b64encode(str(end).encode("utf-8")).decode("utf-8")
-        if end < len(history_manager.get_history())
-        else None
-    )
-    prev_cursor = (
-        base64.urlsafe_b64encode(str(start).encode("utf-8")).decode("utf-8")
-        if start > 0 and start < len(history_manager.get_history())
-        else None
-    )
+def iter_entries(last_seq, after=None, unique=False, query=None):
+    """Yield the (seq, entry) pairs after ``after`` up to ``last_seq``, fetching a batch at a time."""
+    batch_size = app.config.get("EXPORT_BATCH_SIZE", 500)
+    while True:
+        page = find_entries(batch_size, after=after, unique=unique, query=query)
+        for seq, entry in page:
+            if seq > last_seq:
+                return
+            yield seq, entry
+        if len(page) < batch_size:
+            return
+        after = page[-1][0]
 
-    def unique_entries(entries):
-        seen = set()
-        unique_list = []
-        for entry in entries:
-            entry_signature = (entry.method, entry.path, entry.status_code, json.dumps(entry.headers, sort_keys=True), entry.data, json.dumps(entry.response_headers, sort_keys=True), entry.response_body)
-            if entry_signature not in seen:
-                seen.add(entry_signature)
-                unique_list.append(entry)
-        return unique_list
-
-    if unique:
-        paginated_history = unique_entries(paginated_history)
-
-    return jsonify(
-        {
-            "history": [entry.to_dict() for entry in paginated_history],
-            "next": next_cursor,
-            "previous": prev_cursor,
-            "limit": limit,
-        }
-    )
+
+def export_entries(last_seq, after=None, unique=False, query=None, counts=False):
+    """Yield the dicts of the entries after ``after`` up to ``last_seq``."""
+    for _, entry in iter_entries(last_seq, after=after, unique=unique, query=query):
+        entry_dict = entry.to_dict()
+        if counts:
+            entry_dict["occurrences"] = history_manager.occurrences(entry)
+        yield entry_dict
+
+
+@app.route("/__/history/tail", methods=["GET"])
+def tail_history():
+    """Push entries to the client as server-sent events as they are recorded.
+
+    Each ``entry`` event carries one entry as JSON, with its cursor as the
+    event id, and only entries matching the history filters are sent. With
+    ``after`` (or the ``Last-Event-ID`` header an EventSource sends when it
+    reconnects) the entries recorded since that cursor are sent first;
+    otherwise the tail starts at the next recorded entry. A comment is sent
+    every TAIL_HEARTBEAT seconds while nothing is recorded. A client too slow
+    to keep up catches up from the tape instead of missing entries.
+    """
+    try:
+        query = HistoryQuery.from_args(request.args.to_dict(flat=False))
+        cursor = request.args.get("after") or request.headers.get("Last-Event-ID")
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    heartbeat = app.config.get("TAIL_HEARTBEAT", 15.0)
+    subscription = tail_hub.subscribe()  # before reading the tape, so nothing recorded meanwhile is missed
+    seen = history_manager.last_seq() if after is None else after
+
+    def events():
+        nonlocal seen
+        catch_up = after is not None
+        try:
+            yield ": tailing\n\n"
+            while True:
+                if catch_up:
+                    last_seq = history_manager.last_seq()
+                    for seq, entry in iter_entries(last_seq, after=seen, query=query):
+                        yield sse_event(seq, entry)
+                    seen = max(seen, last_seq)
+                batch = subscription.wait(heartbeat)
+                catch_up = batch is None
+                if not batch:
+                    if not catch_up:
+                        yield ": keep-alive\n\n"
+                    continue
+                for seq, entry in batch:
+                    if seq <= seen:
+                        continue
+                    seen = seq
+                    if query is None or query.matches(entry):
+                        yield sse_event(seq, entry)
+        finally:
+            subscription.close()
+
+    response = Response(events(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+    response.call_on_close(subscription.close)  # also when the stream never started
+    return response
+
+
+def sse_event(seq, entry):
+    return f"id: {encode_cursor(seq)}\nevent: entry\ndata: {json.dumps(entry.to_dict())}\n\n"
+
+
+def json_array(key, items):
+    """Serialize ``{key: [items...]}`` piece by piece."""
+    yield f"{{{json.dumps(key)}: ["
+    for position, item in enumerate(items):
+        yield ("," if position else "") + json.dumps(item)
+    yield "]}"
+
+
+def upstream_url_for(path, query="", base=None):
+    """The upstream URL for a proxied path and raw query string."""
+    url = urljoin(base or app.config["UPSTREAM_URL"], path)
+    return f"{url}?{query}" if query else url
 
 
 @app.route("/__/replay", methods=["POST"])
 def replay():
+    """Replay a recorded request; the replayed entry's ``diff`` compares it with the recording.
+
+    ``ignore`` adds diff ignore rules to the server's, as in /__/replay/batch.
+    """
     data = request.get_json()
     entry_id = data.get("id")
-    req_to_replay = next((entry for entry in history_manager.get_history() if entry.id == entry_id), None)
+    try:
+        differ = differ_for(data.get("ignore"))
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    req_to_replay = history_manager.get(entry_id)
     if req_to_replay:
-        replayed_response = requests.request(
+        replayed_response = upstream.request(
             method=req_to_replay.method,
-            url=urljoin(app.config["UPSTREAM_URL"], req_to_replay.path),
+            url=upstream_url_for(req_to_replay.path, req_to_replay.query),
             headers=req_to_replay.headers,
-            json=json.loads(req_to_replay.data) if req_to_replay.data else None,
             data=req_to_replay.data,
         )
         # Serialize the replayed response using the HistoryEntry serializer and add custom header
         replayed_entry = HistoryEntry.from_response(replayed_response)
         response_headers = dict(replayed_response.headers)
-        return jsonify(replayed_entry.to_dict()), replayed_response.status_code, response_headers
+        payload = replayed_entry.to_dict()
+        payload["diff"] = differ.diff(req_to_replay, replayed_entry)
+        return jsonify(payload), replayed_response.status_code, response_headers
     else:
-        return (jsonify({"error": "Invalid request index"}), 400, response_headers)
+        return jsonify({"error": "Invalid request index"}), 400
+
+
+@app.route("/__/replay/batch", methods=["POST"])
+def replay_batch():
+    """Replay many recorded requests, selected by ``ids`` or by a history ``filter``.
+
+    Takes ``concurrency``, ``rate`` (requests per second), ``timing``
+    ("fast" or "recorded"), ``speed``, ``limit``, ``upstream`` (to replay
+    against another server) and ``ignore`` (diff ignore rules added to the
+    server's: ``{"headers": [...], "fields": [...], "values": [...]}``) and
+    returns a result with latency and response diff per request, plus a
+    summary.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        entries = select_entries(data)
+        replayer = BatchReplay(
+            lambda entry: upstream.request(
+                method=entry.method,
+                url=upstream_url_for(entry.path, entry.query, base=data.get("upstream")),
+                headers=entry.headers,
+                data=entry.data,
+            ),
+            concurrency=int(data.get("concurrency", 8)),
+            rate=float(data["rate"]) if data.get("rate") else None,
+            timing=data.get("timing", "fast"),
+            speed=float(data.get("speed", 1.0)),
+            differ=differ_for(data.get("ignore")),
+        )
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    results = replayer.run(entries)
+    return jsonify({"results": results, "summary": summarize(results)})
+
+
+def differ_for(ignore):
+    """The server's ResponseDiffer with a request's ignore rules added, if it has any."""
+    if not ignore:
+        return response_differ
+    if not isinstance(ignore, dict):
+        raise ValueError("ignore must be an object with headers, fields and values")
+    return response_differ.extended(
+        ignore_headers=ignore.get("headers", ()),
+        ignore_fields=ignore.get("fields", ()),
+        ignore_values=ignore.get("values", ()),
+    )
+
+
+def select_entries(data):
+    """The entries a batch replay request asks for; raises ValueError if it names none."""
+    limit = data.get("limit")
+    if "ids" in data:
+        entries = []
+        for entry_id in data["ids"]:
+            entry = history_manager.get(entry_id)
+            if entry is None:
+                raise ValueError(f"Unknown id: {entry_id}")
+            entries.append(entry)
+        return entries[:limit] if limit else entries
+    if "filter" not in data:
+        raise ValueError("Give either ids or a filter")
+    args = {k: v if isinstance(v, list) else [str(v)] for k, v in data["filter"].items()}
+    query = HistoryQuery.from_args(args)
+    if query is None:
+        pairs = history_manager.items()
+    else:
+        pairs = history_manager.search(query, limit or history_manager.last_seq() + 1)
+    entries = []
+    for _, entry in pairs:
+        if limit and len(entries) >= limit:
+            break
+        entries.append(entry)
+    return entries
+
+
+@app.route("/__/metrics", methods=["GET"])
+def metrics_endpoint():
+    return Response(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.route("/__/cache", methods=["GET", "DELETE"])
+def cache_stats():
+    if response_cache is None:
+        return jsonify({"error": "The response cache is off; start the proxy with --cache"}), 404
+    if request.method == "DELETE":
+        response_cache.clear()
+    return jsonify(response_cache.stats())
+
+
+@app.route("/__/pool", methods=["GET"])
+def pool_stats():
+    return jsonify(upstream.stats())
+
+
+@app.route("/__/segments", methods=["GET"])
+def segments():
+    storage = history_manager.storage
+    if not isinstance(storage, SegmentedStorage):
+        return jsonify({"error": "The tape is not segmented"}), 404
+    return jsonify({"segments": storage.segments()})
+
 
+@app.route("/__/recorder", methods=["GET"])
+def recorder_stats():
+    if background_recorder is None:
+        return jsonify({"error": "Background recording is not enabled"}), 404
+    return jsonify(background_recorder.stats())
+
+
+import atexit
+import os
+import signal
+import socket
+import threading
 
 import click
+from werkzeug.serving import make_server
+
+
+def make_storage(kind, tape=None, fsync_every=64, compression="zlib", segment_format="jsonl", **retention):
+    """Build the tape storage backend selected on the command line.
+
+    ``retention`` holds the SegmentedStorage rotation and retention settings.
+    """
+    if kind == "segmented":
+        options = {"compression": compression} if segment_format == "pack" else {}
+        return SegmentedStorage(
+            tape or "tape", segment_format=segment_format, fsync_every=fsync_every, **options, **retention
+        )
+    if kind == "packed":
+        return PackedStorage(tape or "tape.pack", fsync_every=fsync_every, compression=compression)
+    if kind == "journal":
+        return JournalStorage(tape or "tape.jsonl", fsync_every=fsync_every)
+    if kind == "sqlite":
+        return SqliteStorage(tape or "tape.sqlite")
+    return JsonStorage(tape or HistoryManager.HISTORY_FILE_PATH)
 
 
 @click.command()
 @click.argument("upstream_url", required=True)
-def run_server(upstream_url):
+@click.option("--storage", type=click.Choice(["json", "journal", "packed", "segmented", "sqlite"]), default="json", help="Tape format: a rewritten JSON array, an append-only JSON Lines journal, a compressed binary tape, a directory of rotating segments, or an SQLite database several workers can share.")
+@click.option("--tape", default=None, help="Path of the tape (defaults to tape.json / tape.jsonl / tape.pack / tape/ / tape.sqlite).")
+@click.option("--compression", type=click.Choice(PackedStorage.CODECS), default="zlib", show_default=True, help="Packed tapes and segments: how each block of records is compressed.")
+@click.option("--segment-format", type=click.Choice(list(SegmentedStorage.FORMATS)), default="jsonl", show_default=True, help="Segmented: write new segments as JSON Lines journals or packed binary files.")
+@click.option("--segment-entries", type=int, default=None, help="Segmented: entries per segment before rotating.")
+@click.option("--segment-bytes", type=int, default=64 * 1024 * 1024, show_default=True, help="Segmented: bytes per segment before rotating.")
+@click.option("--max-entries", type=int, default=None, help="Segmented: evict old segments beyond this many entries.")
+@click.option("--max-bytes", type=int, default=None, help="Segmented: evict old segments beyond this many bytes.")
+@click.option("--max-age", type=float, default=None, help="Segmented: evict segments whose newest entry is older than this many seconds.")
+@click.option("--archive-dir", default=None, help="Segmented: move evicted segments here instead of deleting them.")
+@click.option("--fsync-every", default=64, show_default=True, help="Journal records written between fsyncs; records per block of a packed tape.")
+@click.option("--lazy", is_flag=True, help="Open a journal, packed, segmented or SQLite tape from its index and decode entries on demand.")
+@click.option("--blob-dir", default=None, help="Store each distinct body once in this directory and keep only references in the tape.")
+@click.option("--compress-bodies", type=int, default=None, help="Hold in-memory bodies of at least this many bytes zlib-compressed.")
+@click.option("--background-recording", is_flag=True, help="Record from a background thread instead of on the request path.")
+@click.option("--queue-size", default=10000, show_default=True, help="Background recording: entries that may wait to be written.")
+@click.option("--queue-policy", type=click.Choice(BackgroundRecorder.POLICIES), default="block", show_default=True, help="Background recording: what to do when the queue is full.")
+@click.option("--batch-size", default=256, show_default=True, help="Background recording: entries written per batch.")
+@click.option("--stream", is_flag=True, help="Stream upstream responses to the client as they arrive.")
+@click.option("--record-limit", type=int, default=None, help="Bytes of each streamed response body kept in the tape.")
+@click.option("--record-overflow", type=click.Choice(["truncate", "spill"]), default="truncate", show_default=True, help="What to do with streamed bodies larger than --record-limit.")
+@click.option("--spill-dir", default="bodies", show_default=True, help="Directory for spilled response bodies.")
+@click.option("--pool-size", default=10, show_default=True, help="Maximum pooled connections to the upstream.")
+@click.option("--no-keep-alive", is_flag=True, help="Close upstream connections after every request.")
+@click.option("--retries", default=0, show_default=True, help="Retries for failed connections and 502/503/504 responses to idempotent requests.")
+@click.option("--backoff", default=0.0, show_default=True, help="Backoff factor between retries, in seconds.")
+@click.option("--connect-timeout", type=float, default=None, help="Upstream connect timeout in seconds.")
+@click.option("--read-timeout", type=float, default=None, help="Upstream read timeout in seconds.")
+@click.option("--playback", is_flag=True, help="Serve matching requests from the tape instead of the upstream.")
+@click.option("--on-miss", "playback_miss", type=click.Choice(PlaybackIndex.MISS_POLICIES), default="404", show_default=True, help="Playback: what to do when no recording matches.")
+@click.option("--match-body", is_flag=True, help="Playback: also match on a hash of the request body.")
+@click.option("--ignore-method", is_flag=True, help="Playback: match recordings regardless of method.")
+@click.option("--ignore-query", is_flag=True, help="Playback: match recordings regardless of query string.")
+@click.option("--ignore-param", "ignore_params", multiple=True, help="Playback: query parameter left out of matching (repeatable).")
+@click.option("--cache", is_flag=True, help="Serve repeated GET and HEAD requests from a cache of recent responses.")
+@click.option("--cache-ttl", default=60.0, show_default=True, help="Cache: seconds to keep responses without a Cache-Control max-age.")
+@click.option("--cache-max-entries", default=1000, show_default=True, help="Cache: responses kept before evicting the least recently used.")
+@click.option("--cache-max-bytes", default=64 * 1024 * 1024, show_default=True, help="Cache: bytes of response bodies kept before evicting the least recently used.")
+@click.option("--cache-key-header", "cache_key_headers", multiple=True, help="Cache: request header whose value is part of the cache key (repeatable).")
+@click.option("--diff-ignore-header", "diff_ignore_headers", multiple=True, help="Replay diffs: response header to leave out (repeatable).")
+@click.option("--diff-ignore-field", "diff_ignore_fields", multiple=True, help="Replay diffs: glob of JSON body paths to leave out, e.g. '*.updated_at' (repeatable).")
+@click.option("--diff-ignore-value", "diff_ignore_values", multiple=True, help="Replay diffs: 'timestamps', 'uuids' or a regex; values matching it on both sides count as equal (repeatable).")
+@click.option("--engine", type=click.Choice(["flask", "asyncio"]), default="flask", show_default=True, help="Serve with Flask's threaded server or the aiohttp-based asyncio engine.")
+@click.option("--workers", default=1, show_default=True, help="Processes serving requests; more than one requires --storage sqlite.")
+@click.option("--sync-interval", default=0.5, show_default=True, help="SQLite: seconds between picking up the entries other workers have recorded.")
+def run_server(upstream_url, engine, workers, **options):
     """Start the proxy server with the given UPSTREAM_URL."""
+    if workers > 1:
+        if options["storage"] != "sqlite":
+            raise click.UsageError("--workers requires --storage sqlite")
+        if engine == "asyncio":
+            raise click.UsageError("--workers is not supported by the asyncio engine")
+        serve_workers(workers, lambda: configure(upstream_url, **options))
+        return
+    configure(upstream_url, **options)
+    if engine == "asyncio":
+        if options["stream"] or options["playback"] or options["cache"]:
+            raise click.UsageError("--stream, --playback and --cache are not supported by the asyncio engine")
+        import aio
+
+        aio.run(
+            upstream_url,
+            pool_size=options["pool_size"],
+            connect_timeout=options["connect_timeout"],
+            read_timeout=options["read_timeout"],
+        )
+    else:
+        app.run(host="0.0.0.0", port=54321, debug=True, threaded=True)
+
+
+def configure(
+    upstream_url,
+    storage="json",
+    tape=None,
+    compression="zlib",
+    segment_format="jsonl",
+    fsync_every=64,
+    segment_entries=None,
+    segment_bytes=64 * 1024 * 1024,
+    max_entries=None,
+    max_bytes=None,
+    max_age=None,
+    archive_dir=None,
+    lazy=False,
+    blob_dir=None,
+    compress_bodies=None,
+    background_recording=False,
+    queue_size=10000,
+    queue_policy="block",
+    batch_size=256,
+    stream=False,
+    record_limit=None,
+    record_overflow="truncate",
+    spill_dir="bodies",
+    pool_size=10,
+    no_keep_alive=False,
+    retries=0,
+    backoff=0.0,
+    connect_timeout=None,
+    read_timeout=None,
+    playback=False,
+    playback_miss="404",
+    match_body=False,
+    ignore_method=False,
+    ignore_query=False,
+    ignore_params=(),
+    cache=False,
+    cache_ttl=60.0,
+    cache_max_entries=1000,
+    cache_max_bytes=64 * 1024 * 1024,
+    cache_key_headers=(),
+    diff_ignore_headers=(),
+    diff_ignore_fields=(),
+    diff_ignore_values=(),
+    sync_interval=0.5,
+):
+    """Set up the app and its module-level services from the run_server options."""
+    global history_manager, upstream, playback_index, background_recorder, response_cache, response_differ, tape_sync
+    if lazy and storage == "json":
+        raise click.UsageError("--lazy requires --storage journal, packed, segmented or sqlite")
+    try:
+        response_differ = ResponseDiffer(diff_ignore_headers, diff_ignore_fields, diff_ignore_values)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--diff-ignore-value")
     app.config["UPSTREAM_URL"] = upstream_url
-    app.run(host="0.0.0.0", port=54321, debug=True, threaded=True)
+    app.config["STREAM_PROXY"] = stream
+    app.config["RECORD_BODY_LIMIT"] = record_limit
+    app.config["RECORD_OVERFLOW"] = record_overflow
+    app.config["SPILL_DIR"] = spill_dir
+    app.config["PLAYBACK"] = playback
+    app.config["PLAYBACK_MISS"] = playback_miss
+    app.config["SHARED_TAPE"] = storage == "sqlite"
+    history_manager = HistoryManager(
+        make_storage(
+            storage,
+            tape,
+            fsync_every,
+            compression=compression,
+            segment_format=segment_format,
+            segment_entries=segment_entries,
+            segment_bytes=segment_bytes,
+            max_entries=max_entries,
+            max_bytes=max_bytes,
+            max_age=max_age,
+            archive_dir=archive_dir,
+        ),
+        lazy=lazy,
+        blobs=BlobStore(blob_dir) if blob_dir else None,
+        compress_bodies=compress_bodies,
+    )
+    upstream = UpstreamPool(
+        pool_size=pool_size,
+        keep_alive=not no_keep_alive,
+        max_retries=retries,
+        backoff_factor=backoff,
+        connect_timeout=connect_timeout,
+        read_timeout=read_timeout,
+    )
+    if playback:
+        rules = MatchRules(
+            method=not ignore_method,
+            query=not ignore_query,
+            body=match_body,
+            ignore_params=ignore_params,
+        )
+        playback_index = PlaybackIndex(rules)
+        playback_index.build(history_manager.items())
+        history_manager.add_listener(playback_index.add)
+    history_manager.add_listener(tail_hub.publish)
+    if cache:
+        response_cache = ResponseCache(
+            ttl=cache_ttl, max_entries=cache_max_entries, max_bytes=cache_max_bytes, key_headers=cache_key_headers
+        )
+        history_manager.add_listener(response_cache.add)
+    atexit.register(history_manager.close)
+    if background_recording:
+        background_recorder = BackgroundRecorder(
+            history_manager, max_size=queue_size, policy=queue_policy, batch_size=batch_size
+        )
+        # Registered last so it runs first: drain the queue before the tape is closed.
+        atexit.register(background_recorder.close)
+    if tape_sync is not None:
+        tape_sync.set()
+        tape_sync = None
+    if storage == "sqlite" and sync_interval:
+        tape_sync = start_tape_sync(sync_interval)
+
+
+def start_tape_sync(interval):
+    """Refresh the history from a shared tape every ``interval`` seconds until the returned event is set.
+
+    This is how the playback index, the response cache and live tails learn
+    of entries recorded by other workers.
+    """
+    stop = threading.Event()
+
+    def sync():
+        while not stop.wait(interval):
+            try:
+                history_manager.refresh()
+            except Exception:
+                logging.exception("Refreshing the tape failed")
+
+    threading.Thread(target=sync, name="tape-sync", daemon=True).start()
+    return stop
+
+
+def serve_workers(workers, configure_worker, host="0.0.0.0", port=54321):
+    """Serve from ``workers`` forked processes accepting connections on one listening socket.
+
+    Each worker calls ``configure_worker`` after the fork, so it opens its
+    own tape connection and upstream pool. SIGINT or SIGTERM stops them all.
+    """
+    listener = socket.create_server((host, port), backlog=128)
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                serve_worker(listener, configure_worker, host, port)
+            finally:
+                os._exit(0)
+        children.append(pid)
+    listener.close()
+
+    def stop(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for pid in children:
+        os.waitpid(pid, 0)
+
+
+def serve_worker(listener, configure_worker, host, port):
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    configure_worker()
+    server = make_server(host, port, app, threaded=True, fd=listener.fileno())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if background_recorder is not None:
+            background_recorder.close()
+        history_manager.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,172 @@
+import fnmatch
+import json
+import re
+
+from blobs import digest
+
+# Headers expected to differ between any two responses, left out of diffs.
+VOLATILE_HEADERS = {"date", "content-length", "transfer-encoding", "connection", "keep-alive"}
+
+# Value patterns ``ignore_values`` can refer to by name.
+VALUE_PATTERNS = {
+    "timestamps": (
+        r"\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?(Z|[+-]\d{2}:?\d{2})?"
+        r"|(Mon|Tue|Wed|Thu|Fri|Sat|Sun), \d{2} [A-Z][a-z]{2} \d{4} \d{2}:\d{2}:\d{2} GMT"
+    ),
+    "uuids": r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}",
+}
+
+NOT_JSON = object()
+
+
+def parse_json(body):
+    """The JSON document in a body, or NOT_JSON if it doesn't hold an object or array."""
+    if isinstance(body, bytes):
+        try:
+            body = body.decode("utf-8")
+        except UnicodeDecodeError:
+            return NOT_JSON
+    if body.lstrip()[:1] not in ("{", "["):
+        return NOT_JSON
+    try:
+        return json.loads(body)
+    except ValueError:
+        return NOT_JSON
+
+
+class ResponseDiffer:
+    """Compares a replayed HistoryEntry with the recording.
+
+    Status codes are compared as they are. Response headers are compared by
+    lower-cased name with surrounding whitespace stripped, leaving out
+    VOLATILE_HEADERS and ``ignore_headers``. Identical bodies are recognized
+    without parsing them, by digest when the recording's body is in the blob
+    store (so it isn't even read back) and byte for byte otherwise. Two JSON
+    bodies are compared value by value: up to ``max_changes`` differences
+    are reported by path (``items.0.price``), skipping paths that match one
+    of the ``ignore_fields`` globs (``*.updated_at``). Other bodies are only
+    reported with their sizes.
+
+    ``ignore_values`` are regular expressions, or names of VALUE_PATTERNS
+    such as "timestamps" and "uuids"; a header or JSON string that matches
+    one on both sides counts as unchanged, e.g. two different request ids.
+    Raises ValueError for a malformed pattern.
+    """
+
+    def __init__(self, ignore_headers=(), ignore_fields=(), ignore_values=(), max_changes=50):
+        self.ignore_headers = frozenset(name.lower() for name in ignore_headers)
+        self.ignore_fields = tuple(ignore_fields)
+        self.ignore_values = tuple(ignore_values)
+        self.max_changes = max_changes
+        self._skipped_headers = VOLATILE_HEADERS | self.ignore_headers
+        self._fields = re.compile("|".join(map(fnmatch.translate, self.ignore_fields))) if self.ignore_fields else None
+        try:
+            patterns = (f"(?:{VALUE_PATTERNS.get(value, value)})" for value in self.ignore_values)
+            self._values = re.compile("|".join(patterns)) if self.ignore_values else None
+        except re.error as e:
+            raise ValueError(f"Invalid ignore pattern: {e}") from None
+
+    def extended(self, ignore_headers=(), ignore_fields=(), ignore_values=()):
+        """A differ applying these ignore rules on top of this one's."""
+        return ResponseDiffer(
+            self.ignore_headers | set(ignore_headers),
+            self.ignore_fields + tuple(ignore_fields),
+            self.ignore_values + tuple(ignore_values),
+            self.max_changes,
+        )
+
+    def diff(self, recorded, replayed):
+        """An empty dict if the responses match; otherwise what differs, by part of the response."""
+        diff = {}
+        if recorded.status_code != replayed.status_code:
+            diff["status_code"] = {"recorded": recorded.status_code, "replayed": replayed.status_code}
+        headers = self.diff_headers(recorded.response_headers, replayed.response_headers)
+        if headers:
+            diff["response_headers"] = headers
+        body = self.diff_bodies(recorded, replayed)
+        if body:
+            diff["response_body"] = body
+        return diff
+
+    def normalize_headers(self, headers):
+        skipped = self._skipped_headers
+        return {name.lower(): value.strip() for name, value in headers.items() if name.lower() not in skipped}
+
+    def diff_headers(self, recorded, replayed):
+        recorded, replayed = self.normalize_headers(recorded), self.normalize_headers(replayed)
+        return {
+            name: {"recorded": recorded.get(name), "replayed": replayed.get(name)}
+            for name in sorted(recorded.keys() | replayed.keys())
+            if not self.same_value(recorded.get(name), replayed.get(name))
+        }
+
+    def same_value(self, recorded, replayed):
+        if recorded == replayed:
+            return True
+        return (
+            self._values is not None
+            and isinstance(recorded, str)
+            and isinstance(replayed, str)
+            and self._values.fullmatch(recorded) is not None
+            and self._values.fullmatch(replayed) is not None
+        )
+
+    def diff_bodies(self, recorded, replayed):
+        """None if the bodies match, otherwise their sizes and, for JSON, the changed values.
+
+        Added values are reported with only a "replayed" value and removed
+        ones with only a "recorded" value; ``truncated`` is set when more
+        than ``max_changes`` values differ.
+        """
+        replayed_body = replayed.response_body
+        if recorded.response_body_digest is not None and recorded.response_body_digest == digest(replayed_body):
+            return None
+        recorded_body = recorded.response_body
+        if recorded_body == replayed_body:
+            return None
+        diff = {"recorded_size": len(recorded_body), "replayed_size": len(replayed_body)}
+        recorded_json = parse_json(recorded_body)
+        replayed_json = parse_json(replayed_body) if recorded_json is not NOT_JSON else NOT_JSON
+        if replayed_json is not NOT_JSON:
+            changes = []
+            self._compare(recorded_json, replayed_json, "", changes)
+            if not changes:
+                return None
+            if len(changes) > self.max_changes:
+                del changes[self.max_changes :]
+                diff["truncated"] = True
+            diff["changes"] = changes
+        return diff
+
+    def _ignored(self, path):
+        return self._fields is not None and self._fields.match(path) is not None
+
+    def _compare(self, recorded, replayed, path, changes):
+        if recorded == replayed and type(recorded) is type(replayed):
+            return
+        if len(changes) > self.max_changes or (path and self._ignored(path)):
+            return
+        if isinstance(recorded, dict) and isinstance(replayed, dict):
+            for key, value in recorded.items():
+                child = f"{path}.{key}" if path else str(key)
+                if key in replayed:
+                    self._compare(value, replayed[key], child, changes)
+                elif not self._ignored(child):
+                    changes.append({"path": child, "recorded": value})
+            for key in replayed.keys() - recorded.keys():
+                child = f"{path}.{key}" if path else str(key)
+                if not self._ignored(child):
+                    changes.append({"path": child, "replayed": replayed[key]})
+        elif isinstance(recorded, list) and isinstance(replayed, list):
+            for index in range(max(len(recorded), len(replayed))):
+                child = f"{path}.{index}" if path else str(index)
+                if index >= len(replayed):
+                    if not self._ignored(child):
+                        changes.append({"path": child, "recorded": recorded[index]})
+                elif index >= len(recorded):
+                    if not self._ignored(child):
+                        changes.append({"path": child, "replayed": replayed[index]})
+                else:
+                    self._compare(recorded[index], replayed[index], child, changes)
+        elif not self.same_value(recorded, replayed) or type(recorded) is not type(replayed):
+            changes.append({"path": path, "recorded": recorded, "replayed": replayed})
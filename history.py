@@ -1,38 +1,229 @@
-from dataclasses import dataclass
+import base64
+from collections import Counter, OrderedDict
+from collections.abc import Sequence
+from datetime import datetime
+import functools
+import hashlib
+import itertools
 import json
 import os
-from datetime import datetime
+import sys
+import threading
+import uuid
+import zlib
+
+from blobs import digest
+from search import HistoryIndex, SignatureIndex
+from storage import JsonStorage
+
+BODY_FIELDS = ("data", "response_body")
+
+
+def decode_body(raw):
+    """Bodies are kept as text when they are valid UTF-8 and as the exact bytes otherwise."""
+    if isinstance(raw, str):
+        return raw
+    try:
+        return raw.decode("utf-8")
+    except UnicodeDecodeError:
+        return bytes(raw)
+
+
+def display_body(body):
+    if isinstance(body, bytes):
+        return f"<{len(body)} bytes of binary data>"
+    return body
+
+
+def intern_string(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+def intern_headers(headers):
+    """A copy of ``headers`` whose names and values are interned, so repeated ones share memory."""
+    if headers is None:
+        return None
+    return {intern_string(name): intern_string(value) for name, value in headers.items()}
+
+
+class DeferredBody:
+    """A body that is only materialized when an entry's body is read."""
+
+    __slots__ = ()
+
+    def load(self):
+        raise NotImplementedError
+
+
+class BlobBody(DeferredBody):
+    """A body kept in a BlobStore and read back through its cache."""
+
+    __slots__ = ("blobs", "key", "binary")
+
+    def __init__(self, blobs, key, binary=False):
+        self.blobs = blobs
+        self.key = key
+        self.binary = binary
+
+    def load(self):
+        return self.blobs.get(self.key, binary=self.binary)
 
-from datetime import datetime
+
+class CompressedBody(DeferredBody):
+    """A body held zlib-compressed in memory."""
+
+    __slots__ = ("compressed", "binary")
+
+    def __init__(self, body):
+        self.binary = isinstance(body, bytes)
+        self.compressed = zlib.compress(body if self.binary else body.encode("utf-8"), 1)
+
+    def load(self):
+        raw = zlib.decompress(self.compressed)
+        return raw if self.binary else raw.decode("utf-8")
 
 
-@dataclass
 class HistoryEntry:
-    id: str
-    method: str
-    path: str
-    status_code: int
-    headers: dict
-    data: str
-    response_headers: dict
-    response_body: str
-    timestamp: datetime
-    http_version: str = "HTTP/1.1"
-
-    def to_dict(self):
-        """Convert the HistoryEntry instance to a dictionary, including the ID and timestamp."""
-        return {
+    """One recorded exchange.
+
+    Entries are slotted, and their method, path and header strings are
+    interned, so a tape of repetitive traffic keeps one copy of each. A body
+    may be given as a DeferredBody, which is loaded every time it is read
+    rather than held in the entry.
+    """
+
+    FIELDS = (
+        "id",
+        "method",
+        "path",
+        "status_code",
+        "headers",
+        "data",
+        "response_headers",
+        "response_body",
+        "timestamp",
+        "http_version",
+        "response_size",
+        "response_body_path",
+        "query",
+        "data_digest",
+        "response_body_digest",
+        "signature_digest",
+        "timings",
+        "served_from_cache",
+    )
+    __slots__ = tuple(f"_{name}" if name in BODY_FIELDS else name for name in FIELDS)
+
+    def __init__(
+        self,
+        id,
+        method,
+        path,
+        status_code,
+        headers,
+        data,  # bytes when the body is not valid UTF-8
+        response_headers,
+        response_body,  # bytes when the body is not valid UTF-8
+        timestamp,
+        http_version="HTTP/1.1",
+        response_size=None,  # full body size, set when response_body is not the whole body
+        response_body_path=None,  # file holding the full body when it was spilled to disk
+        query="",  # raw query string of the request
+        data_digest=None,  # content address of data, when stored in a BlobStore
+        response_body_digest=None,  # content address of response_body, when stored in a BlobStore
+        signature_digest=None,  # signature() as of recording, stored with the entry
+        timings=None,  # milliseconds spent in each phase of the exchange, e.g. {"receive": 0.1, "ttfb": 12.5}
+        served_from_cache=False,  # answered by the proxy's response cache rather than the upstream
+    ):
+        self.id = id
+        self.method = intern_string(method)
+        self.path = intern_string(path)
+        self.status_code = status_code
+        self.headers = intern_headers(headers)
+        self._data = data
+        self.response_headers = intern_headers(response_headers)
+        self._response_body = response_body
+        self.timestamp = timestamp
+        self.http_version = intern_string(http_version)
+        self.response_size = response_size
+        self.response_body_path = response_body_path
+        self.query = intern_string(query)
+        self.data_digest = data_digest
+        self.response_body_digest = response_body_digest
+        self.signature_digest = signature_digest
+        self.timings = timings
+        self.served_from_cache = served_from_cache
+
+    @property
+    def data(self):
+        body = self._data
+        return body.load() if isinstance(body, DeferredBody) else body
+
+    @data.setter
+    def data(self, body):
+        self._data = body
+
+    @property
+    def response_body(self):
+        body = self._response_body
+        return body.load() if isinstance(body, DeferredBody) else body
+
+    @response_body.setter
+    def response_body(self, body):
+        self._response_body = body
+
+    def deferred(self, field):
+        """The DeferredBody holding a body field, or None when the body is held in the entry."""
+        body = getattr(self, f"_{field}")
+        return body if isinstance(body, DeferredBody) else None
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.FIELDS)
+
+    __hash__ = None
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.FIELDS)
+        return f"{self.__class__.__name__}({fields})"
+
+    def to_dict(self, bodies=True):
+        """Convert the HistoryEntry instance to a dictionary, including the ID and timestamp.
+
+        With ``bodies=False`` the request and response bodies are left out
+        (and not loaded), for callers that serialize them on their own.
+        """
+        entry_dict = {
             "id": self.id,  # Include the ID in the dictionary
             "method": self.method,
             "path": self.path,
             "http_version": self.http_version,
             "status_code": self.status_code,
             "headers": self.headers,
-            "data": self.data,
             "response_headers": self.response_headers,
-            "response_body": self.response_body,
             "timestamp": self.timestamp.isoformat(),
         }
+        if bodies:
+            entry_dict["data"] = self.data
+            entry_dict["response_body"] = self.response_body
+        for field in BODY_FIELDS:
+            if isinstance(entry_dict.get(field), bytes):
+                entry_dict[field] = base64.b64encode(entry_dict[field]).decode("ascii")
+                entry_dict[f"{field}_encoding"] = "base64"
+        if self.query:
+            entry_dict["query"] = self.query
+        if self.response_size is not None:
+            entry_dict["response_size"] = self.response_size
+        if self.response_body_path is not None:
+            entry_dict["response_body_path"] = self.response_body_path
+        if self.signature_digest is not None:
+            entry_dict["signature"] = self.signature_digest
+        if self.timings is not None:
+            entry_dict["timings"] = self.timings
+        if self.served_from_cache:
+            entry_dict["served_from_cache"] = True
+        return entry_dict
 
     @classmethod
     def from_dict(cls, entry_dict):
@@ -44,6 +235,9 @@ class HistoryEntry:
         if timestamp_str.endswith("Z"):
             timestamp_str = timestamp_str[:-1] + "+00:00"
         entry_dict["timestamp"] = datetime.fromisoformat(timestamp_str)
+        for field in BODY_FIELDS:
+            if entry_dict.get(f"{field}_encoding") == "base64":
+                entry_dict[field] = base64.b64decode(entry_dict[field])
         return cls(
             id=id_str,  # Pass the ID to the constructor
             method=entry_dict["method"],
@@ -55,6 +249,12 @@ class HistoryEntry:
             response_headers=entry_dict["response_headers"],
             response_body=entry_dict["response_body"],
             timestamp=entry_dict["timestamp"],
+            response_size=entry_dict.get("response_size"),
+            response_body_path=entry_dict.get("response_body_path"),
+            query=entry_dict.get("query", ""),
+            signature_digest=entry_dict.get("signature"),
+            timings=entry_dict.get("timings"),
+            served_from_cache=entry_dict.get("served_from_cache", False),
         )
 
     @classmethod
@@ -67,7 +267,7 @@ class HistoryEntry:
             headers=dict(request.headers),
             data=request.body or "",
             response_headers=dict(response.headers),
-            response_body=response.text,
+            response_body=decode_body(response.content),
         )
 
 
@@ -75,7 +275,7 @@ class HistoryEntry:
         """Update the HistoryEntry instance with a new response from the requests library and return the instance."""
         self.status_code = response.status_code
         self.response_headers = dict(response.headers)
-        self.response_body = response.text
+        self.response_body = decode_body(response.content)
         if 'timestamp' in response.headers:
             timestamp_str = response.headers['timestamp']
             if timestamp_str.endswith("Z"):
@@ -89,21 +289,37 @@ class HistoryEntry:
         if timestamp is None:
             timestamp = datetime.utcnow()
         return cls(
+            id=str(uuid.uuid4()),
             method=response.request.method,
             path=response.request.url,
             status_code=response.status_code,
             headers=dict(response.request.headers),
-            data=response.request.body or "",
+            data=decode_body(response.request.body or ""),
             response_headers=dict(response.headers),
-            response_body=response.text,
+            response_body=decode_body(response.content),
             timestamp=timestamp,  # Add the current UTC timestamp if not provided
         )
 
+    def signature(self):
+        """Digest identifying the exchange regardless of its id and timestamp."""
+        parts = (
+            self.method,
+            self.path,
+            self.query,
+            str(self.status_code),
+            json.dumps(self.headers, sort_keys=True),
+            self.data_digest or digest(self.data),
+            json.dumps(self.response_headers, sort_keys=True),
+            self.response_body_digest or digest(self.response_body),
+        )
+        return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
     def format_as_http_message(self) -> str:
-        request_line = f"{self.method} {self.path} {self.http_version}\n"
+        target = f"{self.path}?{self.query}" if self.query else self.path
+        request_line = f"{self.method} {target} {self.http_version}\n"
         request_headers = "".join(f"{k}: {v}\n" for k, v in self.headers.items())
         request_section = (
-            f"{request_line}{request_headers}\n{self.data}\n\n"
+            f"{request_line}{request_headers}\n{display_body(self.data)}\n\n"
             if self.data
             else f"{request_line}{request_headers}\n"
         )
@@ -113,7 +329,7 @@ class HistoryEntry:
             f"{k}: {v}\n" for k, v in self.response_headers.items()
         )
         response_section = (
-            f"{status_line}{response_headers}\n{self.response_body}\n"
+            f"{status_line}{response_headers}\n{display_body(self.response_body)}\n"
             if self.response_body
             else f"{status_line}{response_headers}\n"
         )
@@ -121,31 +337,405 @@ class HistoryEntry:
         return f"{request_section}{response_section}"
 
 
+class LazyHistory(Sequence):
+    """A read-only view of a tape that decodes entries only when they are accessed.
+
+    Backed by a storage exposing ``count()`` and ``read(index)``; the most
+    recently used entries are kept in a bounded cache.
+    """
+
+    def __init__(self, storage, decode=HistoryEntry.from_dict, cache_size=1024):
+        self._storage = storage
+        self._decode = decode
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._storage.count()
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("history index out of range")
+        with self._lock:
+            entry = self._cache.get(index)
+            if entry is not None:
+                self._cache.move_to_end(index)
+                return entry
+        entry = self._decode(self._storage.read(index))
+        self.remember(index, entry)
+        return entry
+
+    def clear(self):
+        """Drop every cached entry."""
+        with self._lock:
+            self._cache.clear()
+
+    def remember(self, index, entry):
+        """Cache an entry, e.g. one the storage has just written."""
+        with self._lock:
+            self._cache[index] = entry
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+
+
 class HistoryManager:
+    """Records HistoryEntry objects to a tape and indexes them.
+
+    Every entry gets a sequence number (its position on the tape) that never
+    changes once assigned; cursors for paging through history are built on
+    sequence numbers so they stay valid while new entries are appended.
+
+    Storages with a retention policy evict the oldest entries; the entries
+    still in memory then start at ``_first_seq``, and evicted entries that
+    were archived remain readable through ``at`` and ``page``.
+
+    Bodies moved to the blob store are read back from it on access instead
+    of being held by the entries. With ``compress_bodies`` other bodies of
+    at least that many characters (or bytes) are held compressed.
+
+    With an indexed storage (``storage.indexed``) lookups by id, ``unique``
+    pages, occurrence counts and filtered searches are storage queries, and
+    none of the in-memory indexes are built.
+
+    The manager is safe to share between threads. Appends are serialized by
+    a single lock, so sequence numbers follow the order in which batches
+    reach storage and records are never interleaved on the tape.
+    """
+
     HISTORY_FILE_PATH = "tape.json"
 
-    def __init__(self):
-        self._history = self._load_history_from_file()
+    def __init__(self, storage=None, lazy=False, blobs=None, compress_bodies=None):
+        self._storage = storage if storage is not None else JsonStorage(self.HISTORY_FILE_PATH)
+        self._blobs = blobs
+        self._compress_bodies = compress_bodies
+        self._lock = threading.RLock()
+        self._by_id = None  # built on the first lookup by id
+        self._listeners = []
+        self._index = None  # built on the first filtered query
+        self._signatures = None  # built on the first unique query
+        self._blob_refs = None  # live references per blob key, built when entries are first deleted
+        self._indexed = self._storage.indexed  # the storage answers lookups and queries itself
+        if lazy:
+            self._storage.load_index()
+            self._history = LazyHistory(self._storage, decode=self._from_record)
+        else:
+            self._history = self._load_history_from_file()
+        self._first_seq = self._storage.first_seq()
 
     def _load_history_from_file(self):
-        """Load history from file, parsing the 'timestamp' field correctly."""
-        if os.path.exists(self.HISTORY_FILE_PATH):
-            with open(self.HISTORY_FILE_PATH, "r") as file:
-                history_data = json.load(file)
-                # Parse the 'timestamp' field for each entry
-                return [HistoryEntry.from_dict(entry) for entry in history_data]
-        return []
-
-    def _save_history_to_file(self):
-        """Save history to file, converting the 'timestamp' field to a string."""
-        with open(self.HISTORY_FILE_PATH, "w") as file:
-            # Convert each entry to a dictionary including the 'timestamp' field
-            history_data = [entry.to_dict() for entry in self._history]
-            json.dump(history_data, file, default=str)
+        """Load history from storage, parsing the 'timestamp' field correctly."""
+        return [self._from_record(record) for record in self._storage.load()]
+
+    def _to_record(self, entry):
+        """Serialize an entry for storage, moving large bodies into the blob store.
+
+        Binary bodies stay bytes; each storage decides how to encode them.
+        The entry's signature is computed the first time it is serialized and
+        stored with it; bodies already in the blob store are referenced by key
+        without being read back, so rewriting a tape costs no hashing.
+        """
+        if entry.signature_digest is None:
+            entry.signature_digest = entry.signature()
+        record = entry.to_dict(bodies=False)
+        for field in BODY_FIELDS:
+            stored = entry.deferred(field)
+            if isinstance(stored, BlobBody) and stored.blobs is self._blobs:
+                key, binary = stored.key, stored.binary
+            else:
+                body = getattr(entry, field)
+                if self._blobs is None or len(body) < self._blobs.min_size:
+                    record[field] = body
+                    self._compress(entry, field)
+                    continue
+                binary = isinstance(body, bytes)
+                key, _ = self._blobs.put(body)
+                setattr(entry, field, BlobBody(self._blobs, key, binary))
+                setattr(entry, f"{field}_digest", key)
+            record[field] = {"$blob": key, "binary": True} if binary else {"$blob": key}
+        return record
+
+    def _compress(self, entry, field):
+        """Hold a large body compressed, if the manager compresses bodies and it compresses at all."""
+        if self._compress_bodies is None or entry.deferred(field):
+            return
+        body = getattr(entry, field)
+        if len(body) < self._compress_bodies:
+            return
+        compressed = CompressedBody(body)
+        if len(compressed.compressed) < len(body):
+            setattr(entry, field, compressed)
+
+    def _from_record(self, record):
+        record = dict(record)
+        digests = {}
+        for field in BODY_FIELDS:
+            value = record.get(field)
+            if isinstance(value, dict) and "$blob" in value:
+                if self._blobs is None:
+                    raise ValueError("Tape references stored bodies but no blob store is configured")
+                digests[f"{field}_digest"] = value["$blob"]
+                record[field] = BlobBody(self._blobs, value["$blob"], value.get("binary", False))
+        entry = HistoryEntry.from_dict(record)
+        for name, key in digests.items():
+            setattr(entry, name, key)
+        for field in BODY_FIELDS:
+            self._compress(entry, field)
+        return entry
 
     def append(self, entry: HistoryEntry):
-        self._history.append(entry)
-        self._save_history_to_file()
+        self.extend([entry])
+
+    def extend(self, entries):
+        """Append a batch of entries, writing them to storage in one go."""
+        with self._lock:
+            start = self._first_seq + len(self._history)
+            if self._storage.rewrite_only:
+                self._storage.rewrite(self._to_record(entry) for entry in itertools.chain(self._history, entries))
+                preceding = None
+            else:
+                preceding = self._storage.extend([self._to_record(entry) for entry in entries])
+            if preceding:
+                self._take_in(start, [self._from_record(record) for record in preceding])
+            self._take_in(start + len(preceding or ()), entries)
+            if self._storage.needs_compaction():
+                self.compact()
+
+    def refresh(self):
+        """Take in the entries other processes sharing the storage have recorded since the last call."""
+        with self._lock:
+            start = self._first_seq + len(self._history)
+            records = self._storage.refresh()
+            if records:
+                self._take_in(start, [self._from_record(record) for record in records])
+
+    def _take_in(self, start, entries):
+        """Index and announce entries just written to storage, numbered from ``start``."""
+        lazy = isinstance(self._history, LazyHistory)
+        for seq, entry in enumerate(entries, start):
+            if not lazy:
+                self._history.append(entry)
+            if entry.id is not None and self._by_id is not None:
+                self._by_id[entry.id] = seq
+            if self._index is not None:
+                self._index.add(seq, entry)
+            if self._signatures is not None:
+                self._signatures.add(seq, entry.signature_digest or entry.signature())
+            if self._blob_refs is not None:
+                self._blob_refs.update(self._blob_keys(entry))
+        self._drop_evicted()
+        for seq, entry in enumerate(entries, start):
+            if lazy and seq >= self._first_seq:
+                self._history.remember(seq - self._first_seq, entry)
+            for listener in self._listeners:
+                listener(seq, entry)
+
+    def _drop_evicted(self):
+        """Forget entries the storage's retention policy has evicted."""
+        first_seq = self._storage.first_seq()
+        if first_seq > self._first_seq:
+            if isinstance(self._history, LazyHistory):
+                self._history.clear()  # cached positions have shifted
+            else:
+                del self._history[: first_seq - self._first_seq]
+            self._first_seq = first_seq
+            if self._index is not None:
+                self._index.discard_before(first_seq)
+            if self._signatures is not None:
+                self._signatures.discard_before(first_seq)
+        for entry_id in self._storage.pop_evicted_ids():
+            if self._by_id is not None and self._by_id.get(entry_id, first_seq) < first_seq:
+                del self._by_id[entry_id]
+        self._delete_bodies()
+
+    def _delete_bodies(self):
+        """Remove the spilled bodies of deleted entries, and their blobs once no live entry refers to them."""
+        keys, paths = self._storage.pop_deleted_bodies()
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        if not keys or self._blobs is None:
+            return
+        if self._blob_refs is None:
+            # Counted from the live tape, which no longer holds the deleted entries.
+            self._blob_refs = Counter(key for entry in self._history for key in self._blob_keys(entry))
+        else:
+            self._blob_refs.subtract(keys)
+        for key in set(keys):
+            if self._blob_refs[key] <= 0:
+                del self._blob_refs[key]
+                self._blobs.delete(key)
+
+    @staticmethod
+    def _blob_keys(entry):
+        return [key for key in (entry.data_digest, entry.response_body_digest) if key is not None]
+
+    def add_listener(self, listener):
+        """Call ``listener(seq, entry)`` after every appended entry."""
+        self._listeners.append(listener)
+
+    def compact(self):
+        """Rewrite the backing tape from the in-memory history."""
+        with self._lock:
+            self._storage.rewrite(self._to_record(entry) for entry in self._history)
+
+    def close(self):
+        with self._lock:
+            self._storage.close()
 
     def get_history(self):
         return self._history
+
+    @property
+    def storage(self):
+        return self._storage
+
+    def items(self):
+        """Yield (seq, entry) for every entry on the live tape when iteration starts.
+
+        Entries are fetched one at a time under the lock, so appends can go on
+        meanwhile; entries evicted in between are skipped.
+        """
+        with self._lock:
+            first_seq, stop = self._first_seq, self._first_seq + len(self._history)
+        for seq in range(first_seq, stop):
+            with self._lock:
+                position = seq - self._first_seq
+                if position < 0:
+                    continue
+                if position >= len(self._history):
+                    return
+                entry = self._history[position]
+            yield seq, entry
+
+    def get(self, entry_id):
+        """Return the entry with the given id, or None."""
+        with self._lock:
+            seq = self._storage.find(entry_id) if self._indexed else self._id_map().get(entry_id)
+            return None if seq is None else self.at(seq)
+
+    def _id_map(self):
+        """Map the id of every live entry to its sequence number; O(n) memory, so only built when needed."""
+        if self._by_id is None:
+            if isinstance(self._history, LazyHistory):
+                ids = self._storage.ids()
+            else:
+                ids = (entry.id for entry in self._history)
+            self._by_id = {entry_id: seq for seq, entry_id in enumerate(ids, self._first_seq) if entry_id is not None}
+        return self._by_id
+
+    def at(self, seq):
+        """Return the entry with sequence number ``seq``, reading archived segments if needed."""
+        with self._lock:
+            if seq >= self._first_seq:
+                return self._history[seq - self._first_seq]
+            if seq < 0:
+                raise IndexError("history index out of range")
+            return self._from_record(self._storage.read_archived(seq))
+
+    def oldest_seq(self):
+        """Sequence number of the oldest entry that can still be read."""
+        with self._lock:
+            return min(self._storage.oldest_seq(), self._first_seq)
+
+    def last_seq(self):
+        """Sequence number of the newest entry, or one less than oldest_seq() for an empty tape."""
+        with self._lock:
+            return self._first_seq + len(self._history) - 1
+
+    def page(self, limit, after=None, before=None, unique=False):
+        """Return up to ``limit`` (seq, entry) pairs.
+
+        With ``after`` the page starts just past that sequence number, with
+        ``before`` it ends just short of it; otherwise it starts at the oldest
+        entry. With ``unique`` only the first occurrence of every distinct
+        exchange on the live tape is returned.
+        """
+        with self._lock:
+            if unique:
+                unique_seqs = self._storage.unique_seqs if self._indexed else self._signature_index().page
+                return [(seq, self.at(seq)) for seq in unique_seqs(limit, after=after, before=before)]
+            oldest, stop = self.oldest_seq(), self.last_seq() + 1
+            if before is not None:
+                end = min(before, stop)
+                start = max(end - limit, oldest)
+            else:
+                start = oldest if after is None else max(after + 1, oldest)
+                end = min(start + limit, stop)
+            return [(seq, self.at(seq)) for seq in range(start, end)]
+
+    def _signature_index(self):
+        if self._signatures is None:
+            self._signatures = SignatureIndex()
+            for seq, entry in self.items():
+                self._signatures.add(seq, entry.signature_digest or entry.signature())
+        return self._signatures
+
+    def occurrences(self, entry):
+        """How many times the exchange recorded in ``entry`` occurs on the live tape."""
+        signature = entry.signature_digest or entry.signature()
+        with self._lock:
+            if self._indexed:
+                return self._storage.occurrences(signature)
+            return self._signature_index().count(signature)
+
+    def search(self, query, limit, after=None, before=None, unique=False):
+        """Return up to ``limit`` (seq, entry) pairs on the live tape matching a HistoryQuery.
+
+        Paging and ``unique`` work like ``page``. The secondary indexes are
+        built on the first call and kept current as entries are appended,
+        unless the storage is indexed and runs the query itself.
+        """
+        with self._lock:
+            signatures = None
+            if self._indexed:
+                scan = functools.partial(self._storage.scan, unique=unique)
+            else:
+                if self._index is None:
+                    self._index = HistoryIndex()
+                    for seq, entry in self.items():
+                        self._index.add(seq, entry)
+                scan = self._index.scan
+                signatures = self._signature_index() if unique else None
+            if before is not None:
+                seqs = scan(query, self._first_seq, before, reverse=True)
+            else:
+                seqs = scan(query, 0 if after is None else after + 1, self.last_seq() + 1)
+            results = []
+            for seq in seqs:
+                if len(results) >= limit:
+                    break
+                if signatures is not None and not signatures.is_first(seq):
+                    continue
+                entry = self.at(seq)
+                if query.matches(entry):
+                    results.append((seq, entry))
+            if before is not None:
+                results.reverse()
+            return results
+
+
+def copy_tape(source, destination, blobs=None, batch_size=10000):
+    """Copy every live entry of the ``source`` storage to ``destination``, e.g. to migrate a tape.
+
+    Entries are written ``batch_size`` at a time, each batch in one write
+    (one transaction for SQLite), and keep their ids, timestamps and stored
+    signatures; entries recorded without one get it computed on the way.
+    Returns the number of entries copied.
+    """
+    reader = HistoryManager(source, lazy=hasattr(source, "load_index"), blobs=blobs)
+    writer = HistoryManager(destination, blobs=blobs)
+    try:
+        history = reader.get_history()
+        for start in range(0, len(history), batch_size):
+            writer.extend(history[start : start + batch_size])
+        return len(history)
+    finally:
+        reader.close()
+        writer.close()
@@ -0,0 +1,174 @@
+from bisect import bisect_left
+from collections import deque
+import re
+import threading
+import time
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Path segments that identify a resource rather than a route.
+ID_SEGMENT = re.compile(
+    r"^(\d+|[0-9a-fA-F]{8}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{12}|[0-9a-fA-F]{24,})$"
+)
+
+
+def route_template(path):
+    """``/orders/{id}/items`` for ``orders/42/items``, so metrics don't get a label per resource."""
+    segments = ["{id}" if ID_SEGMENT.match(segment) else segment for segment in path.strip("/").split("/")]
+    return "/" + "/".join(segments)
+
+
+class RollingHistogram:
+    """A histogram of the observations made in the last ``window`` seconds.
+
+    Observations land in time slices ``window / slices`` seconds wide; slices
+    that fall out of the window are dropped, so both recording and reading
+    cost the same no matter how much traffic has been seen.
+    """
+
+    def __init__(self, buckets=DURATION_BUCKETS, window=60.0, slices=6):
+        self.buckets = buckets
+        self.window = window
+        self.slices = slices
+        self._width = window / slices
+        self._slices = deque()  # [slice number, counts per bucket (last is +Inf), sum]
+
+    def _expire(self, number):
+        while self._slices and self._slices[0][0] <= number - self.slices:
+            self._slices.popleft()
+
+    def observe(self, value, now):
+        number = int(now // self._width)
+        if not self._slices or self._slices[-1][0] != number:
+            self._expire(number)
+            self._slices.append([number, [0] * (len(self.buckets) + 1), 0.0])
+        current = self._slices[-1]
+        current[1][bisect_left(self.buckets, value)] += 1
+        current[2] += value
+
+    def snapshot(self, now):
+        """Return (counts per bucket, sum, count) over the window."""
+        self._expire(int(now // self._width))
+        counts = [0] * (len(self.buckets) + 1)
+        total = 0.0
+        for _, slice_counts, slice_total in self._slices:
+            for position, count in enumerate(slice_counts):
+                counts[position] += count
+            total += slice_total
+        return counts, total, sum(counts)
+
+    def quantile(self, q, counts):
+        """Estimate a quantile from bucket counts, interpolating within the bucket."""
+        count = sum(counts)
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for position, bucket_count in enumerate(counts):
+            if seen + bucket_count >= rank and bucket_count:
+                if position == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[position - 1] if position else 0.0
+                return lower + (self.buckets[position] - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels):
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+class Metrics:
+    """Request counters and latency histograms per route, in Prometheus text format.
+
+    ``observe`` is called once per proxied request with its phase timings
+    in milliseconds. It updates cumulative counters and histograms (for
+    Prometheus to aggregate) and a RollingHistogram per route and phase
+    (for the recent quantiles and throughput), so ``render`` never looks at
+    the history.
+    """
+
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self, buckets=DURATION_BUCKETS, window=60.0, slices=6, clock=time.monotonic):
+        self.buckets = buckets
+        self.window = window
+        self.slices = slices
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._requests = {}  # (method, route, status) -> count
+        self._histograms = {}  # (method, route, phase) -> [counts per bucket, sum]
+        self._rolling = {}  # (method, route, phase) -> RollingHistogram
+
+    def observe(self, method, route, status, timings):
+        now = self.clock()
+        with self._lock:
+            key = (method, route, str(status))
+            self._requests[key] = self._requests.get(key, 0) + 1
+            for phase, milliseconds in timings.items():
+                seconds = milliseconds / 1000
+                key = (method, route, phase)
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0.0]
+                    self._rolling[key] = RollingHistogram(self.buckets, self.window, self.slices)
+                histogram[0][bisect_left(self.buckets, seconds)] += 1
+                histogram[1] += seconds
+                self._rolling[key].observe(seconds, now)
+
+    def render(self):
+        """The metrics in the Prometheus text exposition format."""
+        now = self.clock()
+        window = f"{self.window:g}"
+        lines = [
+            "# HELP tapedeck_requests_total Proxied requests by route and response status.",
+            "# TYPE tapedeck_requests_total counter",
+        ]
+        with self._lock:
+            for (method, route, status), count in sorted(self._requests.items()):
+                lines.append(f"tapedeck_requests_total{_labels(method=method, route=route, status=status)} {count}")
+
+            lines += [
+                "# HELP tapedeck_phase_duration_seconds Time spent in each phase of a proxied request.",
+                "# TYPE tapedeck_phase_duration_seconds histogram",
+            ]
+            for (method, route, phase), (counts, total) in sorted(self._histograms.items()):
+                cumulative = 0
+                for bound, count in zip(list(self.buckets) + ["+Inf"], counts):
+                    cumulative += count
+                    le = bound if isinstance(bound, str) else f"{bound:g}"
+                    labels = _labels(method=method, route=route, phase=phase, le=le)
+                    lines.append(f"tapedeck_phase_duration_seconds_bucket{labels} {cumulative}")
+                labels = _labels(method=method, route=route, phase=phase)
+                lines.append(f"tapedeck_phase_duration_seconds_sum{labels} {total:.6f}")
+                lines.append(f"tapedeck_phase_duration_seconds_count{labels} {cumulative}")
+
+            lines += [
+                f"# HELP tapedeck_recent_phase_duration_seconds Phase durations over the last {window} seconds.",
+                "# TYPE tapedeck_recent_phase_duration_seconds summary",
+            ]
+            throughput = []
+            for (method, route, phase), rolling in sorted(self._rolling.items()):
+                counts, total, count = rolling.snapshot(now)
+                for q in self.QUANTILES:
+                    value = rolling.quantile(q, counts)
+                    labels = _labels(method=method, route=route, phase=phase, quantile=f"{q:g}")
+                    lines.append(f"tapedeck_recent_phase_duration_seconds{labels} {'NaN' if value is None else f'{value:.6f}'}")
+                labels = _labels(method=method, route=route, phase=phase)
+                lines.append(f"tapedeck_recent_phase_duration_seconds_sum{labels} {total:.6f}")
+                lines.append(f"tapedeck_recent_phase_duration_seconds_count{labels} {count}")
+                if phase == "total":
+                    throughput.append((method, route, count / self.window))
+
+        lines += [
+            f"# HELP tapedeck_recent_requests_per_second Proxied requests per second over the last {window} seconds.",
+            "# TYPE tapedeck_recent_requests_per_second gauge",
+        ]
+        for method, route, rate in throughput:
+            lines.append(f"tapedeck_recent_requests_per_second{_labels(method=method, route=route)} {rate:.6f}")
+        return "\n".join(lines) + "\n"
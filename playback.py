@@ -0,0 +1,75 @@
+import hashlib
+from urllib.parse import parse_qsl, urlencode
+
+
+class MatchRules:
+    """Decides which parts of a request identify a recorded exchange.
+
+    The path is always matched. The method and query string are matched
+    unless switched off, with ``ignore_params`` left out of the query (cache
+    busters, timestamps). With ``body`` set, a hash of the request body must
+    match as well.
+    """
+
+    def __init__(self, method=True, query=True, body=False, ignore_params=()):
+        self.method = method
+        self.query = query
+        self.body = body
+        self.ignore_params = frozenset(ignore_params)
+
+    def key(self, method, path, query, data):
+        """Build the lookup key for a request; ``data`` is the body as a string or bytes."""
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        return (
+            method.upper() if self.method else None,
+            path.lstrip("/"),
+            self._normalize_query(query) if self.query else None,
+            hashlib.sha256(data).hexdigest() if self.body and data else None,
+        )
+
+    def _normalize_query(self, query):
+        params = [
+            (name, value)
+            for name, value in parse_qsl(query, keep_blank_values=True)
+            if name not in self.ignore_params
+        ]
+        return urlencode(sorted(params))
+
+
+class PlaybackIndex:
+    """Maps request keys to the sequence number of the newest matching recording.
+
+    Built once from the tape and kept current through
+    ``HistoryManager.add_listener``, so a lookup is a single dict access.
+    """
+
+    MISS_POLICIES = ("404", "passthrough", "record")
+
+    def __init__(self, rules=None):
+        self.rules = rules or MatchRules()
+        self._index = {}
+        self.hits = 0
+        self.misses = 0
+
+    def build(self, items):
+        """Index (seq, entry) pairs, e.g. from ``HistoryManager.items()``."""
+        for seq, entry in items:
+            self.add(seq, entry)
+
+    def add(self, seq, entry):
+        if entry.response_size is not None and entry.response_body_path is None:
+            return  # only part of the body was recorded; it can't be played back
+        self._index[self.rules.key(entry.method, entry.path, entry.query, entry.data)] = seq
+
+    def lookup(self, method, path, query, data):
+        """Return the sequence number of the matching recording, or None."""
+        seq = self._index.get(self.rules.key(method, path, query, data))
+        if seq is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return seq
+
+    def __len__(self):
+        return len(self._index)
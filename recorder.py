@@ -0,0 +1,179 @@
+from collections import deque
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from history import decode_body
+
+
+class BodyRecorder:
+    """Collects a streamed response body for the tape while it is sent to the client.
+
+    At most ``limit`` bytes are kept in memory (no limit if None). Past that the
+    body is either cut off (``overflow="truncate"``) or moved to a file in
+    ``spill_dir`` that keeps receiving the rest of the stream
+    (``overflow="spill"``).
+    """
+
+    def __init__(self, limit=None, overflow="truncate", spill_dir=None):
+        if overflow not in ("truncate", "spill"):
+            raise ValueError(f"Unknown overflow policy: {overflow!r}")
+        self.limit = limit
+        self.overflow = overflow
+        self.spill_dir = spill_dir
+        self.size = 0
+        self.truncated = False
+        self.spill_path = None
+        self._buffer = bytearray()
+        self._spill = None
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self._spill is not None:
+            self._spill.write(chunk)
+        elif self.limit is None or len(self._buffer) + len(chunk) <= self.limit:
+            self._buffer.extend(chunk)
+        elif self.overflow == "spill":
+            if self.spill_dir:
+                os.makedirs(self.spill_dir, exist_ok=True)
+            self._spill = tempfile.NamedTemporaryFile(
+                dir=self.spill_dir, prefix="body-", suffix=".bin", delete=False
+            )
+            self.spill_path = self._spill.name
+            self._spill.write(self._buffer)
+            self._spill.write(chunk)
+            self._buffer = bytearray()
+        elif not self.truncated:
+            self._buffer.extend(chunk[: self.limit - len(self._buffer)])
+            self.truncated = True
+
+    def close(self):
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+    def body(self):
+        """The recorded (possibly partial) body: text if it is valid UTF-8, bytes otherwise."""
+        return decode_body(bytes(self._buffer))
+
+
+class BackgroundRecorder:
+    """Takes recording off the request path.
+
+    ``submit`` puts an entry on a bounded in-memory queue; a writer thread
+    drains it in batches of up to ``batch_size`` into ``HistoryManager.extend``.
+    When the queue is full, ``policy`` decides what gives:
+
+    - ``"block"``: the submitting request waits for room.
+    - ``"drop-oldest"``: the oldest queued entry is discarded.
+    - ``"sample"``: once the queue is half full only every ``sample_every``-th
+      entry is queued, and entries arriving at a full queue are dropped.
+    """
+
+    POLICIES = ("block", "drop-oldest", "sample")
+
+    def __init__(self, history_manager, max_size=10000, policy="block", batch_size=256, sample_every=10):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown backpressure policy: {policy!r}")
+        self.history_manager = history_manager
+        self.max_size = max_size
+        self.policy = policy
+        self.batch_size = batch_size
+        self.sample_every = sample_every
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._closed = False
+        self._busy = False
+        self._offered = 0
+        self._submitted = 0
+        self._recorded = 0
+        self._dropped = 0
+        self._batches = 0
+        self._errors = 0
+        self._thread = threading.Thread(target=self._run, name="tape-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, entry):
+        """Queue an entry for recording; returns False if it was dropped."""
+        with self._lock:
+            self._offered += 1
+            if self.policy == "block":
+                while len(self._queue) >= self.max_size and not self._closed:
+                    self._not_full.wait()
+            elif self.policy == "drop-oldest":
+                if len(self._queue) >= self.max_size:
+                    self._queue.popleft()
+                    self._dropped += 1
+            elif len(self._queue) >= self.max_size or (
+                len(self._queue) >= self.max_size // 2 and self._offered % self.sample_every
+            ):
+                self._dropped += 1
+                return False
+            if self._closed:
+                self._dropped += 1
+                return False
+            self._queue.append(entry)
+            self._submitted += 1
+            self._not_empty.notify()
+            return True
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._queue and not self._closed:
+                    self._not_empty.wait()
+                if not self._queue:
+                    return
+                batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+                self._busy = True
+                self._not_full.notify_all()
+            try:
+                self.history_manager.extend(batch)
+            except Exception:
+                logging.exception("Failed to record %d history entries", len(batch))
+                with self._lock:
+                    self._errors += len(batch)
+            else:
+                with self._lock:
+                    self._recorded += len(batch)
+                    self._batches += 1
+            finally:
+                with self._lock:
+                    self._busy = False
+                    self._not_full.notify_all()
+
+    def flush(self, timeout=None):
+        """Wait until everything queued so far has been written."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while self._queue or self._busy:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._not_full.wait(remaining)
+        return True
+
+    def close(self):
+        """Write out the queue and stop the writer thread."""
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+        self._thread.join()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "policy": self.policy,
+                "queue_depth": len(self._queue),
+                "max_size": self.max_size,
+                "submitted": self._submitted,
+                "recorded": self._recorded,
+                "dropped": self._dropped,
+                "failed": self._errors,
+                "batches": self._batches,
+            }
@@ -0,0 +1,190 @@
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+import math
+import threading
+import time
+
+from diff import ResponseDiffer
+from history import HistoryEntry
+from metrics import route_template
+
+# Upper bounds, in milliseconds, of the latency histogram buckets.
+LATENCY_BUCKETS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+DEFAULT_DIFFER = ResponseDiffer()
+
+
+def diff_responses(recorded, replayed, differ=None):
+    """Compare a replayed HistoryEntry with the recording; an empty dict means they match.
+
+    ``differ`` is a ResponseDiffer with ignore rules; without one only
+    VOLATILE_HEADERS are ignored.
+    """
+    return (differ or DEFAULT_DIFFER).diff(recorded, replayed)
+
+
+class RateLimiter:
+    """Spaces calls to ``wait`` at least ``1 / rate`` seconds apart."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next = time.monotonic()
+
+    def wait(self):
+        now = time.monotonic()
+        slot = max(self._next, now)
+        self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class BatchReplay:
+    """Re-sends recorded requests and compares the responses with the recordings.
+
+    ``send(entry)`` sends one recorded request and returns a requests
+    Response. At most ``concurrency`` requests are in flight, and at most
+    ``rate`` are started per second. With ``timing="recorded"`` requests
+    start with the gaps they were recorded with, divided by ``speed``;
+    ``"fast"`` sends them as soon as a worker is free. Responses are diffed
+    against the recordings with ``differ`` (a ResponseDiffer), or not at all
+    without ``compare``, e.g. for load tests.
+    """
+
+    TIMINGS = ("fast", "recorded")
+
+    def __init__(self, send, concurrency=8, rate=None, timing="fast", speed=1.0, compare=True, differ=None):
+        if timing not in self.TIMINGS:
+            raise ValueError(f"Unknown timing: {timing!r}")
+        if concurrency < 1 or (rate is not None and rate <= 0) or speed <= 0:
+            raise ValueError("concurrency, rate and speed must be positive")
+        self.send = send
+        self.concurrency = concurrency
+        self.rate = rate
+        self.timing = timing
+        self.speed = speed
+        self.compare = compare
+        self.differ = differ or DEFAULT_DIFFER
+
+    def run(self, entries):
+        """Replay ``entries`` in order and return one result dict per entry, in the same order."""
+        entries = list(entries)
+        slots = threading.Semaphore(self.concurrency)
+        limiter = RateLimiter(self.rate) if self.rate else None
+        futures = []
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="replay") as pool:
+            for entry in entries:
+                if self.timing == "recorded":
+                    offset = (entry.timestamp - entries[0].timestamp).total_seconds() / self.speed
+                    delay = start + offset - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                if limiter is not None:
+                    limiter.wait()
+                slots.acquire()  # don't queue work whose start time would then drift
+                future = pool.submit(self.replay_one, entry)
+                future.add_done_callback(lambda _: slots.release())
+                futures.append(future)
+        return [future.result() for future in futures]
+
+    def replay_one(self, entry):
+        result = {
+            "id": entry.id,
+            "method": entry.method,
+            "path": entry.path,
+            "recorded_status": entry.status_code,
+        }
+        started = time.perf_counter()
+        try:
+            response = self.send(entry)
+        except Exception as e:
+            result["latency_ms"] = round((time.perf_counter() - started) * 1000, 3)
+            result["error"] = f"{type(e).__name__}: {e}"
+            result["match"] = False
+            return result
+        result["latency_ms"] = round((time.perf_counter() - started) * 1000, 3)
+        result["status_code"] = response.status_code
+        if self.compare:
+            result["diff"] = self.differ.diff(entry, HistoryEntry.from_response(response))
+            result["match"] = not result["diff"]
+        return result
+
+
+def summarize(results):
+    """Totals and latency of a batch replay."""
+    latencies = [result["latency_ms"] for result in results if "error" not in result]
+    errors = sum(1 for result in results if "error" in result)
+    matched = sum(1 for result in results if result["match"])
+    return {
+        "total": len(results),
+        "matched": matched,
+        "mismatched": len(results) - matched - errors,
+        "errors": errors,
+        "mean_latency_ms": round(sum(latencies) / len(latencies), 3) if latencies else None,
+        "max_latency_ms": max(latencies) if latencies else None,
+    }
+
+
+def endpoint_key(method, path):
+    """Group requests by endpoint: ``GET /orders/{id}`` for ``GET orders/42``."""
+    return f"{method.upper()} {route_template(path)}"
+
+
+def percentile(ordered, q):
+    """Nearest-rank percentile of an ascending list."""
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+def latency_stats(latencies):
+    ordered = sorted(latencies)
+    if not ordered:
+        return None
+    return {
+        "mean": round(sum(ordered) / len(ordered), 3),
+        "p50": percentile(ordered, 50),
+        "p95": percentile(ordered, 95),
+        "p99": percentile(ordered, 99),
+        "max": ordered[-1],
+    }
+
+
+def latency_histogram(latencies):
+    """Requests per latency bucket, as ``[{"le": bound_ms, "count": n}, ...]`` ending with "+Inf"."""
+    counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+    for latency in latencies:
+        counts[bisect_left(LATENCY_BUCKETS_MS, latency)] += 1
+    bounds = list(LATENCY_BUCKETS_MS) + ["+Inf"]
+    return [{"le": bound, "count": count} for bound, count in zip(bounds, counts)]
+
+
+def load_report(results, duration, target_rate=None):
+    """Throughput, error rate and latency of a load test, overall and per endpoint.
+
+    A request counts as an error if it failed to get a response or got a 5xx.
+    """
+
+    def stats(group):
+        latencies = [result["latency_ms"] for result in group if "error" not in result]
+        errors = sum(1 for result in group if "error" in result or result["status_code"] >= 500)
+        statuses = {}
+        for result in group:
+            status = f"{result['status_code'] // 100}xx" if "status_code" in result else "failed"
+            statuses[status] = statuses.get(status, 0) + 1
+        return {
+            "requests": len(group),
+            "throughput_rps": round(len(group) / duration, 3) if duration else None,
+            "errors": errors,
+            "error_rate": round(errors / len(group), 4) if group else 0.0,
+            "statuses": dict(sorted(statuses.items())),
+            "latency_ms": latency_stats(latencies),
+            "histogram": latency_histogram(latencies),
+        }
+
+    endpoints = {}
+    for result in results:
+        endpoints.setdefault(endpoint_key(result["method"], result["path"]), []).append(result)
+    report = stats(results)
+    report["duration_s"] = round(duration, 3)
+    report["target_rps"] = round(target_rate, 3) if target_rate else None
+    report["endpoints"] = {key: stats(group) for key, group in sorted(endpoints.items())}
+    return report
@@ -0,0 +1,346 @@
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from datetime import timezone
+import fnmatch
+import heapq
+
+from storage import EPOCH, GLOB_CHARS, utc_naive
+
+
+def epoch_seconds(timestamp):
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return (timestamp - EPOCH).total_seconds()
+
+
+class HistoryQuery:
+    """Filters for a /__/history request.
+
+    - ``methods``: allowed methods (any if empty).
+    - ``path``: a path prefix, or a glob if it contains ``*``, ``?`` or ``[``.
+    - ``status_min``/``status_max``: inclusive status code range.
+    - ``since``/``until``: inclusive time window, as naive UTC datetimes.
+    - ``headers``: (name, value) pairs a request or response header must match;
+      a value of None only requires the header to be present.
+    - ``body``: substring of the request or response body.
+    """
+
+    PARAMS = ("method", "path", "status", "since", "until", "header", "body")
+
+    def __init__(
+        self,
+        methods=(),
+        path=None,
+        status_min=None,
+        status_max=None,
+        since=None,
+        until=None,
+        headers=(),
+        body=None,
+    ):
+        self.methods = frozenset(method.upper() for method in methods)
+        self.path = path.lstrip("/") if path else None
+        self.path_is_glob = bool(self.path and GLOB_CHARS.search(self.path))
+        self.status_min = status_min
+        self.status_max = status_max
+        self.since = since
+        self.until = until
+        self.headers = [(name.lower(), value) for name, value in headers]
+        self.body = body
+
+    @classmethod
+    def from_args(cls, args):
+        """Parse query parameters given as a mapping of name to list of values.
+
+        Returns None when no filter is set; raises ValueError for malformed values.
+        """
+        if not any(args.get(name) for name in cls.PARAMS):
+            return None
+        methods = [m.strip() for value in args.get("method", ()) for m in value.split(",") if m.strip()]
+        status_min = status_max = None
+        if args.get("status"):
+            status_min, status_max = cls.parse_status(args["status"][-1])
+        headers = []
+        for value in args.get("header", ()):
+            name, sep, header_value = value.partition(":")
+            if not name.strip():
+                raise ValueError(f"Invalid header filter: {value!r}")
+            headers.append((name.strip(), header_value.strip() if sep else None))
+        return cls(
+            methods=methods,
+            path=args["path"][-1] if args.get("path") else None,
+            status_min=status_min,
+            status_max=status_max,
+            since=cls.parse_time(args["since"][-1]) if args.get("since") else None,
+            until=cls.parse_time(args["until"][-1]) if args.get("until") else None,
+            headers=headers,
+            body=args["body"][-1] if args.get("body") else None,
+        )
+
+    @staticmethod
+    def parse_status(value):
+        """Accept ``404``, ``5xx`` or ``500-599``."""
+        try:
+            if value.lower().endswith("xx") and len(value) == 3:
+                low = int(value[0]) * 100
+                return low, low + 99
+            low, _, high = value.partition("-")
+            return int(low), int(high or low)
+        except ValueError:
+            raise ValueError(f"Invalid status filter: {value!r}") from None
+
+    @staticmethod
+    def parse_time(value):
+        try:
+            return utc_naive(value)
+        except ValueError:
+            raise ValueError(f"Invalid timestamp: {value!r}") from None
+
+    def match_path(self, path):
+        path = path.lstrip("/")
+        if self.path_is_glob:
+            return fnmatch.fnmatchcase(path, self.path)
+        return path.startswith(self.path)
+
+    def match_status(self, status_code):
+        return (self.status_min is None or status_code >= self.status_min) and (
+            self.status_max is None or status_code <= self.status_max
+        )
+
+    def matches(self, entry):
+        """Check every filter against a decoded entry."""
+        if self.methods and entry.method.upper() not in self.methods:
+            return False
+        if self.path is not None and not self.match_path(entry.path):
+            return False
+        if not self.match_status(entry.status_code):
+            return False
+        if self.since is not None or self.until is not None:
+            seconds = epoch_seconds(entry.timestamp)
+            if self.since is not None and seconds < epoch_seconds(self.since):
+                return False
+            if self.until is not None and seconds > epoch_seconds(self.until):
+                return False
+        for name, value in self.headers:
+            if not any(
+                k.lower() == name and (value is None or v == value)
+                for headers in (entry.headers, entry.response_headers)
+                for k, v in headers.items()
+            ):
+                return False
+        if self.body is not None:
+            needle = self.body.encode("utf-8")
+            if not any(
+                needle in (body if isinstance(body, bytes) else body.encode("utf-8"))
+                for body in (entry.data, entry.response_body)
+                if body
+            ):
+                return False
+        return True
+
+
+class HistoryIndex:
+    """Secondary indexes over the live tape for filtered history queries.
+
+    For every entry the method, path, status code and timestamp are kept in
+    compact columns, and every distinct method, path and status code has a
+    posting list of the sequence numbers it occurs at. Distinct paths and
+    status codes are also kept sorted, so the values matching a path prefix
+    or status range are found by bisecting. A query walks the
+    shortest posting list that applies (or the whole range) and checks the
+    columns, so entries are only decoded once they are known to match
+    everything but header and body filters.
+    """
+
+    def __init__(self):
+        self._base = 0  # sequence number of the first indexed entry
+        self._methods = array("H")
+        self._paths = array("I")
+        self._statuses = array("H")
+        self._timestamps = array("d")
+        self._peak = array("d")  # running maximum of the timestamps, for bisecting on ``since``
+        self._method_ids = {}
+        self._path_ids = {}
+        self._sorted_paths = []  # distinct paths in sorted order, so a prefix is a bisect range
+        self._statuses_seen = []  # distinct live status codes, sorted
+        self._postings = {"method": {}, "path": {}, "status": {}}  # kind -> value -> array of sequence numbers
+
+    def __len__(self):
+        return len(self._methods)
+
+    def _intern(self, ids, value, names=None):
+        key = ids.get(value)
+        if key is None:
+            key = ids[value] = len(ids)
+            if names is not None:
+                insort(names, value)
+        return key
+
+    def add(self, seq, entry):
+        """Index an entry; entries must be added in sequence order."""
+        if not self._methods:
+            self._base = seq
+        method = self._intern(self._method_ids, entry.method.upper())
+        path = self._intern(self._path_ids, entry.path.lstrip("/"), self._sorted_paths)
+        self._methods.append(method)
+        self._paths.append(path)
+        self._statuses.append(entry.status_code)
+        seconds = epoch_seconds(entry.timestamp)
+        self._timestamps.append(seconds)
+        self._peak.append(max(seconds, self._peak[-1]) if self._peak else seconds)
+        if entry.status_code not in self._postings["status"]:
+            insort(self._statuses_seen, entry.status_code)
+        for kind, value in (("method", method), ("path", path), ("status", entry.status_code)):
+            self._postings[kind].setdefault(value, array("Q")).append(seq)
+
+    def discard_before(self, seq):
+        """Forget entries evicted from the live tape."""
+        drop = min(seq - self._base, len(self._methods))
+        if drop <= 0:
+            return
+        for column in (self._methods, self._paths, self._statuses, self._timestamps, self._peak):
+            del column[:drop]
+        self._base = seq
+        for kind, by_value in self._postings.items():
+            for value, postings in list(by_value.items()):
+                del postings[: bisect_left(postings, seq)]
+                if not postings:
+                    del by_value[value]
+                    if kind == "status":
+                        self._statuses_seen.remove(value)
+
+    def scan(self, query, start, stop, reverse=False):
+        """Yield the sequence numbers in [start, stop) whose indexed columns match ``query``."""
+        start = max(start, self._base)
+        stop = min(stop, self._base + len(self._methods))
+        if query.since is not None:
+            start = max(start, self._base + bisect_left(self._peak, epoch_seconds(query.since)))
+        if start >= stop:
+            return
+
+        methods = None
+        if query.methods:
+            methods = {self._method_ids[m] for m in query.methods if m in self._method_ids}
+        paths = None
+        if query.path is not None:
+            paths = {self._path_ids[name] for name in self._matching_paths(query)}
+        statuses = None
+        if query.status_min is not None or query.status_max is not None:
+            codes = self._statuses_seen
+            low = 0 if query.status_min is None else bisect_left(codes, query.status_min)
+            high = len(codes) if query.status_max is None else bisect_right(codes, query.status_max)
+            statuses = set(codes[low:high])
+
+        driver = None
+        for kind, values in (("method", methods), ("path", paths), ("status", statuses)):
+            if values is None:
+                continue
+            by_value = self._postings[kind]
+            postings = [by_value[value] for value in values if value in by_value]
+            total = sum(len(p) for p in postings)
+            if driver is None or total < driver[0]:
+                driver = (total, postings)
+        if driver is None or driver[0] >= stop - start:
+            seqs = range(stop - 1, start - 1, -1) if reverse else range(start, stop)
+        else:
+            ranges = [(p, bisect_left(p, start), bisect_left(p, stop)) for p in driver[1]]
+            if reverse:
+                seqs = heapq.merge(*(reversed(p[lo:hi]) for p, lo, hi in ranges), reverse=True)
+            else:
+                seqs = heapq.merge(*(p[lo:hi] for p, lo, hi in ranges))
+
+        since = epoch_seconds(query.since) if query.since is not None else None
+        until = epoch_seconds(query.until) if query.until is not None else None
+        for seq in seqs:
+            position = seq - self._base
+            if methods is not None and self._methods[position] not in methods:
+                continue
+            if paths is not None and self._paths[position] not in paths:
+                continue
+            if statuses is not None and self._statuses[position] not in statuses:
+                continue
+            seconds = self._timestamps[position]
+            if (since is not None and seconds < since) or (until is not None and seconds > until):
+                continue
+            yield seq
+
+    def _matching_paths(self, query):
+        """The indexed paths matching the query's path filter, found by bisecting on its literal prefix."""
+        glob = GLOB_CHARS.search(query.path) if query.path_is_glob else None
+        prefix = query.path[: glob.start()] if glob else query.path
+        names = self._sorted_paths
+        for position in range(bisect_left(names, prefix), len(names)):
+            name = names[position]
+            if not name.startswith(prefix):
+                break
+            if glob is None or query.match_path(name):
+                yield name
+
+
+class SignatureIndex:
+    """Distinct exchanges on the live tape, keyed by ``HistoryEntry.signature()``.
+
+    Each entry's signature is interned to a small id. Per id the index keeps
+    the first live occurrence and the number of occurrences, and the
+    sequence numbers of first occurrences are kept sorted, so a page of
+    unique entries is a bisect away. Evicting entries rebuilds the index from
+    the signatures still on the tape.
+    """
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        self._base = 0
+        self._entry_ids = array("I")  # signature id of every entry
+        self._ids = {}  # signature -> id
+        self._signatures = []  # id -> signature
+        self._first = array("Q")  # id -> sequence number of the first occurrence
+        self._counts = array("Q")  # id -> occurrences
+        self._unique = array("Q")  # first occurrences, ascending
+
+    def __len__(self):
+        return len(self._signatures)
+
+    def add(self, seq, signature):
+        """Index an entry's signature; entries must be added in sequence order."""
+        if not self._entry_ids:
+            self._base = seq
+        key = self._ids.get(signature)
+        if key is None:
+            key = self._ids[signature] = len(self._signatures)
+            self._signatures.append(signature)
+            self._first.append(seq)
+            self._counts.append(0)
+            self._unique.append(seq)
+        self._counts[key] += 1
+        self._entry_ids.append(key)
+
+    def discard_before(self, seq):
+        """Forget entries evicted from the live tape."""
+        drop = min(seq - self._base, len(self._entry_ids))
+        if drop <= 0:
+            return
+        live = [self._signatures[key] for key in self._entry_ids[drop:]]
+        self._reset()
+        for position, signature in enumerate(live, seq):
+            self.add(position, signature)
+
+    def is_first(self, seq):
+        """Whether the entry at ``seq`` is the first occurrence of its exchange."""
+        return self._first[self._entry_ids[seq - self._base]] == seq
+
+    def count(self, signature):
+        """How many times an exchange occurs on the live tape."""
+        key = self._ids.get(signature)
+        return 0 if key is None else self._counts[key]
+
+    def page(self, limit, after=None, before=None):
+        """Sequence numbers of up to ``limit`` first occurrences, paged like ``HistoryManager.page``."""
+        if before is not None:
+            end = bisect_left(self._unique, before)
+            start = max(end - limit, 0)
+        else:
+            start = 0 if after is None else bisect_right(self._unique, after)
+            end = start + limit
+        return list(self._unique[start:end])
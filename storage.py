@@ -0,0 +1,1253 @@
+from array import array
+import base64
+from bisect import bisect_right
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+import json
+import os
+import re
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # zstandard is an optional dependency
+    zstandard = None
+
+EPOCH = datetime(1970, 1, 1)
+GLOB_CHARS = re.compile(r"[*?\[]")
+
+
+def utc_naive(timestamp):
+    """Parse an ISO timestamp into a naive UTC datetime, like ``datetime.utcnow()``."""
+    parsed = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def _json_default(value):
+    if isinstance(value, bytes):
+        return {"$bytes": base64.b64encode(value).decode("ascii")}
+    return str(value)
+
+
+def _json_object_hook(obj):
+    if len(obj) == 1 and "$bytes" in obj:
+        return base64.b64decode(obj["$bytes"])
+    return obj
+
+
+def dumps_record(record):
+    """Encode a record as JSON; bytes values become ``{"$bytes": <base64>}``."""
+    return json.dumps(record, default=_json_default)
+
+
+def loads_record(data):
+    """Decode a record written by ``dumps_record``."""
+    return json.loads(data, object_hook=_json_object_hook)
+
+
+class Storage:
+    """Base class of the tape backends used by HistoryManager.
+
+    Backends store plain record dicts (``HistoryEntry.to_dict()`` output, with
+    bodies as str or bytes, or replaced by blob references), so they never need
+    to know about HistoryEntry. Records are numbered by sequence number in the order
+    they were appended. Backends that support lazy loading also implement
+    ``load_index``, ``count``, ``read`` and ``ids``. Backends that keep their
+    own indexes set ``indexed`` and implement ``find``, ``unique_seqs``,
+    ``occurrences`` and ``scan``, which HistoryManager then queries instead
+    of building indexes in memory. Backends that can only replace the whole
+    tape set ``rewrite_only``; HistoryManager then hands ``rewrite`` every
+    record on each append rather than calling ``extend``.
+    """
+
+    indexed = False
+    rewrite_only = False
+
+    def load(self):
+        """Return every live record, oldest first."""
+        raise NotImplementedError
+
+    def append(self, record):
+        self.extend([record])
+
+    def extend(self, records):
+        """Append records. Storages shared between processes return the records
+        other processes appended since the last ``refresh``, which precede these."""
+        raise NotImplementedError
+
+    def refresh(self):
+        """Return the records other processes sharing the storage have appended since the last call."""
+        return []
+
+    def rewrite(self, records):
+        """Replace all live records with ``records``."""
+        raise NotImplementedError
+
+    def needs_compaction(self):
+        return False
+
+    def first_seq(self):
+        """Sequence number of the oldest live record."""
+        return 0
+
+    def oldest_seq(self):
+        """Sequence number of the oldest record that can still be read, archived or not."""
+        return self.first_seq()
+
+    def read_archived(self, seq):
+        """Decode a record that has been moved out of the live tape."""
+        raise IndexError(f"record {seq} is no longer stored")
+
+    def pop_evicted_ids(self):
+        """Return (and forget) the ids of records evicted since the last call."""
+        return []
+
+    def pop_deleted_bodies(self):
+        """Return (and forget) the blob keys and spill file paths of records deleted since the last call.
+
+        A blob key is listed once per deleted record referencing it.
+        """
+        return [], []
+
+    def sync(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class JsonStorage(Storage):
+    """The original tape format: a single JSON array rewritten on every append.
+
+    Each rewrite goes to a temporary file that atomically replaces the tape,
+    so readers and crashes never see a half-written file. Records aren't
+    kept in memory; HistoryManager re-serializes its entries on every write.
+    """
+
+    rewrite_only = True
+
+    def __init__(self, path="tape.json"):
+        self.path = path
+
+    def load(self):
+        """Return the list of record dicts stored in the tape."""
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, "r") as file:
+            return json.load(file, object_hook=_json_object_hook)
+
+    def extend(self, records):
+        self.rewrite(self.load() + list(records))
+
+    def rewrite(self, records):
+        """Write the whole tape to a temporary file and swap it into place."""
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(list(records), file, default=_json_default)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.path)
+
+
+class JournalStorage(Storage):
+    """Append-only JSON Lines tape.
+
+    Each append writes a single line, so it costs O(1) no matter how long the
+    tape is. Writes are flushed to the OS immediately and fsync'd, along with
+    the index, every ``fsync_every`` records or ``fsync_interval`` seconds
+    after the first unsynced one (by a timer when appends stop). A process
+    crash loses at most the record being written, a system crash at most
+    that window. A torn trailing line is truncated away on load; unparseable
+    lines are skipped and reclaimed by compaction.
+
+    The byte offset of every record is kept in a sidecar index file
+    (``<path>.idx``, an array of little-endian uint64) and its id in
+    ``<path>.ids`` (one per line). ``load_index`` opens the tape from those
+    files without decoding any records, appending to them only the records
+    written after they were last saved, and ``read`` decodes a single record
+    on demand. The ids are held in memory.
+    """
+
+    SUFFIX = ".jsonl"
+
+    def __init__(self, path="tape.jsonl", fsync_every=64, fsync_interval=1.0, compact_ratio=0.5):
+        self.path = path
+        self.index_path = f"{path}.idx"
+        self.ids_path = f"{path}.ids"
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.compact_ratio = compact_ratio
+        self._file = None
+        self._reader = None
+        self._offsets = array("Q")
+        self._ids = []
+        self._indexed = 0  # number of offsets already written to the index file
+        self._size = 0
+        self._dead_bytes = 0
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._timer = None  # fsyncs the records of an idle journal
+        self._lock = threading.RLock()
+
+    def load(self):
+        """Read every intact record, dropping a torn tail left by a crash."""
+        records = []
+        self._offsets = array("Q")
+        self._ids = []
+        self._dead_bytes = 0
+        self._scan(0, records)
+        self._write_index(truncate=True)
+        self._open()
+        return records
+
+    def load_index(self):
+        """Open the tape from its offset index and return the record count.
+
+        Only the part of the tape written after the index was last saved is
+        read back; the rest of the tape is never decoded.
+        """
+        self._offsets, self._ids, ids_size = self._read_index()
+        self._dead_bytes = 0
+        # Re-scan from the last indexed record so a torn tail is still caught.
+        start = 0
+        if self._offsets:
+            start = self._offsets.pop()
+            ids_size -= len((self._ids.pop() or "").encode("utf-8")) + 1
+        self._indexed = len(self._offsets)
+        if self._indexed:
+            # Keep the index files' intact prefix and only append what the scan finds.
+            with open(self.ids_path, "r+b") as file:
+                file.truncate(ids_size)
+            with open(self.index_path, "r+b") as file:
+                file.truncate(self._indexed * self._offsets.itemsize)
+        self._scan(start, None)
+        self._write_index()
+        self._open()
+        return len(self._offsets)
+
+    def _read_index(self):
+        """Return the indexed offsets and ids, and the size of the ids file's matching prefix."""
+        offsets = array("Q")
+        paths = (self.path, self.index_path, self.ids_path)
+        if not all(os.path.exists(path) for path in paths):
+            return offsets, [], 0
+        with open(self.index_path, "rb") as file:
+            raw = file.read()
+        offsets.frombytes(raw[: len(raw) - len(raw) % offsets.itemsize])
+        if sys.byteorder != "little":
+            offsets.byteswap()
+        with open(self.ids_path, "rb") as file:
+            raw_ids = file.read()
+        ids = raw_ids.decode("utf-8").split("\n")[:-1]
+        if len(ids) < len(offsets):
+            del offsets[len(ids):]
+        del ids[len(offsets):]
+        size = os.path.getsize(self.path)
+        while offsets and offsets[-1] >= size:
+            offsets.pop()
+            ids.pop()
+        # An index that doesn't line up with record boundaries is stale.
+        if offsets and offsets[-1] > 0:
+            with open(self.path, "rb") as file:
+                file.seek(offsets[-1] - 1)
+                if file.read(1) != b"\n":
+                    return array("Q"), [], 0
+        ids_size = len(raw_ids) - len(raw_ids.split(b"\n", len(offsets))[-1]) if offsets else 0
+        return offsets, [entry_id or None for entry_id in ids], ids_size
+
+    def _scan(self, start, records):
+        """Index the records from byte ``start`` on, collecting them into ``records`` if given."""
+        self._size = start
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as file:
+            file.seek(start)
+            for line in file:
+                if not line.endswith(b"\n"):
+                    break  # partial record from an interrupted write
+                try:
+                    record = loads_record(line)
+                except ValueError:
+                    self._dead_bytes += len(line)
+                else:
+                    self._offsets.append(self._size)
+                    self._ids.append(record.get("id"))
+                    if records is not None:
+                        records.append(record)
+                self._size += len(line)
+        if os.path.getsize(self.path) > self._size:
+            with open(self.path, "r+b") as file:
+                file.truncate(self._size)
+
+    def _write_index(self, truncate=False):
+        start = 0 if truncate else self._indexed
+        mode = "ab" if start else "wb"
+        pending = self._offsets[start:]
+        if sys.byteorder != "little":
+            pending.byteswap()
+        # ids first: a crash between the two writes leaves extra ids, which
+        # _read_index trims, rather than offsets without ids.
+        with open(self.ids_path, mode) as file:
+            file.write("".join(f"{entry_id or ''}\n" for entry_id in self._ids[start:]).encode("utf-8"))
+        with open(self.index_path, mode) as file:
+            pending.tofile(file)
+        self._indexed = len(self._offsets)
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.path, "ab")
+        if self._reader is None:
+            self._reader = open(self.path, "rb")
+
+    def count(self):
+        return len(self._offsets)
+
+    def ids(self):
+        """Return the id of every record, in tape order."""
+        return self._ids
+
+    def read(self, index):
+        """Decode the record at position ``index``."""
+        start = self._offsets[index]
+        end = self._offsets[index + 1] if index + 1 < len(self._offsets) else self._size
+        return loads_record(os.pread(self._reader.fileno(), end - start, start))
+
+    def size(self):
+        """Bytes of intact records in the journal."""
+        return self._size
+
+    def extend(self, records):
+        """Append a batch of records with a single write."""
+        with self._lock:
+            self._open()
+            lines = []
+            for record in records:
+                line = (dumps_record(record) + "\n").encode("utf-8")
+                lines.append(line)
+                self._offsets.append(self._size)
+                self._ids.append(record.get("id"))
+                self._size += len(line)
+            self._file.write(b"".join(lines))
+            self._file.flush()
+            self._unsynced += len(lines)
+            if (
+                self._unsynced >= self.fsync_every
+                or time.monotonic() - self._last_sync >= self.fsync_interval
+            ):
+                self.sync()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.fsync_interval, self._flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _flush(self):
+        with self._lock:
+            self._timer = None
+            self.sync()
+
+    def sync(self):
+        """Force buffered records onto disk, then save the new index entries."""
+        with self._lock:
+            if self._file is not None and self._unsynced:
+                os.fsync(self._file.fileno())
+            if self._indexed < len(self._offsets):
+                self._write_index()
+            self._unsynced = 0
+            self._last_sync = time.monotonic()
+
+    def needs_compaction(self):
+        return self._size > 0 and self._dead_bytes > self._size * self.compact_ratio
+
+    def rewrite(self, records):
+        """Atomically replace the journal with ``records``, reclaiming dead space."""
+        with self._lock:
+            tmp_path = f"{self.path}.tmp"
+            offsets = array("Q")
+            ids = []
+            size = 0
+            with open(tmp_path, "wb") as file:
+                for record in records:
+                    line = (dumps_record(record) + "\n").encode("utf-8")
+                    file.write(line)
+                    offsets.append(size)
+                    ids.append(record.get("id"))
+                    size += len(line)
+                file.flush()
+                os.fsync(file.fileno())
+            self.close()
+            os.replace(tmp_path, self.path)
+            self._offsets = offsets
+            self._ids = ids
+            self._size = size
+            self._dead_bytes = 0
+            self._write_index(truncate=True)
+            self._open()
+
+    def close(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self._file is not None:
+                self.sync()
+                self._file.close()
+                self._file = None
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
+
+
+class PackedStorage(Storage):
+    """Compact binary tape made of compressed blocks of length-prefixed records.
+
+    Bodies are kept as raw bytes next to a small JSON header instead of being
+    escaped into JSON, so binary bodies round-trip exactly. Records are
+    buffered and written as one compressed block every ``fsync_every`` records,
+    or by a timer ``fsync_interval`` seconds after the first buffered record
+    when appends stop, and then fsync'd; a crash loses the records still
+    buffered, and a torn trailing block is truncated away on load.
+
+    A block is a header (codec, section sizes, record count and CRC32), the
+    ids of its records, uncompressed, so ``load_index`` can open the tape
+    without decompressing anything, and the compressed records. ``read``
+    decompresses one block and keeps the last few in a cache. The codec is
+    recorded per block, so ``compression`` can change between runs.
+    """
+
+    MAGIC = b"TAPEPK1\n"
+    SUFFIX = ".pack"
+    CODECS = ("none", "zlib", "zstd")
+    BODY_FIELDS = ("data", "response_body")
+    _BLOCK = struct.Struct("<BIIII")  # codec, ids bytes, payload bytes, record count, crc32
+    _LENGTH = struct.Struct("<I")
+    _BODY = struct.Struct("<BI")  # kind (0: kept in the header, 1: text, 2: bytes), length
+
+    def __init__(
+        self,
+        path="tape.pack",
+        fsync_every=64,
+        fsync_interval=1.0,
+        compression="zlib",
+        level=None,
+        block_cache_size=4,
+    ):
+        if compression not in self.CODECS:
+            raise ValueError(f"Unknown compression: {compression!r}")
+        if compression == "zstd" and zstandard is None:
+            raise RuntimeError("zstd compression needs zstandard: pip install zstandard")
+        self.path = path
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.compression = compression
+        self.level = level
+        self.block_cache_size = block_cache_size
+        self._file = None
+        self._reader = None
+        self._blocks = []  # (offset of the ids section, ids bytes, payload bytes, codec, crc32) per block
+        self._block_starts = []  # position of the first record of each block
+        self._ids = []
+        self._pending = []  # packed records not yet written
+        self._pending_bytes = 0
+        self._size = 0
+        self._cache = OrderedDict()
+        self._lock = threading.RLock()
+        self._last_sync = time.monotonic()
+        self._timer = None  # writes out the pending records of an idle tape
+
+    # -- record and block encoding -------------------------------------------
+
+    @classmethod
+    def pack_record(cls, record):
+        """Encode a record as a JSON header followed by its raw bodies."""
+        header = {
+            k: v for k, v in record.items() if not (k in cls.BODY_FIELDS and isinstance(v, (str, bytes)))
+        }
+        encoded = dumps_record(header).encode("utf-8")
+        parts = [cls._LENGTH.pack(len(encoded)), encoded]
+        for field in cls.BODY_FIELDS:
+            value = record.get(field)
+            if isinstance(value, str):
+                kind, raw = 1, value.encode("utf-8")
+            elif isinstance(value, bytes):
+                kind, raw = 2, value
+            else:
+                kind, raw = 0, b""
+            parts += [cls._BODY.pack(kind, len(raw)), raw]
+        return b"".join(parts)
+
+    @classmethod
+    def unpack_record(cls, data):
+        (length,) = cls._LENGTH.unpack_from(data, 0)
+        position = cls._LENGTH.size + length
+        record = loads_record(bytes(data[cls._LENGTH.size : position]))
+        for field in cls.BODY_FIELDS:
+            kind, length = cls._BODY.unpack_from(data, position)
+            position += cls._BODY.size
+            raw = bytes(data[position : position + length])
+            position += length
+            if kind == 1:
+                record[field] = raw.decode("utf-8")
+            elif kind == 2:
+                record[field] = raw
+        return record
+
+    def _compress(self, data):
+        if self.compression == "zlib":
+            return zlib.compress(data, -1 if self.level is None else self.level)
+        if self.compression == "zstd":
+            return zstandard.ZstdCompressor(level=3 if self.level is None else self.level).compress(data)
+        return data
+
+    def _decompress(self, codec, data):
+        name = self.CODECS[codec]
+        if name == "zlib":
+            return zlib.decompress(data)
+        if name == "zstd":
+            if zstandard is None:
+                raise RuntimeError(f"{self.path} has zstd blocks; pip install zstandard to read it")
+            return zstandard.ZstdDecompressor().decompress(data)
+        return data
+
+    def _encode_block(self, packed, ids):
+        payload = self._compress(b"".join(self._LENGTH.pack(len(record)) + record for record in packed))
+        ids_section = "\n".join(entry_id or "" for entry_id in ids).encode("utf-8")
+        crc = zlib.crc32(payload, zlib.crc32(ids_section))
+        header = self._BLOCK.pack(self.CODECS.index(self.compression), len(ids_section), len(payload), len(packed), crc)
+        return header + ids_section + payload, (len(ids_section), len(payload), self.CODECS.index(self.compression), crc)
+
+    # -- loading -------------------------------------------------------------
+
+    def load(self):
+        """Decode every record, dropping a torn tail left by a crash."""
+        with self._lock:
+            self._scan()
+            self._open()
+            return [self.read(index) for index in range(len(self._ids))]
+
+    def load_index(self):
+        """Open the tape from its block headers and return the record count."""
+        with self._lock:
+            self._scan()
+            self._open()
+            return len(self._ids)
+
+    def _scan(self):
+        self._blocks, self._block_starts, self._ids = [], [], []
+        self._pending, self._pending_bytes = [], 0
+        self._cache.clear()
+        self._size = 0
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return
+        with open(self.path, "rb") as file:
+            if file.read(len(self.MAGIC)) != self.MAGIC:
+                raise ValueError(f"{self.path} is not a packed tape")
+            offset = len(self.MAGIC)
+            file_size = os.fstat(file.fileno()).st_size
+            while offset + self._BLOCK.size <= file_size:
+                file.seek(offset)
+                codec, ids_size, payload_size, count, crc = self._BLOCK.unpack(file.read(self._BLOCK.size))
+                end = offset + self._BLOCK.size + ids_size + payload_size
+                if end > file_size:
+                    break  # partial block from an interrupted write
+                ids = file.read(ids_size).decode("utf-8").split("\n") if count else []
+                self._blocks.append((offset + self._BLOCK.size, ids_size, payload_size, codec, crc))
+                self._block_starts.append(len(self._ids))
+                self._ids.extend(entry_id or None for entry_id in ids)
+                offset = end
+            # Only the last block can be half-written; check it fully.
+            if self._blocks and not self._verify(file, self._blocks[-1]):
+                offset = self._blocks[-1][0] - self._BLOCK.size
+                del self._ids[self._block_starts.pop():]
+                self._blocks.pop()
+        self._size = offset
+        if file_size > self._size:
+            with open(self.path, "r+b") as file:
+                file.truncate(self._size)
+
+    def _verify(self, file, block):
+        offset, ids_size, payload_size, codec, crc = block
+        file.seek(offset)
+        return zlib.crc32(file.read(ids_size + payload_size)) == crc
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.path, "ab")
+            if self._file.tell() == 0:
+                self._file.write(self.MAGIC)
+                self._file.flush()
+                self._size = len(self.MAGIC)
+        if self._reader is None:
+            self._reader = open(self.path, "rb")
+
+    # -- reading -------------------------------------------------------------
+
+    def count(self):
+        return len(self._ids)
+
+    def ids(self):
+        return self._ids
+
+    def size(self):
+        """Bytes written to the tape plus the packed size of buffered records."""
+        return self._size + self._pending_bytes
+
+    def read(self, index):
+        """Decode the record at position ``index``."""
+        with self._lock:
+            written = len(self._ids) - len(self._pending)
+            if index >= written:
+                return self.unpack_record(self._pending[index - written])
+            block = bisect_right(self._block_starts, index) - 1
+            return self.unpack_record(self._block_records(block)[index - self._block_starts[block]])
+
+    def _block_records(self, block):
+        records = self._cache.get(block)
+        if records is not None:
+            self._cache.move_to_end(block)
+            return records
+        offset, ids_size, payload_size, codec, crc = self._blocks[block]
+        raw = os.pread(self._reader.fileno(), ids_size + payload_size, offset)
+        if zlib.crc32(raw) != crc:
+            raise ValueError(f"Corrupt block at byte {offset - self._BLOCK.size} of {self.path}")
+        payload = memoryview(self._decompress(codec, raw[ids_size:]))
+        records = []
+        position = 0
+        while position < len(payload):
+            (length,) = self._LENGTH.unpack_from(payload, position)
+            position += self._LENGTH.size
+            records.append(payload[position : position + length])
+            position += length
+        self._cache[block] = records
+        if len(self._cache) > self.block_cache_size:
+            self._cache.popitem(last=False)
+        return records
+
+    # -- writing -------------------------------------------------------------
+
+    def extend(self, records):
+        """Buffer a batch of records, writing a block once enough have accumulated."""
+        with self._lock:
+            self._open()
+            for record in records:
+                packed = self.pack_record(record)
+                self._pending.append(packed)
+                self._pending_bytes += len(packed)
+                self._ids.append(record.get("id"))
+            if (
+                len(self._pending) >= self.fsync_every
+                or time.monotonic() - self._last_sync >= self.fsync_interval
+            ):
+                self.sync()
+            elif self._pending and self._timer is None:
+                self._timer = threading.Timer(self.fsync_interval, self._flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _flush(self):
+        with self._lock:
+            self._timer = None
+            self.sync()
+
+    def sync(self):
+        """Write the buffered records as one block and force it onto disk."""
+        with self._lock:
+            if self._pending and self._file is not None:
+                data, (ids_size, payload_size, codec, crc) = self._encode_block(
+                    self._pending, self._ids[len(self._ids) - len(self._pending) :]
+                )
+                self._file.write(data)
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._blocks.append((self._size + self._BLOCK.size, ids_size, payload_size, codec, crc))
+                self._block_starts.append(len(self._ids) - len(self._pending))
+                self._size += len(data)
+                self._pending, self._pending_bytes = [], 0
+            self._last_sync = time.monotonic()
+
+    def rewrite(self, records):
+        """Atomically replace the tape with ``records``, packed into full blocks."""
+        with self._lock:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "wb") as file:
+                file.write(self.MAGIC)
+                packed, ids = [], []
+                for record in records:
+                    packed.append(self.pack_record(record))
+                    ids.append(record.get("id"))
+                    if len(packed) >= self.fsync_every:
+                        file.write(self._encode_block(packed, ids)[0])
+                        packed, ids = [], []
+                if packed:
+                    file.write(self._encode_block(packed, ids)[0])
+                file.flush()
+                os.fsync(file.fileno())
+            self.close()
+            os.replace(tmp_path, self.path)
+            self._scan()
+            self._open()
+
+    def close(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self._file is not None:
+                self.sync()
+                self._file.close()
+                self._file = None
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
+
+
+class SegmentedStorage(Storage):
+    """A tape split into rotating journal segments, with a retention policy.
+
+    Records go to the active segment (a JournalStorage) until it holds
+    ``segment_entries`` records or ``segment_bytes`` bytes; then it is sealed
+    and a new segment is started. Sealed segments are evicted, oldest first,
+    while the live tape holds more than ``max_entries`` records or
+    ``max_bytes`` bytes, or once their newest record is more than ``max_age``
+    seconds old. Retention works on whole segments, so size segments well
+    below the caps. Evicted segments are deleted, or moved to ``archive_dir``
+    when it is set, where they can still be read. The blob keys and spilled
+    body files of deleted records are handed to HistoryManager through
+    ``pop_deleted_bodies`` to be removed once nothing else refers to them.
+
+    Segments are JSON Lines journals, or compressed PackedStorage files with
+    ``segment_format="pack"``; existing segments keep the format they were
+    written in.
+
+    ``segments.json`` in the tape directory indexes every segment, live or
+    archived, by first sequence number, size and time range.
+    """
+
+    INDEX_NAME = "segments.json"
+    FORMATS = {"jsonl": JournalStorage, "pack": PackedStorage}
+
+    def __init__(
+        self,
+        directory="tape",
+        segment_entries=None,
+        segment_bytes=64 * 1024 * 1024,
+        max_entries=None,
+        max_bytes=None,
+        max_age=None,
+        archive_dir=None,
+        archive_cache_size=4,
+        segment_format="jsonl",
+        **segment_options,
+    ):
+        if segment_format not in self.FORMATS:
+            raise ValueError(f"Unknown segment format: {segment_format!r}")
+        self.directory = directory
+        self.index_path = os.path.join(directory, self.INDEX_NAME)
+        self.segment_entries = segment_entries
+        self.segment_bytes = segment_bytes
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.archive_dir = archive_dir
+        self.archive_cache_size = archive_cache_size
+        self.segment_format = segment_format
+        self.segment_options = segment_options
+        self._segments = []  # index entries, oldest first; archived ones precede live ones
+        self._journals = {}  # segment name -> JournalStorage or PackedStorage, for live segments
+        self._archive_readers = OrderedDict()
+        self._evicted_ids = []
+        self._deleted_blobs = []
+        self._deleted_spills = []
+        self._live_count = 0
+
+    # -- segment index -------------------------------------------------------
+
+    def _load_segment_index(self):
+        os.makedirs(self.directory, exist_ok=True)
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as file:
+                self._segments = json.load(file)
+        else:
+            # Rebuild from the segment files themselves, e.g. after a crash.
+            names = sorted(
+                n for n in os.listdir(self.directory)
+                if n.startswith("segment-") and n.rpartition(".")[2] in self.FORMATS
+            )
+            self._segments = [self._new_segment_meta(int(n[len("segment-"):].partition(".")[0]), n) for n in names]
+
+    def _save_segment_index(self):
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(self._segments, file, indent=1)
+        os.replace(tmp_path, self.index_path)
+
+    def _new_segment_meta(self, first_seq, name=None):
+        return {
+            "name": name or f"segment-{first_seq:012d}.{self.segment_format}",
+            "first_seq": first_seq,
+            "count": 0,
+            "bytes": 0,
+            "first_timestamp": None,
+            "last_timestamp": None,
+            "archived": False,
+        }
+
+    def segments(self):
+        """Return a copy of the segment index."""
+        return [dict(meta) for meta in self._segments]
+
+    def _live(self):
+        return [meta for meta in self._segments if not meta["archived"]]
+
+    def _active(self):
+        return self._segments[-1]
+
+    def _segment_storage(self, directory, name):
+        segment_format = name.rpartition(".")[2]
+        options = self.segment_options if segment_format == self.segment_format else {}
+        return self.FORMATS[segment_format](os.path.join(directory, name), **options)
+
+    def _segment_for(self, seq):
+        starts = [meta["first_seq"] for meta in self._segments]
+        position = bisect_right(starts, seq) - 1
+        if position < 0 or seq >= self._segments[position]["first_seq"] + self._segments[position]["count"]:
+            raise IndexError(f"record {seq} is no longer stored")
+        return self._segments[position]
+
+    # -- loading -------------------------------------------------------------
+
+    def _open_segments(self, lazy):
+        self._load_segment_index()
+        self._enforce_retention()
+        records = [] if not lazy else None
+        for meta in self._live():
+            journal = self._segment_storage(self.directory, meta["name"])
+            if lazy:
+                journal.load_index()
+            else:
+                records.extend(journal.load())
+            meta["count"] = journal.count()
+            meta["bytes"] = journal.size()
+            self._journals[meta["name"]] = journal
+        if not self._live():
+            last = self._segments[-1] if self._segments else None
+            self._start_segment(last["first_seq"] + last["count"] if last else 0)
+        self._live_count = sum(meta["count"] for meta in self._live())
+        self._save_segment_index()
+        return records
+
+    def load(self):
+        return self._open_segments(lazy=False)
+
+    def load_index(self):
+        self._open_segments(lazy=True)
+        return self._live_count
+
+    def _start_segment(self, first_seq):
+        meta = self._new_segment_meta(first_seq)
+        journal = self._segment_storage(self.directory, meta["name"])
+        journal.load()
+        self._segments.append(meta)
+        self._journals[meta["name"]] = journal
+
+    # -- reading -------------------------------------------------------------
+
+    def count(self):
+        return self._live_count
+
+    def ids(self):
+        return [entry_id for meta in self._live() for entry_id in self._journals[meta["name"]].ids()]
+
+    def first_seq(self):
+        return self._live()[0]["first_seq"]
+
+    def oldest_seq(self):
+        return self._segments[0]["first_seq"]
+
+    def read(self, index):
+        seq = self.first_seq() + index
+        meta = self._segment_for(seq)
+        return self._journals[meta["name"]].read(seq - meta["first_seq"])
+
+    def read_archived(self, seq):
+        meta = self._segment_for(seq)
+        if not meta["archived"]:
+            return self._journals[meta["name"]].read(seq - meta["first_seq"])
+        reader = self._archive_readers.get(meta["name"])
+        if reader is None:
+            reader = self._segment_storage(self.archive_dir, meta["name"])
+            reader.load_index()
+            self._archive_readers[meta["name"]] = reader
+            if len(self._archive_readers) > self.archive_cache_size:
+                self._archive_readers.popitem(last=False)[1].close()
+        else:
+            self._archive_readers.move_to_end(meta["name"])
+        return reader.read(seq - meta["first_seq"])
+
+    # -- writing -------------------------------------------------------------
+
+    def _active_is_full(self):
+        meta = self._active()
+        return (self.segment_entries is not None and meta["count"] >= self.segment_entries) or (
+            self.segment_bytes is not None and meta["bytes"] >= self.segment_bytes
+        )
+
+    def extend(self, records):
+        position = 0
+        while position < len(records):
+            if self._active_is_full():
+                self._rotate()
+            meta = self._active()
+            room = len(records) - position
+            if self.segment_entries is not None:
+                room = min(room, self.segment_entries - meta["count"])
+            chunk = records[position : position + room]
+            journal = self._journals[meta["name"]]
+            journal.extend(chunk)
+            meta["count"] += len(chunk)
+            meta["bytes"] = journal.size()
+            meta["first_timestamp"] = meta["first_timestamp"] or chunk[0].get("timestamp")
+            meta["last_timestamp"] = chunk[-1].get("timestamp")
+            self._live_count += len(chunk)
+            position += len(chunk)
+        if self._enforce_retention():
+            self._save_segment_index()
+
+    def _rotate(self):
+        sealed = self._active()
+        self._journals[sealed["name"]].sync()
+        self._start_segment(sealed["first_seq"] + sealed["count"])
+        self._enforce_retention()
+        self._save_segment_index()
+
+    def _enforce_retention(self):
+        """Evict sealed segments the retention policy no longer allows; returns whether any were."""
+        evicted = False
+        cutoff = None
+        if self.max_age is not None:
+            cutoff = datetime.utcnow() - timedelta(seconds=self.max_age)
+        while True:
+            live = self._live()
+            if len(live) < 2:
+                return evicted  # never evict the active segment
+            oldest = live[0]
+            too_many = self.max_entries is not None and sum(m["count"] for m in live) > self.max_entries
+            too_big = self.max_bytes is not None and sum(m["bytes"] for m in live) > self.max_bytes
+            too_old = (
+                cutoff is not None
+                and oldest["last_timestamp"] is not None
+                and utc_naive(oldest["last_timestamp"]) < cutoff
+            )
+            if not (too_many or too_big or too_old):
+                return evicted
+            self._evict(oldest)
+            evicted = True
+
+    def _evict(self, meta):
+        journal = self._journals.pop(meta["name"], None)
+        if journal is not None:
+            self._evicted_ids.extend(entry_id for entry_id in journal.ids() if entry_id is not None)
+            self._live_count -= meta["count"]
+        if not self.archive_dir:
+            if journal is None:  # evicted while opening the tape
+                journal = self._segment_storage(self.directory, meta["name"])
+                journal.load_index()
+            self._collect_bodies(journal)
+        if journal is not None:
+            journal.close()
+        path = os.path.join(self.directory, meta["name"])
+        suffixes = ("", ".idx", ".ids")
+        if self.archive_dir:
+            os.makedirs(self.archive_dir, exist_ok=True)
+            for suffix in suffixes:
+                if os.path.exists(path + suffix):
+                    os.replace(path + suffix, os.path.join(self.archive_dir, meta["name"]) + suffix)
+            meta["archived"] = True
+        else:
+            for suffix in suffixes:
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+            self._segments.remove(meta)
+
+    def _collect_bodies(self, journal):
+        """Note the blob keys and spill files referenced by a segment about to be deleted."""
+        for index in range(journal.count()):
+            record = journal.read(index)
+            for field in ("data", "response_body"):
+                value = record.get(field)
+                if isinstance(value, dict) and "$blob" in value:
+                    self._deleted_blobs.append(value["$blob"])
+            if record.get("response_body_path"):
+                self._deleted_spills.append(record["response_body_path"])
+
+    def pop_evicted_ids(self):
+        evicted, self._evicted_ids = self._evicted_ids, []
+        return evicted
+
+    def pop_deleted_bodies(self):
+        deleted = self._deleted_blobs, self._deleted_spills
+        self._deleted_blobs, self._deleted_spills = [], []
+        return deleted
+
+    def needs_compaction(self):
+        return any(journal.needs_compaction() for journal in self._journals.values())
+
+    def rewrite(self, records):
+        records = iter(records)
+        for meta in self._live():
+            journal = self._journals[meta["name"]]
+            journal.rewrite([next(records) for _ in range(meta["count"])])
+            meta["bytes"] = journal.size()
+        self._save_segment_index()
+
+    def sync(self):
+        self._journals[self._active()["name"]].sync()
+        self._save_segment_index()
+
+    def close(self):
+        if not self._journals:
+            return
+        for journal in self._journals.values():
+            journal.close()
+        for reader in self._archive_readers.values():
+            reader.close()
+        self._archive_readers.clear()
+        self._save_segment_index()
+
+
+class SqliteStorage(Storage):
+    """A tape in an SQLite database, which several processes can record to at once.
+
+    The database runs in WAL mode, so readers never block the writer, and
+    each batch of records is inserted in one ``BEGIN IMMEDIATE``
+    transaction, which SQLite serializes across processes. A record's
+    sequence number is its row number less one, so every process sees the
+    same numbering. Each process remembers the last row it has seen;
+    ``refresh`` returns the rows others have added since, and ``extend``
+    returns the ones that were added just before its own batch.
+
+    Next to the record, each row holds its id, timestamp, method, path,
+    status code and signature in indexed columns, and whether it is the
+    first occurrence of its exchange, so lookups by id, ``unique`` pages and
+    filtered scans are index queries rather than in-memory indexes.
+    """
+
+    SUFFIX = ".sqlite"
+    indexed = True
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (
+            seq INTEGER PRIMARY KEY,
+            id TEXT,
+            timestamp REAL,
+            method TEXT,
+            path TEXT,
+            status INTEGER,
+            signature TEXT,
+            first INTEGER NOT NULL DEFAULT 1,
+            record TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS entries_id ON entries (id);
+        CREATE INDEX IF NOT EXISTS entries_timestamp ON entries (timestamp);
+        CREATE INDEX IF NOT EXISTS entries_method_path ON entries (method, path);
+        CREATE INDEX IF NOT EXISTS entries_status ON entries (status);
+        CREATE INDEX IF NOT EXISTS entries_signature ON entries (signature, seq);
+        CREATE INDEX IF NOT EXISTS entries_first ON entries (seq) WHERE first;
+    """
+
+    COLUMNS = "id, timestamp, method, path, status, signature, first, record"
+
+    SCAN_BATCH = 256
+
+    def __init__(self, path="tape.sqlite", timeout=30.0):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(self.SCHEMA)
+        self._seen = 0  # row number of the last record this process has taken in
+        self._closed = False
+
+    def _rows_after(self, seen):
+        return self._db.execute("SELECT seq, record FROM entries WHERE seq > ? ORDER BY seq", (seen,)).fetchall()
+
+    def _take(self, rows):
+        if rows:
+            self._seen = rows[-1][0]
+        return [loads_record(record) for _, record in rows]
+
+    def _rows(self, records):
+        """Column values for inserting ``records`` after the rows already stored."""
+        signatures = set()
+        for record in records:
+            signature = record.get("signature")
+            first = signature is None or (
+                signature not in signatures
+                and self._db.execute("SELECT 1 FROM entries WHERE signature = ? LIMIT 1", (signature,)).fetchone()
+                is None
+            )
+            signatures.add(signature)
+            yield (
+                record.get("id"),
+                (utc_naive(record["timestamp"]) - EPOCH).total_seconds(),
+                record["method"].upper(),
+                record["path"].lstrip("/"),
+                record["status_code"],
+                signature,
+                first,
+                dumps_record(record),
+            )
+
+    def _insert(self, records):
+        placeholders = ", ".join("?" * len(self.COLUMNS.split(", ")))
+        cursor = self._db.executemany(
+            f"INSERT INTO entries ({self.COLUMNS}) VALUES ({placeholders})", list(self._rows(records))
+        )
+        return cursor.rowcount
+
+    def load(self):
+        with self._lock:
+            return self._take(self._rows_after(0))
+
+    def load_index(self):
+        with self._lock:
+            self._seen = self._db.execute("SELECT COALESCE(MAX(seq), 0) FROM entries").fetchone()[0]
+
+    def count(self):
+        """Records this process has taken in; the ones others appended since show up on ``refresh``."""
+        return self._seen
+
+    def ids(self):
+        with self._lock:
+            rows = self._db.execute("SELECT id FROM entries WHERE seq <= ? ORDER BY seq", (self._seen,))
+            return [entry_id for (entry_id,) in rows]
+
+    def read(self, index):
+        with self._lock:
+            row = self._db.execute("SELECT record FROM entries WHERE seq = ?", (index + 1,)).fetchone()
+        if row is None:
+            raise IndexError("history index out of range")
+        return loads_record(row[0])
+
+    def find(self, entry_id):
+        """Sequence number of the newest record with id ``entry_id``, or None."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT MAX(seq) FROM entries WHERE id = ? AND seq <= ?", (entry_id, self._seen)
+            ).fetchone()
+        return None if row[0] is None else row[0] - 1
+
+    def unique_seqs(self, limit, after=None, before=None):
+        """Sequence numbers of up to ``limit`` first occurrences, paged like ``HistoryManager.page``."""
+        with self._lock:
+            if before is not None:
+                rows = self._db.execute(
+                    "SELECT seq FROM entries WHERE first AND seq <= ? ORDER BY seq DESC LIMIT ?",
+                    (min(before, self._seen), limit),
+                ).fetchall()
+                rows.reverse()
+            else:
+                rows = self._db.execute(
+                    "SELECT seq FROM entries WHERE first AND seq > ? AND seq <= ? ORDER BY seq LIMIT ?",
+                    (-1 if after is None else after + 1, self._seen, limit),
+                ).fetchall()
+        return [seq - 1 for (seq,) in rows]
+
+    def occurrences(self, signature):
+        """How many records have the signature ``signature``."""
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM entries WHERE signature = ? AND seq <= ?", (signature, self._seen)
+            ).fetchone()[0]
+
+    def scan(self, query, start, stop, reverse=False, unique=False):
+        """Yield the sequence numbers in [start, stop) whose indexed columns match a HistoryQuery.
+
+        Path globs are narrowed to their literal prefix, so matches still
+        need checking with ``query.matches``. With ``unique`` only first
+        occurrences are yielded.
+        """
+        conditions, params = [], []
+        if query.methods:
+            conditions.append(f"method IN ({', '.join('?' * len(query.methods))})")
+            params.extend(sorted(query.methods))
+        prefix = query.path[: GLOB_CHARS.search(query.path).start()] if query.path_is_glob else query.path
+        if prefix:
+            conditions.append("path >= ? AND path < ?")
+            params.extend((prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)))
+        if query.status_min is not None:
+            conditions.append("status >= ?")
+            params.append(query.status_min)
+        if query.status_max is not None:
+            conditions.append("status <= ?")
+            params.append(query.status_max)
+        if query.since is not None:
+            conditions.append("timestamp >= ?")
+            params.append((utc_naive(query.since.isoformat()) - EPOCH).total_seconds())
+        if query.until is not None:
+            conditions.append("timestamp <= ?")
+            params.append((utc_naive(query.until.isoformat()) - EPOCH).total_seconds())
+        if unique:
+            conditions.append("first")
+        where = "".join(f" AND {condition}" for condition in conditions)
+        order = "DESC" if reverse else "ASC"
+        low, high = start, stop - 1  # as row numbers: [start + 1, stop]
+        while True:
+            with self._lock:
+                rows = self._db.execute(
+                    f"SELECT seq FROM entries WHERE seq > ? AND seq <= ?{where} ORDER BY seq {order} LIMIT ?",
+                    (low, min(high + 1, self._seen), *params, self.SCAN_BATCH),
+                ).fetchall()
+            for (seq,) in rows:
+                yield seq - 1
+            if len(rows) < self.SCAN_BATCH:
+                return
+            if reverse:
+                high = rows[-1][0] - 2
+            else:
+                low = rows[-1][0]
+
+    def refresh(self):
+        with self._lock:
+            return self._take(self._rows_after(self._seen))
+
+    def extend(self, records):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                preceding = self._take(self._rows_after(self._seen))
+                self._seen += self._insert(records)
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return preceding
+
+    def rewrite(self, records):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.execute("DELETE FROM entries")
+                self._seen = self._insert(records)
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            try:
+                self._db.execute("PRAGMA optimize")  # keep the query planner's statistics current
+            except sqlite3.OperationalError:
+                pass  # another process is writing; its own close will optimize
+            self._db.close()
+            self._closed = True
@@ -0,0 +1,78 @@
+from collections import deque
+import threading
+
+
+class Subscription:
+    """Entries recorded since a live tail subscribed, waiting to be sent to it.
+
+    At most ``max_pending`` entries are queued. A subscriber that falls
+    further behind is marked ``overflowed`` and its queue is dropped; it can
+    catch up from the tape, where every entry is anyway.
+    """
+
+    def __init__(self, hub, max_pending=1000):
+        self._hub = hub
+        self.max_pending = max_pending
+        self.overflowed = False
+        self._pending = deque()
+        self._ready = threading.Condition()
+
+    def push(self, seq, entry):
+        with self._ready:
+            if len(self._pending) >= self.max_pending:
+                self._pending.clear()
+                self.overflowed = True
+            else:
+                self._pending.append((seq, entry))
+            self._ready.notify()
+
+    def wait(self, timeout):
+        """Return the queued (seq, entry) pairs, waiting up to ``timeout`` seconds for one.
+
+        Returns None instead if entries were dropped since the last call.
+        """
+        with self._ready:
+            if not self._pending and not self.overflowed:
+                self._ready.wait(timeout)
+            if self.overflowed:
+                self.overflowed = False
+                return None
+            batch = list(self._pending)
+            self._pending.clear()
+            return batch
+
+    def close(self):
+        self._hub.unsubscribe(self)
+
+
+class TailHub:
+    """Hands every entry recorded to the tape to the live tail subscriptions.
+
+    ``publish`` is registered with ``HistoryManager.add_listener``; it only
+    appends to each subscription's queue, so a slow reader never holds up
+    recording.
+    """
+
+    def __init__(self, max_pending=1000):
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._subscriptions = set()
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+    def subscribe(self):
+        subscription = Subscription(self, self.max_pending)
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def publish(self, seq, entry):
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            subscription.push(seq, entry)
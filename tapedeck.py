@@ -1,13 +1,28 @@
 from history import HistoryEntry
+import json
+import os
+import time
 import requests
 import click
 from cmd import Cmd
 
-from history import HistoryEntry
+from history import HistoryEntry, copy_tape
+from blobs import BlobStore
+from replay import BatchReplay, load_report
+from storage import JsonStorage, JournalStorage, PackedStorage, SegmentedStorage, SqliteStorage
+from upstream import UpstreamPool
 
 
 PROXY_SERVICE_URL = "http://localhost:54321"
 
+TAPE_FORMATS = {
+    "json": JsonStorage,
+    "journal": JournalStorage,
+    "packed": PackedStorage,
+    "segmented": SegmentedStorage,
+    "sqlite": SqliteStorage,
+}
+
 
 # Moved _replay_request function outside of the ProxyCLI class to fix NameError
 def _replay_request(request_id):
@@ -86,6 +101,326 @@ def replay():
         click.echo("Failed to fetch history")
 
 
+def history_filter_options(command):
+    """Add the /__/history filter options to a command, collected into its ``filters`` keywords."""
+    options = [
+        click.option("--method", help="Only recorded requests with this method."),
+        click.option("--path", help="Only recorded requests under this path prefix or glob."),
+        click.option("--status", help="Only recorded requests with this status, e.g. 503, 5xx or 500-599."),
+        click.option("--since", help="Only requests recorded at or after this ISO timestamp."),
+        click.option("--until", help="Only requests recorded at or before this ISO timestamp."),
+        click.option("--header", "headers", multiple=True, help="Only requests with this Name:value header (repeatable)."),
+        click.option("--body", help="Only requests whose request or response body contains this text."),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+def filter_params(filters):
+    """Turn the history_filter_options values into /__/history query parameters."""
+    filters = dict(filters)
+    filters["header"] = list(filters.pop("headers"))
+    return {name: value for name, value in filters.items() if value}
+
+
+@cli.command("batch-replay")
+@click.argument("ids", nargs=-1)
+@history_filter_options
+@click.option("--limit", type=int, default=None, help="Replay at most this many requests.")
+@click.option("--concurrency", default=8, show_default=True, help="Requests in flight at once.")
+@click.option("--rate", type=float, default=None, help="Maximum requests started per second.")
+@click.option("--timing", type=click.Choice(["fast", "recorded"]), default="fast", show_default=True, help="Send as fast as possible, or keep the recorded gaps between requests.")
+@click.option("--speed", default=1.0, show_default=True, help="With --timing recorded, replay this many times faster than recorded.")
+@click.option("--upstream", default=None, help="Replay against this URL instead of the proxy's upstream.")
+@click.option("--ignore-header", "ignore_headers", multiple=True, help="Response header left out of the diffs (repeatable).")
+@click.option("--ignore-field", "ignore_fields", multiple=True, help="Glob of JSON body paths left out of the diffs, e.g. '*.updated_at' (repeatable).")
+@click.option("--ignore-value", "ignore_values", multiple=True, help="'timestamps', 'uuids' or a regex; values matching it in both responses count as equal (repeatable).")
+@click.option("--json", "as_json", is_flag=True, help="Print the raw results as JSON.")
+def batch_replay(ids, limit, concurrency, rate, timing, speed, upstream, ignore_headers, ignore_fields, ignore_values, as_json, **filters):
+    """Replay the recorded requests with the given IDS, or those matching the filters."""
+    payload = {"concurrency": concurrency, "timing": timing, "speed": speed}
+    if ids:
+        payload["ids"] = list(ids)
+    else:
+        payload["filter"] = filter_params(filters)
+    if limit:
+        payload["limit"] = limit
+    if rate:
+        payload["rate"] = rate
+    if upstream:
+        payload["upstream"] = upstream
+    if ignore_headers or ignore_fields or ignore_values:
+        payload["ignore"] = {"headers": ignore_headers, "fields": ignore_fields, "values": ignore_values}
+    response = requests.post(f"{PROXY_SERVICE_URL}/__/replay/batch", json=payload)
+    if not response.ok:
+        click.echo(f"Batch replay failed: {response.json().get('error', response.text)}")
+        raise SystemExit(1)
+    report = response.json()
+    if as_json:
+        click.echo(json.dumps(report, indent=2))
+        return
+    for result in report["results"]:
+        outcome = result.get("error") or ("match" if result["match"] else "DIFF " + describe_diff(result["diff"]))
+        status = result.get("status_code", "---")
+        click.echo(f"{status} {result['method']} /{result['path']} {result['latency_ms']:.1f}ms {outcome}")
+    summary = report["summary"]
+    click.echo(
+        f"{summary['total']} replayed: {summary['matched']} matched, "
+        f"{summary['mismatched']} differed, {summary['errors']} failed"
+    )
+    if summary["mismatched"] or summary["errors"]:
+        raise SystemExit(1)
+
+
+def describe_diff(diff, paths=3):
+    """``status 200->500, content-type, body: items.0.price, total`` for a replay diff."""
+    parts = []
+    if "status_code" in diff:
+        parts.append(f"status {diff['status_code']['recorded']}->{diff['status_code']['replayed']}")
+    parts.extend(diff.get("response_headers", ()))
+    body = diff.get("response_body")
+    if body is not None:
+        changes = [change["path"] or "(root)" for change in body.get("changes", ())]
+        if not changes:
+            parts.append(f"body {body['recorded_size']}->{body['replayed_size']} bytes")
+        else:
+            more = len(changes) - paths
+            parts.append("body: " + ", ".join(changes[:paths]) + (f" and {more} more" if more > 0 else ""))
+    return ", ".join(parts)
+
+
+def fetch_history(params, limit=None, page_size=1000):
+    """Yield HistoryEntry objects from /__/history, following its cursors."""
+    params = dict(params, limit=page_size)
+    fetched = 0
+    while True:
+        response = requests.get(f"{PROXY_SERVICE_URL}/__/history", params=params)
+        response.raise_for_status()
+        page = response.json()
+        for raw_entry in page["history"]:
+            if limit is not None and fetched >= limit:
+                return
+            fetched += 1
+            yield HistoryEntry.from_dict(raw_entry)
+        if not page["next"]:
+            return
+        params["after"] = page["next"]
+
+
+@cli.command()
+@history_filter_options
+@click.option("--format", "export_format", type=click.Choice(["ndjson", "json"]), default="ndjson", show_default=True, help="One JSON entry per line, or a single JSON document.")
+@click.option("--unique", is_flag=True, help="Only the first recording of each distinct exchange.")
+@click.option("--after", default=None, help="Only entries recorded after this cursor, as printed by an earlier export.")
+@click.option("--output", type=click.File("wb"), default="-", help="Write to this file instead of stdout.")
+def export(export_format, unique, after, output, **filters):
+    """Stream the recorded history, or the part matching the filters, to stdout or --output.
+
+    The export is written as it arrives, so memory use stays flat however
+    large the tape is. The cursor to pass as --after next time, to export
+    only newer entries, is printed to stderr.
+    """
+    params = dict(filter_params(filters), format=export_format)
+    if unique:
+        params["unique"] = "true"
+    if after:
+        params["after"] = after
+    with requests.get(f"{PROXY_SERVICE_URL}/__/history/export", params=params, stream=True) as response:
+        if response.status_code == 400:
+            raise click.UsageError(response.json()["error"])
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            output.write(chunk)
+    click.echo(f"Next export: --after {response.headers['X-Tapedeck-Cursor']}", err=True)
+
+
+def read_events(lines):
+    """Parse the lines of a server-sent event stream into (id, event, data) tuples."""
+    event_id, event, data = None, None, []
+    for line in lines:
+        if not line:
+            if data:
+                yield event_id, event or "message", "\n".join(data)
+            event, data = None, []
+        elif not line.startswith(":"):
+            name, _, value = line.partition(":")
+            value = value[1:] if value.startswith(" ") else value
+            if name == "id":
+                event_id = value
+            elif name == "event":
+                event = value
+            elif name == "data":
+                data.append(value)
+
+
+def tail_line(entry):
+    target = f"/{entry['path'].lstrip('/')}" + (f"?{entry['query']}" if entry.get("query") else "")
+    line = f"{entry['timestamp']} {entry['method']:<7} {target} -> {entry['status_code']}"
+    upstream_ms = (entry.get("timings") or {}).get("upstream")
+    return line if upstream_ms is None else f"{line} ({upstream_ms:.1f}ms)"
+
+
+@cli.command()
+@history_filter_options
+@click.option("--after", default=None, help="Start with the entries recorded after this cursor.")
+@click.option("--json", "as_json", is_flag=True, help="Print every entry as a line of JSON.")
+@click.option("--limit", type=int, default=None, help="Exit after this many entries.")
+def tail(after, as_json, limit, **filters):
+    """Follow the requests the proxy records, as they are recorded.
+
+    Entries are pushed by the proxy, filtered on its side. When the
+    connection drops the command reconnects and resumes after the last entry
+    it printed.
+    """
+    params = filter_params(filters)
+    shown = 0
+    while True:
+        if after:
+            params["after"] = after
+        try:
+            with requests.get(f"{PROXY_SERVICE_URL}/__/history/tail", params=params, stream=True, timeout=(5, 60)) as response:
+                if response.status_code == 400:
+                    raise click.UsageError(response.json()["error"])
+                response.raise_for_status()
+                response.encoding = "utf-8"
+                for event_id, event, data in read_events(response.iter_lines(decode_unicode=True)):
+                    if event != "entry":
+                        continue
+                    after = event_id
+                    click.echo(data if as_json else tail_line(json.loads(data)))
+                    shown += 1
+                    if limit is not None and shown >= limit:
+                        return
+        except (requests.ConnectionError, requests.Timeout):
+            click.echo("Connection to the proxy lost, reconnecting...", err=True)
+        time.sleep(1)
+
+
+@cli.command("load-test")
+@click.argument("target")
+@history_filter_options
+@click.option("--limit", type=int, default=None, help="Replay at most this many recorded requests.")
+@click.option("--speed", default=1.0, show_default=True, help="Replay at this multiple of the recorded rate.")
+@click.option("--fast", is_flag=True, help="Ignore the recorded timing and send as fast as the workers allow.")
+@click.option("--workers", default=32, show_default=True, help="Requests in flight at once.")
+@click.option("--timeout", type=float, default=30.0, show_default=True, help="Per-request timeout in seconds.")
+@click.option("--json", "as_json", is_flag=True, help="Print the report as JSON, for comparing runs.")
+def load_test(target, limit, speed, fast, workers, timeout, as_json, **filters):
+    """Replay the recorded traffic against TARGET as a load test.
+
+    Requests are sent with their recorded spacing compressed by --speed, and
+    throughput, error rates and latency percentiles are reported per endpoint.
+    """
+    entries = list(fetch_history(filter_params(filters), limit=limit))
+    if not entries:
+        click.echo("No recorded requests to replay.")
+        raise SystemExit(1)
+    span = (entries[-1].timestamp - entries[0].timestamp).total_seconds()
+    target_rate = len(entries) / (span / speed) if span > 0 and not fast else None
+
+    pool = UpstreamPool(pool_size=workers, read_timeout=timeout, connect_timeout=timeout)
+
+    def send(entry):
+        url = f"{target.rstrip('/')}/{entry.path.lstrip('/')}"
+        headers = {k: v for k, v in entry.headers.items() if k.lower() not in ("host", "content-length")}
+        return pool.request(entry.method, f"{url}?{entry.query}" if entry.query else url, headers=headers, data=entry.data)
+
+    replayer = BatchReplay(send, concurrency=workers, timing="fast" if fast else "recorded", speed=speed, compare=False)
+    started = time.monotonic()
+    results = replayer.run(entries)
+    report = load_report(results, time.monotonic() - started, target_rate)
+    pool.close()
+
+    if as_json:
+        click.echo(json.dumps(report, indent=2))
+        return
+    click.echo(
+        f"{report['requests']} requests in {report['duration_s']}s: {report['throughput_rps']} req/s"
+        + (f" (target {report['target_rps']} req/s)" if report["target_rps"] else "")
+        + f", {report['error_rate']:.2%} errors"
+    )
+    click.echo(f"{'endpoint':<40} {'requests':>8} {'errors':>7} {'req/s':>8} {'p50':>8} {'p95':>8} {'p99':>8}")
+    for endpoint, stats in report["endpoints"].items():
+        latency = stats["latency_ms"] or {"p50": 0, "p95": 0, "p99": 0}
+        click.echo(
+            f"{endpoint:<40} {stats['requests']:>8} {stats['error_rate']:>7.1%} {stats['throughput_rps']:>8} "
+            f"{latency['p50']:>6.1f}ms {latency['p95']:>6.1f}ms {latency['p99']:>6.1f}ms"
+        )
+
+
+@cli.command()
+@click.option("--sizes", default="1000,10000", show_default=True, help="Comma-separated tape sizes to benchmark against.")
+@click.option("--storage", type=click.Choice(["json", "journal", "packed", "segmented", "sqlite"]), default="journal", show_default=True, help="Tape format to benchmark.")
+@click.option("--requests", "request_count", default=500, show_default=True, help="Requests sent through the proxy; 0 skips the proxy benchmark.")
+@click.option("--concurrency", default=8, show_default=True, help="Proxy requests in flight at once.")
+@click.option("--repeat", default=50, show_default=True, help="Timed runs of each tape benchmark.")
+@click.option("--workload", type=click.Choice(["basic", "request-ids"]), default="basic", show_default=True, help="Synthetic traffic; request-ids adds a unique X-Request-Id and Date header per exchange.")
+@click.option("--output", type=click.Path(dir_okay=False), default=None, help="Write the report to this JSON file, e.g. to use as a baseline.")
+@click.option("--baseline", type=click.Path(exists=True, dir_okay=False), default=None, help="Compare with a report saved by an earlier run.")
+@click.option("--tolerance", default=0.2, show_default=True, help="Growth of a median latency or of memory per entry, as a fraction, reported as a regression.")
+def bench(sizes, storage, request_count, concurrency, repeat, workload, output, baseline, tolerance):
+    """Benchmark the proxy, the recorder and the history endpoints.
+
+    Runs locally against a stand-in upstream and temporary tapes. Exits
+    non-zero if --baseline is given and a benchmark regressed.
+    """
+    import bench as benchmarks
+
+    try:
+        tape_sizes = [int(size) for size in sizes.split(",") if size.strip()]
+    except ValueError:
+        raise click.BadParameter("expected comma-separated integers", param_hint="--sizes")
+    report = benchmarks.run(tape_sizes, storage, request_count, concurrency, repeat, workload)
+    if output:
+        with open(output, "w") as file:
+            json.dump(report, file, indent=2)
+
+    click.echo(f"{'benchmark':<28} {'ops/s':>12} {'p50':>10} {'p95':>10} {'p99':>10}")
+    for name, result in report["results"].items():
+        if "bytes_per_entry" in result:
+            click.echo(f"{name:<28} {result['bytes_per_entry']:>12} bytes per entry")
+            continue
+        latency = result["latency_ms"] or {"p50": 0, "p95": 0, "p99": 0}
+        click.echo(
+            f"{name:<28} {result['ops_per_s']:>12} {latency['p50']:>8.3f}ms {latency['p95']:>8.3f}ms {latency['p99']:>8.3f}ms"
+        )
+    if baseline:
+        with open(baseline) as file:
+            try:
+                regressions = benchmarks.compare(report, json.load(file), tolerance)
+            except ValueError as e:
+                raise click.UsageError(str(e))
+        for regression in regressions:
+            click.echo(
+                f"REGRESSION {regression['name']}: {regression['baseline']} -> "
+                f"{regression['current']} (+{regression['change']:.0%})"
+            )
+        if regressions:
+            raise SystemExit(1)
+        click.echo(f"No regressions against {baseline}.")
+
+
+@cli.command()
+@click.argument("source", type=click.Path(exists=True))
+@click.argument("destination", type=click.Path())
+@click.option("--from", "source_format", type=click.Choice(list(TAPE_FORMATS)), default="json", show_default=True, help="Format of the SOURCE tape.")
+@click.option("--to", "destination_format", type=click.Choice(list(TAPE_FORMATS)), default="sqlite", show_default=True, help="Format to write DESTINATION in.")
+@click.option("--blob-dir", default=None, help="Blob store the tape's bodies are kept in, if it was recorded with --blob-dir.")
+@click.option("--batch-size", default=10000, show_default=True, help="Entries written per transaction.")
+def migrate(source, destination, source_format, destination_format, blob_dir, batch_size):
+    """Copy the tape SOURCE to a new tape DESTINATION, e.g. tape.json to tape.sqlite."""
+    if os.path.exists(destination):
+        raise click.UsageError(f"{destination} already exists")
+    count = copy_tape(
+        TAPE_FORMATS[source_format](source),
+        TAPE_FORMATS[destination_format](destination),
+        blobs=BlobStore(blob_dir) if blob_dir else None,
+        batch_size=batch_size,
+    )
+    click.echo(f"Copied {count} entries from {source} to {destination}.")
+
+
 if __name__ == "__main__":
     cli()
 
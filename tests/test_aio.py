@@ -0,0 +1,77 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("aiohttp")
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import aio
+import cassette
+from history import HistoryManager
+from storage import JournalStorage
+
+
+@pytest.fixture
+def history_manager(tmp_path, monkeypatch):
+    manager = HistoryManager(JournalStorage(str(tmp_path / "tape.jsonl")))
+    monkeypatch.setattr(cassette, "history_manager", manager)
+    yield manager
+    manager.close()
+
+
+async def upstream_handler(request):
+    await asyncio.sleep(0.05)
+    return web.json_response({"path": request.path, "query": request.query_string})
+
+
+def run_against_upstream(scenario):
+    """Run ``scenario(client)`` with the asyncio engine proxying to a local upstream."""
+
+    async def main():
+        upstream = web.Application()
+        upstream.router.add_route("*", "/{tail:.*}", upstream_handler)
+        async with TestServer(upstream) as upstream_server:
+            app = aio.create_app(str(upstream_server.make_url("/")))
+            async with TestClient(TestServer(app)) as client:
+                return await scenario(client)
+
+    return asyncio.run(main())
+
+
+def test_proxy_records_entry(history_manager):
+    async def scenario(client):
+        response = await client.get("/items?a=1")
+        assert response.status == 200
+        assert await response.json() == {"path": "/items", "query": "a=1"}
+
+    run_against_upstream(scenario)
+    [entry] = history_manager.get_history()
+    assert (entry.method, entry.path, entry.query) == ("GET", "items", "a=1")
+    assert entry.status_code == 200
+    assert set(entry.timings) == {"receive", "ttfb", "upstream"}
+    assert entry.timings["upstream"] >= entry.timings["ttfb"] >= 50
+
+
+def test_concurrent_requests_are_all_recorded(history_manager):
+    async def scenario(client):
+        responses = await asyncio.gather(*(client.get(f"/items/{i}") for i in range(200)))
+        assert all(response.status == 200 for response in responses)
+
+    run_against_upstream(scenario)
+    assert len(history_manager.get_history()) == 200
+
+
+def test_history_and_replay(history_manager):
+    async def scenario(client):
+        await client.post("/orders", data="x")
+        page = await (await client.get("/__/history")).json()
+        [entry] = page["history"]
+        replayed = await client.post("/__/replay", json={"id": entry["id"]})
+        assert replayed.status == 200
+        assert (await replayed.json())["status_code"] == 200
+        assert (await replayed.json())["diff"] == {}
+        missing = await client.post("/__/replay", json={"id": "nope"})
+        assert missing.status == 400
+
+    run_against_upstream(scenario)
@@ -0,0 +1,72 @@
+import json
+
+from click.testing import CliRunner
+import pytest
+
+import bench
+import tapedeck
+
+
+def test_bench_tape_covers_each_benchmark():
+    results = bench.bench_tape("journal", 200, repeat=5)
+    assert set(results) == {"load", "append", "history_page", "history_unique", "replay_lookup", "playback_lookup"}
+    assert results["append"]["runs"] == 20
+    assert results["history_page"]["latency_ms"]["p50"] > 0
+
+
+def test_bench_proxy_against_stub_upstream():
+    result = bench.bench_proxy("journal", requests=20, concurrency=2)
+    assert result["runs"] == 20
+    assert result["errors"] == 0
+
+
+def test_compare_reports_slower_medians():
+    def report(**p50):
+        return {"results": {name: {"latency_ms": {"p50": value}} for name, value in p50.items()}}
+
+    regressions = bench.compare(report(load=1.3, append=1.1, new=5.0), report(load=1.0, append=1.0), 0.2)
+    assert regressions == [{"name": "load", "baseline": 1.0, "current": 1.3, "change": 0.3}]
+
+    memory = bench.compare({"results": {"memory@10": {"bytes_per_entry": 1300}}}, {"results": {"memory@10": {"bytes_per_entry": 1000}}})
+    assert [regression["name"] for regression in memory] == ["memory@10"]
+
+
+def test_compare_refuses_other_workloads():
+    current = {"meta": {"workload": "request-ids"}, "results": {}}
+    with pytest.raises(ValueError):
+        bench.compare(current, {"results": {}})
+    assert bench.compare({"meta": {"workload": "basic"}, "results": {}}, {"results": {}}) == []
+
+
+def test_only_the_opt_in_workload_adds_unique_headers():
+    basic = next(bench.synthetic_entries(1))
+    assert basic.headers == {"Accept": "application/json", "User-Agent": "bench"}
+    assert "Date" not in basic.response_headers
+    unique = next(bench.synthetic_entries(1, workload="request-ids"))
+    assert "X-Request-Id" in unique.headers and "Date" in unique.response_headers
+
+
+def test_bench_memory_reports_bytes_per_entry():
+    assert 0 < bench.bench_memory("journal", 500)["bytes_per_entry"] < 5000
+
+
+def test_bench_cli_writes_and_checks_baseline(tmp_path):
+    output = tmp_path / "baseline.json"
+    args = ["bench", "--sizes", "100", "--requests", "0", "--repeat", "3", "--output", str(output)]
+    result = CliRunner().invoke(tapedeck.cli, args)
+    assert result.exit_code == 0, result.output
+    report = json.loads(output.read_text())
+    assert "append@100" in report["results"]
+
+    assert "memory@100" in report["results"]
+    for result in report["results"].values():
+        if "latency_ms" in result:
+            result["latency_ms"]["p50"] = 1e-9
+    output.write_text(json.dumps(report))
+    result = CliRunner().invoke(tapedeck.cli, ["bench", "--sizes", "100", "--requests", "0", "--repeat", "3", "--baseline", str(output)])
+    assert result.exit_code == 1
+    assert "REGRESSION append@100" in result.output
+
+
+def test_bench_diff():
+    assert bench.bench_diff(50)["runs"] == 50
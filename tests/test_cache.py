@@ -0,0 +1,106 @@
+from datetime import datetime
+
+from cache import ResponseCache, parse_cache_control
+from history import HistoryEntry
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_entry(path="items", body="ok", method="GET", status=200, headers=None, response_headers=None, query=""):
+    return HistoryEntry(
+        id=None,
+        method=method,
+        path=path,
+        status_code=status,
+        headers=headers or {},
+        data="",
+        response_headers=response_headers or {},
+        response_body=body,
+        timestamp=datetime(2024, 1, 1),
+        query=query,
+    )
+
+
+def test_parse_cache_control():
+    assert parse_cache_control('max-age=60, No-Store, private="x"') == {"max-age": "60", "no-store": True, "private": "x"}
+    assert parse_cache_control(None) == {}
+
+
+def test_lookup_matches_normalized_query_and_expires():
+    clock = Clock()
+    cache = ResponseCache(ttl=10, clock=clock)
+    cache.add(0, make_entry(query="b=2&a=1"))
+    clock.now = 5
+    entry, age = cache.lookup("GET", "/items", "a=1&b=2", {})
+    assert entry.response_body == "ok" and age == 5
+    assert cache.lookup("GET", "items", "a=1", {}) is None
+    clock.now = 10
+    assert cache.lookup("GET", "items", "a=1&b=2", {}) is None
+    assert cache.stats()["expirations"] == 1
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 2
+
+
+def test_cache_control_decides_what_is_cached():
+    clock = Clock()
+    cache = ResponseCache(ttl=10, clock=clock)
+    assert cache.lifetime(make_entry(response_headers={"Cache-Control": "max-age=100", "Age": "40"})) == 60
+    assert cache.lifetime(make_entry(response_headers={"cache-control": "s-maxage=5, max-age=100"})) == 5
+    for response_headers in ({"Cache-Control": "no-store"}, {"Cache-Control": "private"}, {"Set-Cookie": "a=b"}, {"Vary": "Accept"}):
+        assert cache.lifetime(make_entry(response_headers=response_headers)) is None
+    assert cache.lifetime(make_entry(method="POST")) is None
+    assert cache.lifetime(make_entry(status=500)) is None
+    assert ResponseCache(key_headers=["Accept"]).lifetime(make_entry(response_headers={"Vary": "accept"})) == 60
+
+    cache.add(0, make_entry())
+    assert cache.lookup("GET", "items", "", {"Cache-Control": "no-cache"}) is None
+    clock.now = 3
+    assert cache.lookup("GET", "items", "", {"Cache-Control": "max-age=2"}) is None
+    assert cache.lookup("GET", "items", "", {"Cache-Control": "max-age=5"}) is not None
+
+
+def test_key_headers_and_lru_eviction():
+    cache = ResponseCache(max_entries=2, max_bytes=10, key_headers=["Accept"])
+    cache.add(0, make_entry("a", headers={"Accept": "text/plain"}))
+    assert cache.lookup("GET", "a", "", {"accept": "application/json"}) is None
+    assert cache.lookup("GET", "a", "", {"Accept": "text/plain"}) is not None
+    cache.add(1, make_entry("b", headers={"Accept": "text/plain"}))
+    cache.lookup("GET", "a", "", {"Accept": "text/plain"})
+    cache.add(2, make_entry("c", headers={"Accept": "text/plain"}))
+    assert cache.lookup("GET", "b", "", {"Accept": "text/plain"}) is None  # least recently used
+    cache.add(3, make_entry("d", body="x" * 9, headers={"Accept": "text/plain"}))
+    stats = cache.stats()
+    assert stats["entries"] == 1 and stats["bytes"] == 9 and stats["evictions"] == 3
+
+
+def test_authorized_responses_need_public_or_s_maxage():
+    cache = ResponseCache(ttl=10)
+    authorized = {"Authorization": "Bearer secret"}
+    assert cache.lifetime(make_entry(headers=authorized)) is None
+    assert cache.lifetime(make_entry(headers=authorized, response_headers={"Cache-Control": "max-age=30"})) is None
+    assert cache.lifetime(make_entry(headers=authorized, response_headers={"Cache-Control": "public"})) == 10
+    assert cache.lifetime(make_entry(headers=authorized, response_headers={"Cache-Control": "s-maxage=30"})) == 30
+
+
+def test_unsafe_methods_invalidate_the_path():
+    cache = ResponseCache(ttl=10, key_headers=["Accept"])
+    cache.add(0, make_entry("items", query="page=1"))
+    cache.add(1, make_entry("items", headers={"Accept": "text/plain"}))
+    cache.add(2, make_entry("other"))
+    cache.add(3, make_entry("items", method="POST", status=422))
+    assert cache.lookup("GET", "items", "page=1", {}) is not None
+
+    cache.add(4, make_entry("/items", method="POST", status=201))
+    assert cache.lookup("GET", "items", "page=1", {}) is None
+    assert cache.lookup("GET", "items", "", {"Accept": "text/plain"}) is None
+    assert cache.lookup("GET", "other", "", {}) is not None
+    stats = cache.stats()
+    assert stats["entries"] == 1 and stats["bytes"] == 2 and stats["invalidations"] == 2
+
+    cache.add(5, make_entry("items"))
+    assert cache.lookup("GET", "items", "", {}) is not None
@@ -0,0 +1,101 @@
+from datetime import datetime
+import json
+
+import pytest
+
+from blobs import digest
+from diff import ResponseDiffer
+from history import DeferredBody, HistoryEntry
+
+
+def make_entry(body, status=200, response_headers=None):
+    return HistoryEntry(
+        id=None,
+        method="GET",
+        path="orders/1",
+        status_code=status,
+        headers={},
+        data="",
+        response_headers=response_headers or {"Content-Type": "application/json"},
+        response_body=json.dumps(body) if not isinstance(body, (str, DeferredBody)) else body,
+        timestamp=datetime(2024, 1, 1),
+    )
+
+
+RECORDED = {
+    "id": 1,
+    "total": 10,
+    "items": [{"sku": "a", "price": 5}, {"sku": "b", "price": 5}],
+    "meta": {"request_id": "0b7c3c52-55f5-4a6e-9a5c-2a3f3b8f6a10", "generated": "2024-01-01T10:00:00Z"},
+}
+
+
+def test_json_bodies_are_diffed_by_path():
+    replayed = json.loads(json.dumps(RECORDED))
+    replayed["total"] = "10"
+    replayed["items"][1]["price"] = 6
+    replayed["items"].append({"sku": "c", "price": 1})
+    del replayed["id"]
+    replayed["currency"] = "EUR"
+
+    diff = ResponseDiffer().diff(make_entry(RECORDED), make_entry(replayed, status=201))
+    assert diff["status_code"] == {"recorded": 200, "replayed": 201}
+    assert diff["response_body"]["changes"] == [
+        {"path": "id", "recorded": 1},
+        {"path": "total", "recorded": 10, "replayed": "10"},
+        {"path": "items.1.price", "recorded": 5, "replayed": 6},
+        {"path": "items.2", "replayed": {"sku": "c", "price": 1}},
+        {"path": "currency", "replayed": "EUR"},
+    ]
+
+
+def test_formatting_and_key_order_are_not_differences():
+    reformatted = json.dumps(dict(reversed(list(RECORDED.items()))), indent=2)
+    assert ResponseDiffer().diff(make_entry(RECORDED), make_entry(reformatted)) == {}
+
+
+def test_ignore_rules_for_timestamps_and_request_ids():
+    replayed = json.loads(json.dumps(RECORDED))
+    replayed["meta"] = {"request_id": "5d0f8b1e-0000-4000-8000-000000000000", "generated": "2024-03-05T08:30:12.5Z"}
+    recorded_headers = {"Content-Type": "application/json", "X-Request-Id": "a1", "Last-Modified": "Mon, 01 Jan 2024 10:00:00 GMT"}
+    replayed_headers = {"content-type": "application/json ", "X-Request-Id": "b2", "Last-Modified": "Tue, 05 Mar 2024 08:30:12 GMT"}
+    recorded = make_entry(RECORDED, response_headers=recorded_headers)
+    replayed = make_entry(replayed, response_headers=replayed_headers)
+
+    diff = ResponseDiffer().diff(recorded, replayed)
+    assert set(diff["response_headers"]) == {"x-request-id", "last-modified"}
+    assert [change["path"] for change in diff["response_body"]["changes"]] == ["meta.request_id", "meta.generated"]
+
+    differ = ResponseDiffer(ignore_headers=["X-Request-Id"], ignore_values=["timestamps"])
+    assert [change["path"] for change in differ.diff(recorded, replayed)["response_body"]["changes"]] == [
+        "meta.request_id"
+    ]
+    assert "response_headers" not in differ.diff(recorded, replayed)
+    assert differ.extended(ignore_values=["uuids"]).diff(recorded, replayed) == {}
+    assert differ.extended(ignore_fields=["*.request_id"]).diff(recorded, replayed) == {}
+
+
+def test_identical_bodies_are_matched_by_digest_without_reading_the_recording():
+    class Unreadable(DeferredBody):
+        def load(self):
+            raise AssertionError("recorded body was read")
+
+    body = json.dumps(RECORDED)
+    recorded = make_entry(Unreadable())
+    recorded.response_body_digest = digest(body)
+    assert ResponseDiffer().diff(recorded, make_entry(body)) == {}
+
+
+def test_non_json_bodies_report_sizes_and_changes_are_capped():
+    assert ResponseDiffer().diff(make_entry("ok"), make_entry("fine"))["response_body"] == {
+        "recorded_size": 2,
+        "replayed_size": 4,
+    }
+    diff = ResponseDiffer(max_changes=3).diff(make_entry(list(range(10))), make_entry(list(range(1, 11))))
+    assert len(diff["response_body"]["changes"]) == 3
+    assert diff["response_body"]["truncated"] is True
+
+
+def test_invalid_ignore_pattern():
+    with pytest.raises(ValueError):
+        ResponseDiffer(ignore_values=["("])
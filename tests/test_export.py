@@ -0,0 +1,16 @@
+from click.testing import CliRunner
+
+import tapedeck
+
+
+def test_export_cli_streams_to_file(requests_mock, tmp_path):
+    requests_mock.get(
+        "http://localhost:54321/__/history/export?method=GET&format=ndjson",
+        text='{"id": "a"}\n{"id": "b"}\n',
+        headers={"X-Tapedeck-Cursor": "MQ=="},
+    )
+    output = tmp_path / "tape.ndjson"
+    result = CliRunner().invoke(tapedeck.cli, ["export", "--method", "GET", "--output", str(output)])
+    assert result.exit_code == 0, result.output
+    assert output.read_text().splitlines() == ['{"id": "a"}', '{"id": "b"}']
+    assert "--after MQ==" in result.output
@@ -0,0 +1,625 @@
+from datetime import datetime
+import json
+import multiprocessing
+import os
+import threading
+import time
+
+import pytest
+
+from history import HistoryEntry, HistoryManager
+from search import HistoryQuery
+from blobs import BlobStore, digest
+from storage import JsonStorage, JournalStorage, PackedStorage, SegmentedStorage, SqliteStorage
+
+
+def make_entry(i, path="/test"):
+    return HistoryEntry(
+        id=f"id-{i}",
+        method="GET",
+        path=path,
+        status_code=200,
+        headers={"Accept": "application/json"},
+        data="",
+        response_headers={"Content-Type": "application/json"},
+        response_body=f'{{"n": {i}}}',
+        timestamp=datetime(2023, 1, 1, 12, 0, i % 60),
+    )
+
+
+@pytest.fixture
+def journal_path(tmp_path):
+    return str(tmp_path / "tape.jsonl")
+
+
+def test_json_storage_round_trip(tmp_path):
+    path = str(tmp_path / "tape.json")
+    manager = HistoryManager(JsonStorage(path))
+    for i in range(3):
+        manager.append(make_entry(i))
+
+    reloaded = HistoryManager(JsonStorage(path))
+    assert [e.id for e in reloaded.get_history()] == ["id-0", "id-1", "id-2"]
+    assert reloaded.get_history()[2].timestamp == datetime(2023, 1, 1, 12, 0, 2)
+
+    storage = JsonStorage(path)
+    storage.extend([make_entry(3).to_dict()])
+    assert [record["id"] for record in storage.load()] == ["id-0", "id-1", "id-2", "id-3"]
+
+
+def test_journal_appends_one_line_per_entry(journal_path):
+    manager = HistoryManager(JournalStorage(journal_path))
+    for i in range(5):
+        manager.append(make_entry(i))
+    manager.close()
+
+    with open(journal_path) as file:
+        assert len(file.readlines()) == 5
+    reloaded = HistoryManager(JournalStorage(journal_path))
+    assert [e.id for e in reloaded.get_history()] == [f"id-{i}" for i in range(5)]
+
+
+def test_journal_drops_torn_tail(journal_path):
+    manager = HistoryManager(JournalStorage(journal_path))
+    manager.append(make_entry(0))
+    manager.append(make_entry(1))
+    manager.close()
+    with open(journal_path, "a") as file:
+        file.write('{"id": "id-2", "method": "GE')  # crash mid-write
+
+    reloaded = HistoryManager(JournalStorage(journal_path))
+    assert [e.id for e in reloaded.get_history()] == ["id-0", "id-1"]
+    reloaded.append(make_entry(3))
+    reloaded.close()
+    again = HistoryManager(JournalStorage(journal_path))
+    assert [e.id for e in again.get_history()] == ["id-0", "id-1", "id-3"]
+
+
+def test_journal_compacts_corrupt_records(journal_path):
+    with open(journal_path, "w") as file:
+        file.write("not json\n" * 50)
+    storage = JournalStorage(journal_path)
+    manager = HistoryManager(storage)
+    assert manager.get_history() == []
+    assert storage.needs_compaction()
+
+    manager.append(make_entry(0))
+    manager.close()
+    with open(journal_path) as file:
+        assert len(file.readlines()) == 1
+
+
+def test_lazy_history_reads_from_offset_index(journal_path):
+    manager = HistoryManager(JournalStorage(journal_path))
+    for i in range(20):
+        manager.append(make_entry(i))
+    manager.close()
+
+    storage = JournalStorage(journal_path)
+    lazy = HistoryManager(storage, lazy=True)
+    history = lazy.get_history()
+    assert len(history) == 20
+    assert history[7].id == "id-7"
+    assert history[-1].response_body == '{"n": 19}'
+    assert [e.id for e in history[18:]] == ["id-18", "id-19"]
+
+    lazy.append(make_entry(20))
+    assert history[20].id == "id-20"
+    lazy.close()
+
+
+def test_lazy_history_indexes_unindexed_tail(journal_path):
+    storage = JournalStorage(journal_path)
+    manager = HistoryManager(storage)
+    for i in range(3):
+        manager.append(make_entry(i))
+    manager.close()
+    # Records appended by a process that died before saving its index.
+    extra = JournalStorage(journal_path)
+    extra.load()
+    extra.append(make_entry(3).to_dict())
+    extra._timer.cancel()  # the process dies before its idle flush
+    extra._file.close()
+    with open(journal_path, "a") as file:
+        file.write('{"id": "torn')
+
+    lazy = HistoryManager(JournalStorage(journal_path), lazy=True)
+    assert [e.id for e in lazy.get_history()] == ["id-0", "id-1", "id-2", "id-3"]
+    lazy.close()
+    with open(f"{journal_path}.ids") as file:
+        assert file.read() == "id-0\nid-1\nid-2\nid-3\n"
+    assert os.path.getsize(f"{journal_path}.idx") == 4 * 8
+
+    reopened = HistoryManager(JournalStorage(journal_path), lazy=True)
+    assert reopened._by_id is None  # the id map is only built for lookups by id
+    assert reopened.get("id-3").response_body == '{"n": 3}'
+    reopened.close()
+
+
+def test_blob_store_deduplicates_bodies(journal_path, tmp_path):
+    blobs = BlobStore(str(tmp_path / "blobs"), min_size=4)
+    manager = HistoryManager(JournalStorage(journal_path), blobs=blobs)
+    for i in range(10):
+        entry = make_entry(i)
+        entry.response_body = '{"status": "unchanged"}'
+        manager.append(entry)
+    manager.close()
+
+    with open(journal_path) as file:
+        assert '"unchanged"' not in file.read()
+    assert len(list((tmp_path / "blobs").rglob("*"))) == 2  # one shard directory, one blob
+
+    reloaded = HistoryManager(JournalStorage(journal_path), blobs=BlobStore(str(tmp_path / "blobs")))
+    history = reloaded.get_history()
+    assert history[3].response_body == '{"status": "unchanged"}'
+    assert history[3].response_body is history[7].response_body
+    assert history[3].deferred("response_body").key == history[3].response_body_digest
+    assert history[3].signature() == history[7].signature()
+    assert history[3].to_dict()["response_body"] == '{"status": "unchanged"}'
+
+
+def test_rewrites_reuse_signatures_and_stored_bodies(tmp_path, monkeypatch):
+    blobs = BlobStore(str(tmp_path / "blobs"), min_size=4)
+    manager = HistoryManager(JsonStorage(str(tmp_path / "tape.json")), blobs=blobs)
+    manager.extend([make_entry(i) for i in range(3)])
+    signatures = [entry.signature_digest for entry in manager.get_history()]
+
+    def fail(*args, **kwargs):
+        raise AssertionError("already recorded entry serialized again")
+
+    monkeypatch.setattr(HistoryEntry, "signature", fail)
+    monkeypatch.setattr(blobs, "get", fail)
+    puts = []
+    monkeypatch.setattr(blobs, "put", lambda body, put=blobs.put: puts.append(body) or put(body))
+    entry = make_entry(3)
+    entry.signature_digest = "precomputed"
+    manager.append(entry)  # rewrites the whole JSON tape
+    assert puts == ['{"n": 3}']
+    monkeypatch.undo()
+
+    reloaded = HistoryManager(JsonStorage(str(tmp_path / "tape.json")), blobs=blobs)
+    assert [entry.signature_digest for entry in reloaded.get_history()] == signatures + ["precomputed"]
+    assert reloaded.get("id-1").response_body == '{"n": 1}'
+
+
+def test_entries_are_slotted_and_share_interned_strings():
+    first, second = make_entry(1), make_entry(2)
+    assert not hasattr(first, "__dict__")
+    assert first == make_entry(1) and first != second
+    assert "response_body='{\"n\": 1}'" in repr(first)
+    # Built from separately decoded JSON, as when a tape is loaded.
+    third = HistoryEntry.from_dict(json.loads(json.dumps(first.to_dict())))
+    assert third.method is first.method and third.path is first.path
+    assert next(iter(third.response_headers.values())) is next(iter(first.response_headers.values()))
+
+
+def test_compressed_bodies_are_transparent(journal_path):
+    manager = HistoryManager(JournalStorage(journal_path), compress_bodies=64)
+    entry = make_entry(1)
+    entry.response_body = '{"items": [' + ", ".join(["1"] * 200) + "]}"
+    manager.append(entry)
+    manager.append(make_entry(2))
+    manager.close()
+
+    reloaded = HistoryManager(JournalStorage(journal_path), compress_bodies=64)
+    large, small = reloaded.get_history()
+    assert large.deferred("response_body") is not None
+    assert small.deferred("response_body") is None
+    assert large.response_body == entry.response_body
+    assert large.to_dict() == entry.to_dict()
+    assert large.format_as_http_message() == entry.format_as_http_message()
+
+
+def test_signature_ignores_id_and_timestamp():
+    first, second = make_entry(1), make_entry(2)
+    second.response_body = first.response_body
+    assert first.signature() == second.signature()
+    second.status_code = 500
+    assert first.signature() != second.signature()
+
+
+@pytest.mark.parametrize("storage_class, filename", [(JournalStorage, "tape.jsonl"), (JsonStorage, "tape.json")])
+def test_concurrent_appends_keep_tape_intact(tmp_path, storage_class, filename):
+    path = str(tmp_path / filename)
+    manager = HistoryManager(storage_class(path))
+    threads, per_thread = 16, 10 if storage_class is JsonStorage else 200
+    errors = []
+
+    def writer(t):
+        try:
+            for i in range(per_thread):
+                entry = make_entry(i, path=f"/thread/{t}")
+                entry.id = f"{t}-{i}"
+                manager.append(entry)
+                manager.page(5, after=manager.last_seq() - 5)
+        except Exception as e:  # surfaced below; a failing thread would otherwise pass silently
+            errors.append(e)
+
+    workers = [threading.Thread(target=writer, args=(t,)) for t in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    manager.close()
+    assert errors == []
+
+    history = manager.get_history()
+    assert len(history) == threads * per_thread
+    for seq, entry in enumerate(history):
+        assert manager.get(entry.id) is entry
+        assert manager.at(seq) is entry
+    # Each thread's entries keep their relative order.
+    for t in range(threads):
+        ids = [e.id for e in history if e.path == f"/thread/{t}"]
+        assert ids == [f"{t}-{i}" for i in range(per_thread)]
+
+    reloaded = HistoryManager(storage_class(path))
+    assert [e.id for e in reloaded.get_history()] == [e.id for e in history]
+
+
+@pytest.fixture
+def tape_dir(tmp_path):
+    return str(tmp_path / "tape")
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_segmented_retention_deletes_unreferenced_bodies(tmp_path, tape_dir, lazy):
+    blob_dir = tmp_path / "blobs"
+    blobs = BlobStore(str(blob_dir), min_size=4)
+
+    def entry(i, body):
+        entry = make_entry(i)
+        entry.response_body = body
+        spill = tmp_path / f"spill-{i}"
+        spill.write_text(body)
+        entry.response_body_path = str(spill)
+        entry.response_size = len(body)
+        return entry
+
+    manager = HistoryManager(SegmentedStorage(tape_dir, segment_entries=2), blobs=blobs)
+    manager.extend([entry(0, "shared body"), entry(1, "first body")])
+    manager.close()
+    manager = HistoryManager(SegmentedStorage(tape_dir, segment_entries=2, max_entries=3), lazy=lazy, blobs=blobs)
+    manager.extend([entry(2, "shared body"), entry(3, "later body")])
+    manager.append(entry(4, "newest body"))
+
+    assert [e.id for e in manager.get_history()] == ["id-2", "id-3", "id-4"]
+    assert sorted(path.name for path in tmp_path.glob("spill-*")) == ["spill-2", "spill-3", "spill-4"]
+    stored = {path.name for path in blob_dir.rglob("*") if path.is_file()}
+    assert stored == {digest("shared body"), digest("later body"), digest("newest body")}
+    assert manager.at(2).response_body == "shared body"
+
+    manager.extend([entry(5, "later body"), entry(6, "newest body")])
+    assert [e.id for e in manager.get_history()] == ["id-4", "id-5", "id-6"]
+    stored = {path.name for path in blob_dir.rglob("*") if path.is_file()}
+    assert stored == {digest("later body"), digest("newest body")}
+    manager.close()
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_items_skip_entries_evicted_while_iterating(tape_dir, lazy):
+    manager = HistoryManager(SegmentedStorage(tape_dir, segment_entries=2, max_entries=4), lazy=lazy)
+    manager.extend([make_entry(i) for i in range(4)])
+    items = manager.items()
+    assert next(items)[1].id == "id-0"
+    manager.extend([make_entry(4), make_entry(5)])  # evicts id-0 and id-1
+    assert [(seq, entry.id) for seq, entry in items] == [(2, "id-2"), (3, "id-3")]
+    manager.close()
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_segmented_storage_rotates_and_reloads(tape_dir, lazy):
+    manager = HistoryManager(SegmentedStorage(tape_dir, segment_entries=5))
+    manager.extend([make_entry(i) for i in range(23)])
+    manager.close()
+    assert [meta["count"] for meta in manager.storage.segments()] == [5, 5, 5, 5, 3]
+
+    reloaded = HistoryManager(SegmentedStorage(tape_dir, segment_entries=5), lazy=lazy)
+    assert [entry.id for _, entry in reloaded.page(30)] == [f"id-{i}" for i in range(23)]
+    assert reloaded.get("id-17").response_body == '{"n": 17}'
+    reloaded.append(make_entry(23))
+    assert reloaded.last_seq() == 23
+    assert [meta["count"] for meta in reloaded.storage.segments()][-1] == 4
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_segmented_retention_archives_old_segments(tmp_path, tape_dir, lazy):
+    archive = str(tmp_path / "archive")
+    options = dict(segment_entries=5, max_entries=10, archive_dir=archive)
+    HistoryManager(SegmentedStorage(tape_dir, **options)).close()
+    manager = HistoryManager(SegmentedStorage(tape_dir, **options), lazy=lazy)
+    for i in range(30):
+        manager.append(make_entry(i))
+
+    live = [meta for meta in manager.storage.segments() if not meta["archived"]]
+    assert sum(meta["count"] for meta in live) <= 10
+    assert len(manager.get_history()) == sum(meta["count"] for meta in live)
+    assert manager.get("id-0") is None  # evicted from the id index
+    assert manager.get("id-29").id == "id-29"
+    # Archived entries stay reachable through sequence numbers.
+    assert manager.oldest_seq() == 0
+    assert manager.at(3).id == "id-3"
+    assert [entry.id for _, entry in manager.page(4, after=5)] == ["id-6", "id-7", "id-8", "id-9"]
+    assert sorted(os.listdir(archive))[0] == "segment-000000000000.jsonl"
+    manager.close()
+
+
+def test_segmented_retention_deletes_expired_segments(tape_dir):
+    storage = SegmentedStorage(tape_dir, segment_entries=2, max_age=3600)
+    manager = HistoryManager(storage)
+    manager.extend([make_entry(i) for i in range(4)])  # timestamps in 2023
+    fresh = make_entry(4)
+    fresh.timestamp = datetime.utcnow()
+    manager.append(fresh)
+
+    assert manager.oldest_seq() == 4
+    assert [entry.id for _, entry in manager.page(10)] == ["id-4"]
+    with pytest.raises(IndexError):
+        manager.at(1)
+    assert sorted(os.listdir(tape_dir)) == [
+        "segment-000000000004.jsonl",
+        "segment-000000000004.jsonl.ids",
+        "segment-000000000004.jsonl.idx",
+        "segments.json",
+    ]
+    manager.close()
+
+
+BINARY = bytes(range(256)) * 4
+
+
+def make_binary_entry(i):
+    entry = make_entry(i)
+    entry.data = b"\xff\x00upload" + bytes([i])
+    entry.response_body = BINARY
+    return entry
+
+
+def test_binary_bodies_round_trip_through_json_api():
+    entry = make_binary_entry(1)
+    as_dict = entry.to_dict()
+    assert as_dict["response_body_encoding"] == "base64"
+    assert HistoryEntry.from_dict(as_dict).response_body == BINARY
+
+
+@pytest.mark.parametrize(
+    "storage_class, filename",
+    [(JournalStorage, "tape.jsonl"), (PackedStorage, "tape.pack"), (SqliteStorage, "tape.sqlite")],
+)
+def test_storages_round_trip_binary_bodies(tmp_path, storage_class, filename):
+    path = str(tmp_path / filename)
+    manager = HistoryManager(storage_class(path))
+    manager.extend([make_binary_entry(i) for i in range(3)] + [make_entry(3)])
+    manager.close()
+
+    for lazy in (False, True):
+        reloaded = HistoryManager(storage_class(path), lazy=lazy)
+        history = reloaded.get_history()
+        assert [entry.data for entry in history[:3]] == [b"\xff\x00upload" + bytes([i]) for i in range(3)]
+        assert history[0].response_body == BINARY
+        assert history[3].response_body == '{"n": 3}'
+        reloaded.close()
+
+
+@pytest.mark.parametrize("compression", PackedStorage.CODECS)
+def test_packed_storage_is_compact_and_reads_lazily(tmp_path, journal_path, compression):
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+    path = str(tmp_path / "tape.pack")
+    entries = [make_entry(i) for i in range(200)]
+    HistoryManager(JournalStorage(journal_path)).extend(entries)
+    manager = HistoryManager(PackedStorage(path, compression=compression))
+    manager.extend(entries)
+    manager.close()
+    if compression != "none":
+        assert os.path.getsize(path) * 5 < os.path.getsize(journal_path)
+
+    reloaded = HistoryManager(PackedStorage(path), lazy=True)
+    assert reloaded.get("id-150").response_body == '{"n": 150}'
+    reloaded.extend([make_entry(200)])  # buffered, but readable before it is written
+    assert reloaded.at(200).id == "id-200"
+    reloaded.close()
+    assert [e.id for e in HistoryManager(PackedStorage(path)).get_history()][-2:] == ["id-199", "id-200"]
+
+
+def test_journal_syncs_records_and_index_when_idle(journal_path):
+    manager = HistoryManager(JournalStorage(journal_path, fsync_interval=0.05))
+    manager.append(make_entry(0))
+    deadline = time.monotonic() + 5
+    while not os.path.exists(f"{journal_path}.idx") or not os.path.getsize(f"{journal_path}.idx"):
+        assert time.monotonic() < deadline
+        time.sleep(0.02)
+    with open(f"{journal_path}.ids") as file:
+        assert file.read() == "id-0\n"
+    manager.close()
+
+
+def test_packed_storage_writes_buffered_records_when_idle(tmp_path):
+    path = str(tmp_path / "tape.pack")
+    manager = HistoryManager(PackedStorage(path, fsync_every=100, fsync_interval=0.05))
+    manager.append(make_entry(0))
+    deadline = time.monotonic() + 5
+    while not PackedStorage(path).load() and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert [record["id"] for record in PackedStorage(path).load()] == ["id-0"]
+    manager.close()
+
+
+def test_packed_storage_drops_torn_tail(tmp_path):
+    path = str(tmp_path / "tape.pack")
+    storage = PackedStorage(path, fsync_every=2)
+    manager = HistoryManager(storage)
+    manager.extend([make_entry(0), make_entry(1)])
+    manager.extend([make_entry(2), make_entry(3)])
+    manager.close()
+    size = os.path.getsize(path)
+    with open(path, "r+b") as file:
+        file.truncate(size - 3)  # crash in the middle of writing the second block
+
+    reloaded = HistoryManager(PackedStorage(path))
+    assert [e.id for e in reloaded.get_history()] == ["id-0", "id-1"]
+    reloaded.append(make_entry(4))
+    reloaded.close()
+    assert [e.id for e in HistoryManager(PackedStorage(path)).get_history()] == ["id-0", "id-1", "id-4"]
+
+
+def test_segmented_storage_with_packed_segments(tape_dir):
+    manager = HistoryManager(SegmentedStorage(tape_dir, segment_entries=5))
+    manager.extend([make_entry(i) for i in range(7)])
+    manager.close()
+    # Switching format keeps the existing segments readable.
+    options = dict(segment_entries=5, segment_format="pack", compression="zlib")
+    manager = HistoryManager(SegmentedStorage(tape_dir, **options), lazy=True)
+    manager.extend([make_binary_entry(i) for i in range(7, 12)])
+    manager.close()
+    assert [meta["name"] for meta in manager.storage.segments()] == [
+        "segment-000000000000.jsonl",
+        "segment-000000000005.jsonl",
+        "segment-000000000010.pack",
+    ]
+    reloaded = HistoryManager(SegmentedStorage(tape_dir, **options))
+    assert [e.id for e in reloaded.get_history()] == [f"id-{i}" for i in range(12)]
+    assert reloaded.get("id-11").response_body == BINARY
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_sqlite_tape_is_shared_between_managers(tmp_path, lazy):
+    path = str(tmp_path / "tape.sqlite")
+    first = HistoryManager(SqliteStorage(path), lazy=lazy)
+    second = HistoryManager(SqliteStorage(path), lazy=lazy)
+    seen = []
+    second.add_listener(lambda seq, entry: seen.append((seq, entry.id)))
+
+    first.extend([make_entry(0), make_entry(1)])
+    second.append(make_entry(2))  # takes in the first manager's entries before its own
+    first.append(make_entry(3))
+    assert seen == [(0, "id-0"), (1, "id-1"), (2, "id-2")]
+    assert second.last_seq() == 2
+    second.refresh()
+    assert seen[-1] == (3, "id-3")
+
+    for manager in (first, second):
+        manager.refresh()
+        assert [entry.id for _, entry in manager.page(10)] == [f"id-{i}" for i in range(4)]
+        assert manager.get("id-2").response_body == '{"n": 2}'
+        manager.close()
+
+
+def record_from_process(path, worker, count):
+    manager = HistoryManager(SqliteStorage(path))
+    for i in range(count):
+        entry = make_entry(i, path=f"/worker/{worker}")
+        entry.id = f"{worker}-{i}"
+        manager.append(entry)
+    manager.close()
+
+
+def test_sqlite_tape_takes_appends_from_several_processes(tmp_path):
+    path = str(tmp_path / "tape.sqlite")
+    HistoryManager(SqliteStorage(path)).close()  # create the database before the writers race
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=record_from_process, args=(path, w, 50)) for w in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert [process.exitcode for process in processes] == [0] * 4
+
+    history = HistoryManager(SqliteStorage(path)).get_history()
+    assert len(history) == 200
+    for w in range(4):
+        assert [e.id for e in history if e.path == f"/worker/{w}"] == [f"{w}-{i}" for i in range(50)]
+
+
+def varied_entry(i):
+    entry = make_entry(i % 7, path=f"/orders/{i % 5}" if i % 3 else f"/users/{i % 4}")
+    entry.id = f"id-{i}"
+    entry.method = "POST" if i % 4 == 0 else "GET"
+    entry.status_code = 500 if i % 6 == 0 else 200
+    entry.timestamp = datetime(2023, 1, 1, 12, i // 60, i % 60)
+    return entry
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        None,
+        HistoryQuery(methods=["POST"]),
+        HistoryQuery(path="users/", status_min=500, status_max=599),
+        HistoryQuery(path="*/3"),
+        HistoryQuery(since=datetime(2023, 1, 1, 12, 0, 30), until=datetime(2023, 1, 1, 12, 1, 10)),
+    ],
+)
+def test_sqlite_queries_match_in_memory_indexes(tmp_path, journal_path, query):
+    expected = HistoryManager(JournalStorage(journal_path))
+    indexed = HistoryManager(SqliteStorage(str(tmp_path / "tape.sqlite")), lazy=True)
+    for manager in (expected, indexed):
+        manager.extend([varied_entry(i) for i in range(150)])
+
+    def ids(manager, **options):
+        if query is None:
+            pairs = manager.page(7, **options)
+        else:
+            pairs = manager.search(query, 7, **options)
+        return [(seq, entry.id) for seq, entry in pairs]
+
+    for unique in (False, True):
+        for cursor in ({}, {"after": 40}, {"before": 120}):
+            assert ids(indexed, unique=unique, **cursor) == ids(expected, unique=unique, **cursor)
+    assert indexed.get("id-77").id == "id-77"
+    assert indexed.get("missing") is None
+    entry = expected.at(3)
+    assert indexed.occurrences(entry) == expected.occurrences(entry)
+
+
+def test_lazy_sqlite_tape_opens_without_reading_every_id(tmp_path):
+    path = str(tmp_path / "tape.sqlite")
+    HistoryManager(SqliteStorage(path)).extend([make_entry(i) for i in range(3)])
+    storage = SqliteStorage(path)
+    storage.ids = None  # an indexed storage answers lookups by id itself
+    manager = HistoryManager(storage, lazy=True)
+    assert manager.get("id-1").id == "id-1"
+    manager.close()
+
+
+def test_migrate_json_tape_to_sqlite(tmp_path):
+    from click.testing import CliRunner
+    from tapedeck import cli
+
+    source, destination = str(tmp_path / "tape.json"), str(tmp_path / "tape.sqlite")
+    legacy = HistoryManager(JsonStorage(source))
+    legacy.extend([make_entry(i % 3) for i in range(7)] + [make_binary_entry(7)])
+    legacy.close()
+
+    result = CliRunner().invoke(cli, ["migrate", source, destination, "--batch-size", "3"])
+    assert result.exit_code == 0, result.output
+    assert "Copied 8 entries" in result.output
+
+    migrated = HistoryManager(SqliteStorage(destination))
+    assert [e.id for e in migrated.get_history()] == [e.id for e in HistoryManager(JsonStorage(source)).get_history()]
+    assert migrated.get("id-7").response_body == BINARY
+    assert [seq for seq, _ in migrated.page(10, unique=True)] == [0, 1, 2, 7]
+    migrated.close()
+    assert CliRunner().invoke(cli, ["migrate", source, destination]).exit_code != 0
+
+
+def store_blobs(directory, start):
+    start.wait()
+    blobs = BlobStore(directory)
+    for i in range(300):
+        blobs.put(f"shared body {i} " * 10)
+
+
+def test_blob_store_is_shared_between_processes(tmp_path):
+    directory = str(tmp_path / "blobs")
+    context = multiprocessing.get_context("fork")
+    start = context.Event()
+    processes = [context.Process(target=store_blobs, args=(directory, start)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    start.set()
+    for process in processes:
+        process.join()
+    assert [process.exitcode for process in processes] == [0] * 4
+    assert not list((tmp_path / "blobs").rglob("*.tmp"))
+    assert BlobStore(directory).get(BlobStore(directory).put("shared body 7 " * 10)[0]) == "shared body 7 " * 10
@@ -0,0 +1,59 @@
+from metrics import Metrics, RollingHistogram, route_template
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_route_template_collapses_ids():
+    assert route_template("orders/42/items") == "/orders/{id}/items"
+    assert route_template("/users/5f2b1c9e8a4d3e7f6a1b2c3d") == "/users/{id}"
+    assert route_template("v2/status") == "/v2/status"
+
+
+def test_rolling_histogram_forgets_old_slices():
+    histogram = RollingHistogram(buckets=(0.1, 1.0), window=60, slices=6)
+    histogram.observe(0.05, now=0)
+    histogram.observe(0.5, now=30)
+    assert histogram.snapshot(now=50) == ([1, 1, 0], 0.55, 2)
+    assert histogram.snapshot(now=65)[2] == 1
+    assert histogram.snapshot(now=95) == ([0, 0, 0], 0.0, 0)
+
+
+def test_rolling_histogram_quantile_interpolates():
+    histogram = RollingHistogram(buckets=(1.0, 2.0))
+    assert histogram.quantile(0.5, [0, 0, 0]) is None
+    assert histogram.quantile(0.5, [2, 2, 0]) == 1.0
+    assert histogram.quantile(0.75, [2, 2, 0]) == 1.5
+    assert histogram.quantile(0.99, [0, 0, 3]) == 2.0
+
+
+def test_render_prometheus_text():
+    clock = Clock()
+    metrics = Metrics(buckets=(0.01, 0.1), window=10, clock=clock)
+    metrics.observe("GET", "/orders/{id}", 200, {"upstream": 5.0, "total": 50.0})
+    metrics.observe("GET", "/orders/{id}", 200, {"upstream": 7.0, "total": 150.0})
+    text = metrics.render()
+    assert 'tapedeck_requests_total{method="GET",route="/orders/{id}",status="200"} 2' in text
+    labels = 'method="GET",route="/orders/{id}",phase="total"'
+    assert f'tapedeck_phase_duration_seconds_bucket{{{labels},le="0.01"}} 0' in text
+    assert f'tapedeck_phase_duration_seconds_bucket{{{labels},le="0.1"}} 1' in text
+    assert f'tapedeck_phase_duration_seconds_bucket{{{labels},le="+Inf"}} 2' in text
+    assert f"tapedeck_phase_duration_seconds_sum{{{labels}}} 0.200000" in text
+    assert 'tapedeck_recent_requests_per_second{method="GET",route="/orders/{id}"} 0.200000' in text
+
+    clock.now += 20
+    text = metrics.render()
+    assert f"tapedeck_recent_phase_duration_seconds_count{{{labels}}} 0" in text
+    assert f'tapedeck_recent_phase_duration_seconds{{{labels},quantile="0.5"}} NaN' in text
+    assert f"tapedeck_phase_duration_seconds_count{{{labels}}} 2" in text
+
+
+def test_label_values_are_escaped():
+    metrics = Metrics()
+    metrics.observe("GET", '/a"b\\c', 200, {})
+    assert 'route="/a\\"b\\\\c"' in metrics.render()
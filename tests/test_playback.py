@@ -0,0 +1,48 @@
+from datetime import datetime
+
+from history import HistoryEntry
+from playback import MatchRules, PlaybackIndex
+
+
+def make_entry(method="GET", path="items", query="", data=""):
+    return HistoryEntry(
+        id=f"{method} {path}?{query}",
+        method=method,
+        path=path,
+        status_code=200,
+        headers={},
+        data=data,
+        response_headers={},
+        response_body="",
+        timestamp=datetime(2023, 1, 1),
+        query=query,
+    )
+
+
+def test_query_parameter_order_does_not_matter():
+    index = PlaybackIndex()
+    index.add(0, make_entry(query="a=1&b=2"))
+    assert index.lookup("GET", "/items", "b=2&a=1", "") == 0
+    assert index.lookup("GET", "items", "a=1", "") is None
+    assert index.lookup("POST", "items", "a=1&b=2", "") is None
+    assert (index.hits, index.misses) == (1, 2)
+
+
+def test_newest_recording_wins():
+    index = PlaybackIndex()
+    index.build(enumerate([make_entry(), make_entry()]))
+    assert index.lookup("GET", "items", "", "") == 1
+
+
+def test_ignored_params_and_method():
+    index = PlaybackIndex(MatchRules(method=False, ignore_params=["_"]))
+    index.add(0, make_entry(query="q=x&_=123"))
+    assert index.lookup("HEAD", "items", "q=x&_=999", "") == 0
+
+
+def test_body_hash_matching():
+    index = PlaybackIndex(MatchRules(body=True))
+    index.add(0, make_entry(method="POST", data='{"a": 1}'))
+    index.add(1, make_entry(method="POST", data='{"a": 2}'))
+    assert index.lookup("POST", "items", "", '{"a": 1}') == 0
+    assert index.lookup("POST", "items", "", '{"a": 3}') is None
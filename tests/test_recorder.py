@@ -0,0 +1,108 @@
+import threading
+import time
+
+from recorder import BackgroundRecorder, BodyRecorder
+
+
+def test_body_recorder_keeps_small_bodies():
+    recorder = BodyRecorder(limit=10)
+    recorder.write(b"hello")
+    recorder.close()
+    assert recorder.body() == "hello"
+    assert not recorder.truncated
+    assert recorder.spill_path is None
+
+
+def test_body_recorder_truncates():
+    recorder = BodyRecorder(limit=4)
+    for chunk in (b"abc", b"def", b"ghi"):
+        recorder.write(chunk)
+    recorder.close()
+    assert recorder.body() == "abcd"
+    assert recorder.truncated
+    assert recorder.size == 9
+
+
+def test_body_recorder_spills_to_disk(tmp_path):
+    recorder = BodyRecorder(limit=4, overflow="spill", spill_dir=str(tmp_path))
+    for chunk in (b"abc", b"def", b"ghi"):
+        recorder.write(chunk)
+    recorder.close()
+    assert recorder.body() == ""
+    with open(recorder.spill_path, "rb") as file:
+        assert file.read() == b"abcdefghi"
+
+
+class SlowManager:
+    """Stands in for HistoryManager; holds the writer until released."""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.batches = []
+
+    def extend(self, entries):
+        self.release.wait(5)
+        self.batches.append(list(entries))
+
+    def recorded(self):
+        return [entry for batch in self.batches for entry in batch]
+
+
+def test_background_recorder_writes_in_batches():
+    manager = SlowManager()
+    recorder = BackgroundRecorder(manager, batch_size=50)
+    for i in range(120):
+        recorder.submit(i)
+    manager.release.set()
+    assert recorder.flush(timeout=5)
+    recorder.close()
+    assert manager.recorded() == list(range(120))
+    assert max(len(batch) for batch in manager.batches) <= 50
+    stats = recorder.stats()
+    assert stats["recorded"] == 120
+    assert stats["queue_depth"] == 0
+    assert stats["dropped"] == 0
+
+
+def test_background_recorder_drop_oldest():
+    manager = SlowManager()
+    recorder = BackgroundRecorder(manager, max_size=5, policy="drop-oldest", batch_size=1)
+    recorder.submit("first")  # taken by the writer, which then waits
+    time.sleep(0.1)
+    for i in range(8):
+        recorder.submit(i)
+    assert recorder.stats()["dropped"] == 3
+    manager.release.set()
+    recorder.close()
+    assert manager.recorded() == ["first", 3, 4, 5, 6, 7]
+
+
+def test_background_recorder_sample():
+    manager = SlowManager()
+    recorder = BackgroundRecorder(manager, max_size=10, policy="sample", batch_size=1, sample_every=4)
+    recorder.submit("first")
+    time.sleep(0.1)
+    accepted = sum(recorder.submit(i) for i in range(40))
+    stats = recorder.stats()
+    assert stats["queue_depth"] <= 10
+    assert accepted == stats["queue_depth"]
+    assert stats["dropped"] == 40 - accepted
+    manager.release.set()
+    recorder.close()
+
+
+def test_background_recorder_block():
+    manager = SlowManager()
+    recorder = BackgroundRecorder(manager, max_size=2, policy="block", batch_size=1)
+    recorder.submit("first")
+    time.sleep(0.1)
+    recorder.submit(1)
+    recorder.submit(2)
+    blocked = threading.Thread(target=recorder.submit, args=(3,))
+    blocked.start()
+    blocked.join(0.2)
+    assert blocked.is_alive()
+    manager.release.set()
+    blocked.join(5)
+    recorder.close()
+    assert manager.recorded() == ["first", 1, 2, 3]
@@ -0,0 +1,166 @@
+from datetime import datetime, timedelta
+import json
+import re
+import threading
+import time
+
+from click.testing import CliRunner
+import pytest
+import requests
+
+from history import HistoryEntry
+from replay import BatchReplay, diff_responses, load_report, summarize
+import tapedeck
+
+START = datetime(2023, 1, 1, 12, 0, 0)
+
+
+def make_entry(i, gap=0.0):
+    return HistoryEntry(
+        id=f"id-{i}",
+        method="GET",
+        path=f"items/{i}",
+        status_code=200,
+        headers={},
+        data="",
+        response_headers={"Content-Type": "text/plain", "Date": "Sun, 01 Jan 2023 12:00:00 GMT"},
+        response_body=f"item {i}",
+        timestamp=START + timedelta(seconds=i * gap),
+    )
+
+
+def fake_response(entry, body=None, status=200):
+    response = requests.Response()
+    response.status_code = status
+    response.headers["Content-Type"] = "text/plain"
+    response.headers["Date"] = "Mon, 02 Jan 2023 08:00:00 GMT"
+    response._content = (body if body is not None else entry.response_body).encode("utf-8")
+    response.request = requests.Request("GET", f"http://staging/{entry.path}").prepare()
+    return response
+
+
+def test_batch_replay_diffs_and_keeps_order():
+    def send(entry):
+        if entry.id == "id-3":
+            raise requests.ConnectionError("refused")
+        if entry.id == "id-1":
+            return fake_response(entry, body="changed", status=500)
+        return fake_response(entry)
+
+    results = BatchReplay(send, concurrency=4).run([make_entry(i) for i in range(5)])
+    assert [result["id"] for result in results] == [f"id-{i}" for i in range(5)]
+    assert results[0]["match"] and results[0]["diff"] == {}  # Date differs but is volatile
+    assert results[1]["diff"]["status_code"] == {"recorded": 200, "replayed": 500}
+    assert results[1]["diff"]["response_body"] == {"recorded_size": 6, "replayed_size": 7}
+    assert "ConnectionError" in results[3]["error"]
+    assert summarize(results)["mismatched"] == 1
+    assert summarize(results)["errors"] == 1
+
+
+def test_batch_replay_respects_concurrency():
+    lock = threading.Lock()
+    in_flight = []
+    peak = []
+
+    def send(entry):
+        with lock:
+            in_flight.append(entry)
+            peak.append(len(in_flight))
+        time.sleep(0.01)
+        with lock:
+            in_flight.remove(entry)
+        return fake_response(entry)
+
+    BatchReplay(send, concurrency=3).run([make_entry(i) for i in range(20)])
+    assert max(peak) == 3
+
+
+@pytest.mark.parametrize("options, minimum", [({"rate": 20}, 0.18), ({"timing": "recorded", "speed": 10}, 0.18)])
+def test_batch_replay_paces_requests(options, minimum):
+    entries = [make_entry(i, gap=0.5) for i in range(5)]  # recorded 2s apart in total
+    started = time.monotonic()
+    BatchReplay(fake_response, concurrency=5, **options).run(entries)
+    assert minimum <= time.monotonic() - started < 1.0
+
+
+def test_diff_ignores_header_case():
+    recorded = make_entry(1)
+    replayed = make_entry(1)
+    replayed.response_headers = {"content-type": "text/plain"}
+    assert diff_responses(recorded, replayed) == {}
+    replayed.response_headers["X-New"] = "1"
+    assert diff_responses(recorded, replayed) == {"response_headers": {"x-new": {"recorded": None, "replayed": "1"}}}
+
+
+def test_batch_replay_cli(requests_mock):
+    requests_mock.post(
+        f"{tapedeck.PROXY_SERVICE_URL}/__/replay/batch",
+        json={
+            "results": [{"id": "a", "method": "GET", "path": "x", "status_code": 200, "latency_ms": 1.5, "match": True, "diff": {}}],
+            "summary": {"total": 1, "matched": 1, "mismatched": 0, "errors": 0},
+        },
+    )
+    result = CliRunner().invoke(tapedeck.cli, ["batch-replay", "--method", "POST", "--status", "5xx", "--rate", "10"])
+    assert result.exit_code == 0, result.output
+    assert "200 GET /x 1.5ms match" in result.output
+    assert requests_mock.last_request.json() == {
+        "concurrency": 8,
+        "timing": "fast",
+        "speed": 1.0,
+        "filter": {"method": "POST", "status": "5xx"},
+        "rate": 10.0,
+    }
+
+
+def test_load_report_percentiles_and_endpoints():
+    results = [
+        {"method": "GET", "path": f"orders/{i}", "status_code": 200, "latency_ms": float(i)} for i in range(1, 101)
+    ]
+    results.append({"method": "POST", "path": "orders", "status_code": 503, "latency_ms": 3.0})
+    results.append({"method": "POST", "path": "orders", "error": "ConnectionError", "latency_ms": 1.0})
+    report = load_report(results, duration=2.0, target_rate=60)
+
+    assert report["requests"] == 102
+    assert report["errors"] == 2
+    orders = report["endpoints"]["GET /orders/{id}"]
+    assert orders["latency_ms"]["p50"] == 50.0
+    assert orders["latency_ms"]["p95"] == 95.0
+    assert orders["latency_ms"]["p99"] == 99.0
+    assert orders["throughput_rps"] == 50.0
+    assert sum(bucket["count"] for bucket in orders["histogram"]) == 100
+    assert report["endpoints"]["POST /orders"]["statuses"] == {"5xx": 1, "failed": 1}
+    assert report["endpoints"]["POST /orders"]["error_rate"] == 1.0
+
+
+def test_load_test_cli(requests_mock):
+    history = [make_entry(i, gap=0.05).to_dict() for i in range(6)]
+    requests_mock.get(f"{tapedeck.PROXY_SERVICE_URL}/__/history", json={"history": history, "next": None})
+    requests_mock.get(re.compile(r"http://target\.test/items/\d"), text="ok")
+    requests_mock.get("http://target.test/items/5", status_code=503)
+
+    result = CliRunner().invoke(tapedeck.cli, ["load-test", "http://target.test", "--speed", "2", "--json"])
+    assert result.exit_code == 0, result.output
+    report = json.loads(result.output)
+    assert report["requests"] == 6
+    assert report["errors"] == 1
+    assert report["target_rps"] == 6 / 0.125
+    assert report["duration_s"] >= 0.1  # 0.25s recorded, replayed twice as fast
+    assert list(report["endpoints"]) == ["GET /items/{id}"]
+
+
+def test_batch_replay_cli_sends_ignore_rules_and_describes_diffs(requests_mock):
+    diff = {
+        "status_code": {"recorded": 200, "replayed": 500},
+        "response_body": {"recorded_size": 20, "replayed_size": 30, "changes": [{"path": f"items.{i}"} for i in range(5)]},
+    }
+    requests_mock.post(
+        f"{tapedeck.PROXY_SERVICE_URL}/__/replay/batch",
+        json={
+            "results": [{"id": "a", "method": "GET", "path": "x", "status_code": 500, "latency_ms": 1.5, "match": False, "diff": diff}],
+            "summary": {"total": 1, "matched": 0, "mismatched": 1, "errors": 0},
+        },
+    )
+    result = CliRunner().invoke(tapedeck.cli, ["batch-replay", "a", "--ignore-field", "*.updated_at", "--ignore-value", "uuids"])
+    assert result.exit_code == 1
+    assert "DIFF status 200->500, body: items.0, items.1, items.2 and 2 more" in result.output
+    assert requests_mock.last_request.json()["ignore"] == {"headers": [], "fields": ["*.updated_at"], "values": ["uuids"]}
@@ -0,0 +1,130 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from history import HistoryEntry, HistoryManager
+from search import HistoryQuery
+from storage import JournalStorage, SegmentedStorage
+
+START = datetime(2023, 1, 1, 12, 0, 0)
+
+
+def make_entry(i):
+    return HistoryEntry(
+        id=f"id-{i}",
+        method="POST" if i % 3 == 0 else "GET",
+        path=f"orders/{i}" if i % 2 == 0 else f"users/{i}",
+        status_code=500 if i % 5 == 0 else 200,
+        headers={"X-Client": "mobile" if i % 4 == 0 else "web"},
+        data="",
+        response_headers={"Content-Type": "application/json"},
+        response_body=f'{{"n": {i}, "error": {str(i % 5 == 0).lower()}}}',
+        timestamp=START + timedelta(minutes=i),
+    )
+
+
+@pytest.fixture
+def manager(tmp_path):
+    manager = HistoryManager(JournalStorage(str(tmp_path / "tape.jsonl")))
+    manager.extend([make_entry(i) for i in range(100)])
+    yield manager
+    manager.close()
+
+
+def query(**args):
+    return HistoryQuery.from_args({name: [value] for name, value in args.items()})
+
+
+def expected(manager, q):
+    return [seq for seq, entry in manager.items() if q.matches(entry)]
+
+
+def expected_ids(manager, q):
+    return [entry.id for _, entry in manager.items() if q.matches(entry)]
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        {"method": "POST", "status": "5xx", "path": "/orders"},
+        {"path": "users/1*"},
+        {"path": "*/1?"},
+        {"path": "orders/[12]0", "status": "500-599"},
+        {"path": "users/9"},
+        {"status": "200-299", "method": "get,post"},
+        {"since": "2023-01-01T12:30:00", "until": "2023-01-01T13:00:00Z"},
+        {"header": "X-Client: mobile"},
+        {"header": "content-type"},
+        {"body": '"error": true'},
+    ],
+)
+def test_search_matches_a_full_scan(manager, args):
+    q = query(**args)
+    found = [seq for seq, _ in manager.search(q, 1000)]
+    assert found == expected(manager, q)
+    assert found
+
+
+def test_search_pages_in_both_directions(manager):
+    q = query(method="POST", status="5xx")
+    matches = expected(manager, q)
+    first = manager.search(q, 2)
+    assert [seq for seq, _ in first] == matches[:2]
+    second = manager.search(q, 2, after=first[-1][0])
+    assert [seq for seq, _ in second] == matches[2:4]
+    assert [seq for seq, _ in manager.search(q, 2, before=second[0][0])] == matches[:2]
+
+
+def test_search_index_follows_appends_and_eviction(tmp_path):
+    manager = HistoryManager(SegmentedStorage(str(tmp_path / "tape"), segment_entries=10, max_entries=20))
+    q = query(status="500")
+    manager.extend([make_entry(i) for i in range(15)])
+    assert [entry.id for _, entry in manager.search(q, 10)] == ["id-0", "id-5", "id-10"]
+    manager.extend([make_entry(i) for i in range(15, 40)])
+    assert [entry.id for _, entry in manager.search(q, 10)] == expected_ids(manager, q)
+    assert manager.search(q, 10)[0][0] >= manager.oldest_seq()
+    manager.close()
+
+
+def test_query_parsing():
+    assert HistoryQuery.from_args({}) is None
+    assert HistoryQuery.from_args({"limit": ["5"]}) is None
+    assert HistoryQuery.parse_status("4xx") == (400, 499)
+    assert HistoryQuery.parse_status("404") == (404, 404)
+    for args in ({"status": ["abc"]}, {"since": ["yesterday"]}, {"header": [":x"]}):
+        with pytest.raises(ValueError):
+            HistoryQuery.from_args(args)
+
+
+def test_unique_pages_across_the_whole_tape(tmp_path):
+    manager = HistoryManager(JournalStorage(str(tmp_path / "tape.jsonl")))
+    polls = []
+    for i in range(30):
+        entry = make_entry(i % 4)  # four distinct exchanges, recorded over and over
+        entry.id = f"poll-{i}"
+        polls.append(entry)
+    manager.extend(polls)
+
+    first = manager.page(3, unique=True)
+    assert [seq for seq, _ in first] == [0, 1, 2]
+    assert [seq for seq, _ in manager.page(3, after=2, unique=True)] == [3]
+    assert [seq for seq, _ in manager.page(3, before=3, unique=True)] == [0, 1, 2]
+    assert [manager.occurrences(entry) for _, entry in first] == [8, 8, 7]
+    assert [seq for seq, _ in manager.search(query(method="GET"), 10, unique=True)] == [1, 2]
+    manager.close()
+
+    # Signatures are stored with the entries, so a reloaded tape doesn't recompute them.
+    reloaded = HistoryManager(JournalStorage(str(tmp_path / "tape.jsonl")), lazy=True)
+    assert reloaded.at(5).signature_digest == polls[1].signature()
+    assert [seq for seq, _ in reloaded.page(10, unique=True)] == [0, 1, 2, 3]
+    reloaded.close()
+
+
+def test_unique_index_follows_eviction(tmp_path):
+    manager = HistoryManager(SegmentedStorage(str(tmp_path / "tape"), segment_entries=4, max_entries=8))
+    manager.extend([make_entry(i) for i in range(4)])
+    assert [seq for seq, _ in manager.page(10, unique=True)] == [0, 1, 2, 3]
+    manager.extend([make_entry(i % 2) for i in range(8)])  # evicts the first segment
+    assert [seq for seq, _ in manager.page(10, unique=True)] == [4, 5]
+    assert manager.occurrences(manager.at(4)) == 4
+    manager.close()
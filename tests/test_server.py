@@ -0,0 +1,436 @@
+import io
+import json
+
+import pytest
+import requests
+from requests_mock import ANY
+
+import cassette
+from cassette import app, encode_cursor
+from history import HistoryEntry, HistoryManager
+from playback import PlaybackIndex
+from recorder import BackgroundRecorder
+from storage import JournalStorage, SegmentedStorage, SqliteStorage
+
+
+@pytest.fixture
+def history_manager(tmp_path, monkeypatch):
+    manager = HistoryManager(JournalStorage(str(tmp_path / "tape.jsonl")))
+    monkeypatch.setattr(cassette, "history_manager", manager)
+    yield manager
+    manager.close()
+
+
+@pytest.fixture
+def client(requests_mock, history_manager):
+    requests_mock.register_uri(
+        ANY,
+        "http://example.com/test",
+        text='{"response": "ok"}',
+        headers={"Content-Type": "application/json"},
+    )
+    app.config["UPSTREAM_URL"] = "http://example.com"
+    with app.test_client() as client:
+        yield client
+
+
+def test_proxy_records_entry(client, history_manager):
+    response = client.get("/test")
+    assert response.status_code == 200
+    entry = history_manager.get_history()[-1]
+    assert entry.path == "test"
+    assert history_manager.get(entry.id) is entry
+
+
+def test_history_cursors_walk_the_tape(client):
+    for _ in range(25):
+        client.get("/test")
+
+    first = client.get("/__/history?limit=10").json
+    assert len(first["history"]) == 10
+    assert first["previous"] is None
+
+    second = client.get(f"/__/history?limit=10&after={first['next']}").json
+    ids = [e["id"] for e in first["history"] + second["history"]]
+    assert len(set(ids)) == 20
+
+    back = client.get(f"/__/history?limit=10&before={second['previous']}").json
+    assert [e["id"] for e in back["history"]] == ids[:10]
+
+
+def test_history_cursor_is_stable_while_appending(client):
+    for _ in range(5):
+        client.get("/test")
+    page = client.get("/__/history?limit=3").json
+    for _ in range(5):
+        client.get("/test")
+    following = client.get(f"/__/history?limit=3&after={page['next']}").json
+    assert following["history"][0]["id"] not in {e["id"] for e in page["history"]}
+    assert following["previous"] == encode_cursor(3)
+
+
+def test_history_rejects_bad_cursor(client):
+    response = client.get("/__/history?after=not-a-cursor")
+    assert response.status_code == 400
+
+
+def test_history_filters(client, requests_mock):
+    requests_mock.register_uri(ANY, "http://example.com/orders/1", status_code=503, text="down")
+    for _ in range(3):
+        client.get("/test")
+        client.post("/orders/1", data="{}")
+
+    page = client.get("/__/history?method=POST&status=5xx&path=/orders&limit=2").json
+    assert [(e["method"], e["status_code"]) for e in page["history"]] == [("POST", 503)] * 2
+    assert page["previous"] is None
+    rest = client.get(f"/__/history?method=POST&status=5xx&path=/orders&limit=2&after={page['next']}").json
+    assert len(rest["history"]) == 1
+    assert rest["next"] is None
+    assert client.get("/__/history?body=down&limit=10").json["history"][0]["path"] == "orders/1"
+    assert client.get("/__/history?status=teapot").status_code == 400
+
+
+def test_history_unique_is_tape_wide(client):
+    for _ in range(3):
+        client.get("/test")
+        client.post("/test", data="payload")
+    page = client.get("/__/history?unique=true&counts=true&limit=1").json
+    assert [(e["method"], e["occurrences"]) for e in page["history"]] == [("GET", 3)]
+    rest = client.get(f"/__/history?unique=true&limit=5&after={page['next']}").json
+    assert [e["method"] for e in rest["history"]] == ["POST"]
+    assert rest["next"] is None
+
+
+def test_history_export_streams_in_batches(client, requests_mock, monkeypatch):
+    monkeypatch.setitem(app.config, "EXPORT_BATCH_SIZE", 2)
+    requests_mock.register_uri(ANY, "http://example.com/orders/1", status_code=503, text="down")
+    for _ in range(3):
+        client.get("/test")
+        client.post("/orders/1", data="{}")
+
+    response = client.get("/__/history/export")
+    assert response.is_streamed
+    assert response.mimetype == "application/x-ndjson"
+    lines = response.get_data(as_text=True).splitlines()
+    assert [json.loads(line)["path"] for line in lines] == ["test", "orders/1"] * 3
+
+    document = client.get("/__/history/export?format=json&status=5xx").json
+    assert [entry["status_code"] for entry in document["history"]] == [503] * 3
+
+    cursor = response.headers["X-Tapedeck-Cursor"]
+    assert client.get(f"/__/history/export?after={cursor}").data == b""
+    client.get("/test")
+    assert len(client.get(f"/__/history/export?after={cursor}").data.splitlines()) == 1
+    assert client.get("/__/history/export?format=xml").status_code == 400
+
+
+def sse_events(response):
+    return (chunk.decode("utf-8") for chunk in response.response)
+
+
+def next_entry_event(events):
+    for event in events:
+        if not event.startswith(":"):
+            return event
+
+
+def test_history_tail_pushes_matching_entries(client, history_manager, monkeypatch):
+    monkeypatch.setitem(app.config, "TAIL_HEARTBEAT", 0.01)
+    history_manager.add_listener(cassette.tail_hub.publish)
+    client.get("/test")
+
+    response = client.get("/__/history/tail?method=POST")
+    assert response.mimetype == "text/event-stream"
+    events = sse_events(response)
+    assert next(events) == ": tailing\n\n"
+    client.get("/test")
+    client.post("/test", data="first")
+    event = next_entry_event(events)
+    lines = event.splitlines()
+    assert lines[0] == f"id: {encode_cursor(2)}"
+    assert lines[1] == "event: entry"
+    assert json.loads(lines[2][len("data: "):])["data"] == "first"
+    response.close()
+    assert len(cassette.tail_hub) == 0
+
+
+def test_history_tail_resumes_from_cursor(client, history_manager, monkeypatch):
+    monkeypatch.setitem(app.config, "TAIL_HEARTBEAT", 0.01)
+    history_manager.add_listener(cassette.tail_hub.publish)
+    for body in ("a", "b", "c"):
+        client.post("/test", data=body)
+
+    response = client.get("/__/history/tail", headers={"Last-Event-ID": encode_cursor(0)})
+    events = sse_events(response)
+    assert [json.loads(next_entry_event(events).split("data: ")[1])["data"] for _ in range(2)] == ["b", "c"]
+    client.post("/test", data="d")
+    assert '"data": "d"' in next_entry_event(events)
+    response.close()
+
+
+def test_response_cache_serves_and_records_hits(client, history_manager, requests_mock, monkeypatch):
+    from cache import ResponseCache
+
+    response_cache = ResponseCache(ttl=60)
+    history_manager.add_listener(response_cache.add)
+    monkeypatch.setattr(cassette, "response_cache", response_cache)
+
+    assert client.get("/test").headers.get("X-Tapedeck-Cache") is None
+    response = client.get("/test")
+    assert response.headers["X-Tapedeck-Cache"] == "HIT"
+    assert response.headers["Age"] == "0"
+    assert response.json == {"response": "ok"}
+    assert requests_mock.call_count == 1
+    assert client.post("/test").status_code == 200
+    assert requests_mock.call_count == 2
+
+    first, hit, _ = history_manager.get_history()
+    assert not first.served_from_cache
+    assert hit.served_from_cache and hit.to_dict()["served_from_cache"] is True
+    assert client.get("/__/cache").json["hits"] == 1
+    assert client.delete("/__/cache").json["entries"] == 0
+
+
+def test_replay_by_id(client, history_manager):
+    client.get("/test")
+    entry_id = history_manager.get_history()[-1].id
+    response = client.post("/__/replay", json={"id": entry_id})
+    assert response.status_code == 200
+    assert response.json["response_body"] == '{"response": "ok"}'
+
+    missing = client.post("/__/replay", json={"id": "nope"})
+    assert missing.status_code == 400
+
+
+def test_proxy_records_binary_bodies_exactly(client, requests_mock, history_manager):
+    png = b"\x89PNG\r\n\x1a\n" + bytes(range(256))
+    requests_mock.post("http://example.com/upload", content=png, headers={"Content-Type": "image/png"})
+    response = client.post("/upload", data=b"\xff\xfe\x00raw", content_type="application/octet-stream")
+    assert response.data == png
+
+    entry = history_manager.get_history()[-1]
+    assert entry.data == b"\xff\xfe\x00raw"
+    assert entry.response_body == png
+    listed = client.get("/__/history").json["history"][-1]
+    assert listed["response_body_encoding"] == "base64"
+
+
+def test_batch_replay_endpoint(client, requests_mock, history_manager):
+    for _ in range(3):
+        client.get("/test")
+    client.post("/test", data="payload")
+    requests_mock.register_uri(ANY, "http://staging.example.com/test", text="changed")
+
+    by_filter = client.post("/__/replay/batch", json={"filter": {"method": "GET"}, "concurrency": 2}).json
+    assert by_filter["summary"]["total"] == 3
+    assert all(result["match"] for result in by_filter["results"])
+
+    last = history_manager.get_history()[-1]
+    against_staging = client.post(
+        "/__/replay/batch", json={"ids": [last.id], "upstream": "http://staging.example.com"}
+    ).json
+    assert against_staging["results"][0]["diff"]["response_body"]["replayed_size"] == len("changed")
+    assert client.post("/__/replay/batch", json={"ids": ["nope"]}).status_code == 400
+    assert client.post("/__/replay/batch", json={"timing": "slow", "filter": {}}).status_code == 400
+
+
+def test_replay_diffs_against_the_recording(client, requests_mock):
+    requests_mock.register_uri(ANY, "http://example.com/order", json={"id": 1, "at": "2024-01-01T10:00:00Z"})
+    client.get("/order")
+    entry_id = client.get("/__/history").json["history"][0]["id"]
+    requests_mock.register_uri(ANY, "http://example.com/order", json={"id": 2, "at": "2024-01-02T11:00:00Z"})
+
+    replayed = client.post("/__/replay", json={"id": entry_id}).json
+    assert [change["path"] for change in replayed["diff"]["response_body"]["changes"]] == ["id", "at"]
+    ignoring = {"id": entry_id, "ignore": {"fields": ["id"], "values": ["timestamps"]}}
+    assert client.post("/__/replay", json=ignoring).json["diff"] == {}
+    batch = client.post("/__/replay/batch", json={"ids": [entry_id], "ignore": {"fields": ["at", "id"]}}).json
+    assert batch["summary"]["matched"] == 1
+    assert client.post("/__/replay/batch", json={"ids": [entry_id], "ignore": {"values": ["("]}}).status_code == 400
+    assert client.post("/__/replay", json={"id": entry_id, "ignore": ["id"]}).status_code == 400
+
+
+def test_proxy_records_phase_timings_and_metrics(client, history_manager, monkeypatch):
+    from metrics import Metrics
+
+    monkeypatch.setattr(cassette, "metrics", Metrics())
+    client.get("/test").close()  # the WSGI server closes the response once it's sent
+    entry = history_manager.get_history()[-1]
+    assert set(entry.timings) == {"receive", "connect", "ttfb", "upstream"}
+    assert history_manager.get(entry.id).to_dict()["timings"] == entry.timings
+
+    response = client.get("/__/metrics")
+    assert response.content_type.startswith("text/plain")
+    text = response.get_data(as_text=True)
+    assert 'tapedeck_requests_total{method="GET",route="/test",status="200"} 1' in text
+    for phase in ("receive", "upstream", "record", "respond", "total"):
+        assert f'tapedeck_phase_duration_seconds_count{{method="GET",route="/test",phase="{phase}"}} 1' in text
+    assert 'tapedeck_recent_requests_per_second{method="GET",route="/test"}' in text
+
+
+@pytest.fixture
+def streaming(monkeypatch):
+    monkeypatch.setitem(app.config, "STREAM_PROXY", True)
+    monkeypatch.setitem(app.config, "STREAM_CHUNK_SIZE", 4)
+
+
+def test_streaming_proxy_records_body(client, history_manager, streaming):
+    response = client.get("/test")
+    assert response.status_code == 200
+    assert response.data == b'{"response": "ok"}'
+    entry = history_manager.get_history()[-1]
+    assert entry.response_body == '{"response": "ok"}'
+    assert entry.response_size is None
+
+
+def test_streaming_proxy_times_the_response(client, history_manager, streaming):
+    client.get("/test").close()
+    assert "respond" in history_manager.get_history()[-1].timings
+
+
+def test_streaming_proxy_truncates_large_bodies(client, history_manager, streaming, monkeypatch):
+    monkeypatch.setitem(app.config, "RECORD_BODY_LIMIT", 6)
+    response = client.get("/test")
+    assert response.data == b'{"response": "ok"}'
+    entry = history_manager.get_history()[-1]
+    assert entry.response_body == '{"resp'
+    assert entry.response_size == 18
+
+
+def test_streaming_proxy_marks_bodies_cut_short_by_the_client(client, history_manager, streaming):
+    index = PlaybackIndex()
+    history_manager.add_listener(index.add)
+    response = client.get("/test", buffered=False)
+    assert next(response.response) == b'{"re'
+    response.close()  # the client disconnects
+    entry = history_manager.get_history()[-1]
+    assert entry.response_body == '{"re'
+    assert entry.response_size is not None
+    assert len(index) == 0
+
+
+class FailingBody(io.RawIOBase):
+    """An upstream body that breaks off after its first read."""
+
+    def __init__(self):
+        self.reads = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        self.reads += 1
+        if self.reads > 1:
+            raise ConnectionResetError("upstream went away")
+        buffer[:4] = b'{"re'
+        return 4
+
+
+@pytest.mark.parametrize("record", [True, False])
+def test_streaming_proxy_passes_on_upstream_failures(client, requests_mock, history_manager, streaming, monkeypatch, record):
+    requests_mock.register_uri(ANY, "http://example.com/broken", body=FailingBody())
+    if not record:
+        monkeypatch.setitem(app.config, "PLAYBACK", True)
+        monkeypatch.setitem(app.config, "PLAYBACK_MISS", "passthrough")
+    with pytest.raises(requests.exceptions.RequestException):
+        client.get("/broken", buffered=True)
+    if record:
+        assert history_manager.get_history()[-1].response_size is not None
+    else:
+        assert len(history_manager.get_history()) == 0
+
+
+def test_pool_stats_endpoint(client):
+    client.get("/test")
+    stats = client.get("/__/pool").json
+    assert stats["requests"] >= 1
+    assert stats["in_flight"] == 0
+
+
+@pytest.fixture
+def playback(history_manager, monkeypatch):
+    index = PlaybackIndex()
+    history_manager.add_listener(index.add)
+    monkeypatch.setattr(cassette, "playback_index", index)
+    monkeypatch.setitem(app.config, "PLAYBACK", True)
+    return index
+
+
+def test_playback_serves_recording_without_upstream(client, requests_mock, playback, monkeypatch):
+    monkeypatch.setitem(app.config, "PLAYBACK_MISS", "record")
+    recorded = client.get("/test?x=1")
+    assert recorded.status_code == 200
+    assert requests_mock.call_count == 1
+
+    replayed = client.get("/test?x=1")
+    assert replayed.data == b'{"response": "ok"}'
+    assert replayed.headers["Content-Type"] == "application/json"
+    assert replayed.headers["X-Tapedeck-Playback"]
+    assert requests_mock.call_count == 1
+
+
+def test_playback_miss_policies(client, requests_mock, history_manager, playback, monkeypatch):
+    monkeypatch.setitem(app.config, "PLAYBACK_MISS", "404")
+    assert client.get("/test").status_code == 404
+    assert requests_mock.call_count == 0
+
+    monkeypatch.setitem(app.config, "PLAYBACK_MISS", "passthrough")
+    assert client.get("/test").status_code == 200
+    assert len(history_manager.get_history()) == 0
+    assert client.get("/test").status_code == 200
+    assert requests_mock.call_count == 2
+
+
+def test_background_recording(client, history_manager, monkeypatch):
+    recorder = BackgroundRecorder(history_manager)
+    monkeypatch.setattr(cassette, "background_recorder", recorder)
+    for _ in range(5):
+        assert client.get("/test").status_code == 200
+    recorder.flush(timeout=5)
+    assert len(history_manager.get_history()) == 5
+    assert client.get("/__/recorder").json["recorded"] == 5
+    recorder.close()
+
+
+def test_history_pages_into_archived_segments(client, tmp_path, monkeypatch):
+    storage = SegmentedStorage(
+        str(tmp_path / "tape"), segment_entries=3, max_entries=3, archive_dir=str(tmp_path / "archive")
+    )
+    manager = HistoryManager(storage)
+    monkeypatch.setattr(cassette, "history_manager", manager)
+    for _ in range(10):
+        client.get("/test")
+
+    assert len(manager.get_history()) < 10
+    page = client.get("/__/history?limit=4").json
+    assert len(page["history"]) == 4
+    assert page["previous"] is None
+    ids = [e["id"] for e in page["history"]]
+    while page["next"]:
+        page = client.get(f"/__/history?limit=4&after={page['next']}").json
+        ids += [e["id"] for e in page["history"]]
+    assert len(set(ids)) == 10
+
+    segments = client.get("/__/segments").json["segments"]
+    assert any(meta["archived"] for meta in segments)
+    manager.close()
+
+
+def test_workers_sharing_a_sqlite_tape_serve_the_same_history(client, tmp_path, monkeypatch):
+    path = str(tmp_path / "tape.sqlite")
+    worker, other_worker = HistoryManager(SqliteStorage(path)), HistoryManager(SqliteStorage(path))
+    monkeypatch.setattr(cassette, "history_manager", worker)
+    monkeypatch.setitem(app.config, "SHARED_TAPE", True)
+
+    client.get("/test")
+    recorded = worker.get_history()[0].to_dict()
+    other_worker.append(HistoryEntry.from_dict({**recorded, "id": "other"}))
+    client.get("/test")
+
+    history = client.get("/__/history?limit=10").json["history"]
+    assert [entry["id"] for entry in history] == [recorded["id"], "other", worker.get_history()[-1].id]
+    assert client.post("/__/replay", json={"id": "other"}).status_code == 200
+    other_worker.refresh()
+    assert [entry.id for entry in other_worker.get_history()] == [entry["id"] for entry in history]
+    worker.close()
+    other_worker.close()
@@ -0,0 +1,43 @@
+from click.testing import CliRunner
+
+from tail import TailHub
+import tapedeck
+
+
+def test_subscriptions_receive_published_entries():
+    hub = TailHub()
+    first, second = hub.subscribe(), hub.subscribe()
+    hub.publish(0, "entry-0")
+    hub.publish(1, "entry-1")
+    assert first.wait(0) == [(0, "entry-0"), (1, "entry-1")]
+    assert first.wait(0) == []
+    second.close()
+    hub.publish(2, "entry-2")
+    assert len(hub) == 1
+    assert first.wait(0) == [(2, "entry-2")]
+
+
+def test_slow_subscriber_is_told_to_catch_up():
+    hub = TailHub(max_pending=2)
+    subscription = hub.subscribe()
+    for seq in range(3):
+        hub.publish(seq, f"entry-{seq}")
+    assert subscription.wait(0) is None
+    hub.publish(3, "entry-3")
+    assert subscription.wait(0) == [(3, "entry-3")]
+
+
+def test_read_events_parses_server_sent_events():
+    lines = [": comment", "id: 1", "event: entry", "data: {", "data: }", "", "data: plain", ""]
+    assert list(tapedeck.read_events(lines)) == [("1", "entry", "{\n}"), ("1", "message", "plain")]
+
+
+def test_tail_cli_prints_entries(requests_mock):
+    entry = '{"timestamp": "2024-01-01T00:00:00", "method": "GET", "path": "orders/1", "query": "a=1", "status_code": 200, "timings": {"upstream": 12.345}}'
+    requests_mock.get(
+        "http://localhost:54321/__/history/tail?status=2xx",
+        text=f": tailing\n\nid: MQ==\nevent: entry\ndata: {entry}\n\n",
+    )
+    result = CliRunner().invoke(tapedeck.cli, ["tail", "--status", "2xx", "--limit", "1"])
+    assert result.exit_code == 0, result.output
+    assert result.output == "2024-01-01T00:00:00 GET     /orders/1?a=1 -> 200 (12.3ms)\n"
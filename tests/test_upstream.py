@@ -0,0 +1,70 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+
+import pytest
+
+from upstream import UpstreamPool
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    connections = []
+
+    def setup(self):
+        super().setup()
+        self.connections.append(self.client_address)
+
+    def do_GET(self):
+        body = b"ok"
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Set-Cookie", "session=abc")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def local_upstream():
+    KeepAliveHandler.connections.clear()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_pool_reuses_connections(local_upstream):
+    pool = UpstreamPool(pool_size=2, read_timeout=5)
+    for _ in range(5):
+        assert pool.request("GET", f"{local_upstream}/x").text == "ok"
+
+    stats = pool.stats()
+    assert stats["requests"] == 5
+    assert stats["errors"] == 0
+    assert stats["in_flight"] == 0
+    [host] = stats["hosts"]
+    assert host["connections_opened"] == 1
+    assert host["requests"] == 5
+    assert host["idle_connections"] == 1
+    assert len(KeepAliveHandler.connections) == 1
+    pool.close()
+
+
+def test_pool_does_not_share_upstream_cookies(local_upstream):
+    pool = UpstreamPool()
+    pool.request("GET", f"{local_upstream}/x")
+    second = pool.request("GET", f"{local_upstream}/x")
+    assert "Cookie" not in second.request.headers
+    pool.close()
+
+
+def test_pool_without_keep_alive_opens_new_connections(local_upstream):
+    pool = UpstreamPool(keep_alive=False)
+    for _ in range(3):
+        pool.request("GET", f"{local_upstream}/x")
+    assert len(KeepAliveHandler.connections) == 3
+    pool.close()
@@ -0,0 +1,147 @@
+from http.cookiejar import DefaultCookiePolicy
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+# Seconds the current thread spent opening upstream connections for its request.
+_connect_time = threading.local()
+
+
+class TimedConnectMixin:
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            _connect_time.seconds = getattr(_connect_time, "seconds", 0.0) + time.perf_counter() - started
+
+
+class TimedHTTPConnection(TimedConnectMixin, HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(TimedConnectMixin, HTTPSConnection):
+    pass
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class UpstreamPool:
+    """A shared, thread-safe connection pool for requests sent to the upstream.
+
+    Connections are kept alive and reused across proxied and replayed requests
+    instead of opening a new TCP/TLS connection every time. Cookies set by the
+    upstream are never stored, so clients of the proxy don't share them.
+
+    Every response gets an ``upstream_timings`` dict, in milliseconds:
+    ``connect`` (opening a connection, TLS included; 0 when one was reused),
+    ``ttfb`` (until the response headers arrived) and ``upstream`` (until
+    the request returned, i.e. the whole body unless streaming).
+    """
+
+    def __init__(
+        self,
+        pool_size=10,
+        pool_block=False,
+        keep_alive=True,
+        max_retries=0,
+        backoff_factor=0.0,
+        retry_statuses=(502, 503, 504),
+        connect_timeout=None,
+        read_timeout=None,
+    ):
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.timeout = (connect_timeout, read_timeout)
+        self._session = requests.Session()
+        self._session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=retry_statuses if max_retries else (),
+            raise_on_status=False,
+        )
+        self._adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            pool_block=pool_block,
+            max_retries=retry,
+        )
+        self._adapter.poolmanager.pool_classes_by_scheme = {
+            "http": TimedHTTPConnectionPool,
+            "https": TimedHTTPSConnectionPool,
+        }
+        self._session.mount("http://", self._adapter)
+        self._session.mount("https://", self._adapter)
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._errors = 0
+        self._in_flight = 0
+
+    def request(self, method, url, **kwargs):
+        """Send a request through the pool; accepts the arguments of ``requests.request``."""
+        kwargs.setdefault("timeout", self.timeout)
+        if not self.keep_alive:
+            kwargs["headers"] = {**(kwargs.get("headers") or {}), "Connection": "close"}
+        with self._lock:
+            self._requests += 1
+            self._in_flight += 1
+        _connect_time.seconds = 0.0
+        started = time.perf_counter()
+        try:
+            response = self._session.request(method, url, **kwargs)
+            response.upstream_timings = {
+                "connect": round(_connect_time.seconds * 1000, 3),
+                "ttfb": round(response.elapsed.total_seconds() * 1000, 3),
+                "upstream": round((time.perf_counter() - started) * 1000, 3),
+            }
+            return response
+        except requests.RequestException:
+            with self._lock:
+                self._errors += 1
+            raise
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def stats(self):
+        """Return request counters and per-host connection pool usage."""
+        hosts = []
+        pools = self._adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            # The pool's queue is padded with None placeholders for unopened slots.
+            idle = sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool is not None else 0
+            hosts.append(
+                {
+                    "host": f"{pool.scheme}://{pool.host}:{pool.port}",
+                    "connections_opened": pool.num_connections,
+                    "requests": pool.num_requests,
+                    "idle_connections": idle,
+                }
+            )
+        with self._lock:
+            return {
+                "pool_size": self.pool_size,
+                "keep_alive": self.keep_alive,
+                "requests": self._requests,
+                "errors": self._errors,
+                "in_flight": self._in_flight,
+                "hosts": hosts,
+            }
+
+    def close(self):
+        self._session.close()